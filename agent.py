@@ -50,6 +50,7 @@ from utils.cloud_metadata import EC2
 from utils.configcheck import configcheck, sd_configcheck
 from utils.flare import Flare
 from utils.hostname import get_hostname
+from utils import json_codec
 from utils.jmx import jmx_command
 from utils.pidfile import PidFile
 from utils.platform import Platform
@@ -382,8 +383,10 @@ class Agent(Daemon):
                 if profiled:
                     collector_profiled_runs += 1
                 if not continue_immediately:
-                    log.debug("Sleeping for {0} seconds".format(self.check_frequency))
-                    time.sleep(self.check_frequency)
+                    # `check_freq`, or until the next check is due when checks are scheduled on their own
+                    delay = self.collector.get_next_run_delay()
+                    log.debug("Sleeping for {0} seconds".format(delay))
+                    time.sleep(delay)
                 else:
                     log.debug("Continuing immediately")
 
@@ -493,6 +496,7 @@ class Agent(Daemon):
 def main():
     options, args = get_parsed_args()
     agentConfig = get_config(options=options)
+    json_codec.configure(agentConfig)
     autorestart = agentConfig.get('autorestart', False)
     hostname = get_hostname(agentConfig)
     in_developer_mode = agentConfig.get('developer_mode')
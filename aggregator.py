@@ -1,10 +1,18 @@
 # stdlib
+from array import array
+from contextlib import contextmanager
+import gc
+import random
+import re
 import sys
 import logging
+import threading
 from time import time
 
 # project
 from checks.metric_types import MetricTypes
+from utils.lru_cache import LRUCache
+from utils.quantile_sketch import DDSketch, DEFAULT_RELATIVE_ACCURACY
 
 log = logging.getLogger(__name__)
 
@@ -20,6 +28,32 @@ log = logging.getLogger(__name__)
 # MetricsBucketAggregator constructor.
 RECENT_POINT_THRESHOLD_DEFAULT = 3600
 
+# Single pass match of the common `<name>:<value>|<type>[|@<sample_rate>][|#<tags>]`
+# metric packet. The value is captured by the first group when it is an integer,
+# by the second one otherwise. Anything else goes through the generic parser.
+METRIC_PACKET_RE = re.compile(r'([^:]+):(?:(\s*[-+]?\d+\s*)|([^|:]*))\|([^|:]+)(?:\|@([^|]*))?(?:\|#([^|]*))?$')
+
+# Bounds of the caches used to parse metric packets
+METRIC_NAME_CACHE_SIZE = 10000
+TAGS_CACHE_SIZE = 10000
+# Bound of the cache mapping submitted (name, tags, hostname, device_name) to context keys
+CONTEXT_CACHE_SIZE = 100000
+
+
+@contextmanager
+def gc_paused():
+    """
+    Pause the cyclic garbage collector. Flushes allocate a point per context
+    and none of them are cyclic, collecting while they're built is wasted time.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
 
 class Infinity(Exception):
     pass
@@ -33,7 +67,12 @@ class Metric(object):
     """
     A base metric class that accepts points, slices them into time intervals
     and performs roll-ups within those intervals.
+
+    A metric is created for every context, so metrics use slots rather than
+    a __dict__ and subclasses must list the attributes they add in
+    `__slots__`. The formatter and extra config are shared references.
     """
+    __slots__ = ('formatter', 'name', 'tags', 'hostname', 'device_name', 'last_sample_time')
 
     def sample(self, value, sample_rate, timestamp=None):
         """ Add a point to the given metric. """
@@ -43,9 +82,29 @@ class Metric(object):
         """ Flush all metrics up to the given timestamp. """
         raise NotImplementedError()
 
+    def merge(self, other):
+        """ Merge the unflushed points of another metric with the same context. """
+        raise NotImplementedError()
+
+    def __getstate__(self):
+        state = {}
+        for cls in type(self).__mro__:
+            for attr in getattr(cls, '__slots__', ()):
+                if hasattr(self, attr):
+                    state[attr] = getattr(self, attr)
+        # Formatters can be closures which can't be pickled, the aggregator
+        # receiving the metric sets its own.
+        state['formatter'] = None
+        return state
+
+    def __setstate__(self, state):
+        for attr, value in state.iteritems():
+            setattr(self, attr, value)
+
 
 class Raw(Metric):
     """ A metric that tracks a value at particular points in time and does not aggregate in any way """
+    __slots__ = ('values', 'timestamp')
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -61,6 +120,9 @@ class Raw(Metric):
     def sample(self, value, sample_rate, timestamp=None):
         self.values.append((value, timestamp))
 
+    def merge(self, other):
+        self.values.extend(other.values)
+
     def flush(self, timestamp, interval):
         metrics = [self.formatter(
             metric=self.name,
@@ -78,6 +140,7 @@ class Raw(Metric):
 
 class Gauge(Metric):
     """ A metric that tracks a value at particular points in time. """
+    __slots__ = ('value', 'timestamp')
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -94,6 +157,13 @@ class Gauge(Metric):
         self.last_sample_time = time()
         self.timestamp = timestamp
 
+    def merge(self, other):
+        # Keep the most recent sample
+        if other.value is not None and (self.value is None or other.last_sample_time >= self.last_sample_time):
+            self.value = other.value
+            self.last_sample_time = other.last_sample_time
+            self.timestamp = other.timestamp
+
     def flush(self, timestamp, interval):
         if self.value is not None:
             res = [self.formatter(
@@ -119,6 +189,7 @@ class BucketGauge(Gauge):
     opposed to the time that the sample was collected.
 
     """
+    __slots__ = ()
 
     def flush(self, timestamp, interval):
         if self.value is not None:
@@ -140,6 +211,7 @@ class BucketGauge(Gauge):
 
 class Count(Metric):
     """ A metric that tracks a count. """
+    __slots__ = ('value',)
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -172,6 +244,7 @@ class Count(Metric):
             self.value = None
 
 class MonotonicCount(Metric):
+    __slots__ = ('prev_counter', 'curr_counter', 'count')
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -220,6 +293,7 @@ class MonotonicCount(Metric):
 
 class Counter(Metric):
     """ A metric that tracks a counter value. """
+    __slots__ = ('value',)
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -234,6 +308,10 @@ class Counter(Metric):
         self.value += value * int(1 / sample_rate)
         self.last_sample_time = time()
 
+    def merge(self, other):
+        self.value += other.value
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
     def flush(self, timestamp, interval):
         try:
             value = self.value / interval
@@ -255,6 +333,7 @@ DEFAULT_HISTOGRAM_PERCENTILES = [0.95]
 
 class Histogram(Metric):
     """ A metric to track the distribution of a set of values. """
+    __slots__ = ('count', 'samples', 'aggregates', 'percentiles')
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -277,6 +356,11 @@ class Histogram(Metric):
         self.samples.append(value)
         self.last_sample_time = time()
 
+    def merge(self, other):
+        self.count += other.count
+        self.samples.extend(other.samples)
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
     def flush(self, ts, interval):
         if not self.count:
             return []
@@ -289,7 +373,17 @@ class Histogram(Metric):
         med = self.samples[int(round(length/2 - 1))]
         sum_ = sum(self.samples)
         avg = sum_ / float(length)
+        percentiles = [(p, self.samples[int(round(p * length - 1))]) for p in self.percentiles]
 
+        metrics = self._format_aggregates(ts, interval, min_, max_, med, avg, sum_, percentiles)
+
+        # Reset our state.
+        self.samples = []
+        self.count = 0
+
+        return metrics
+
+    def _format_aggregates(self, ts, interval, min_, max_, med, avg, sum_, percentiles):
         aggregators = [
             ('min', min_, MetricTypes.GAUGE),
             ('max', max_, MetricTypes.GAUGE),
@@ -316,8 +410,7 @@ class Histogram(Metric):
             interval=interval) for suffix, value, metric_type in metric_aggrs
         ]
 
-        for p in self.percentiles:
-            val = self.samples[int(round(p * length - 1))]
+        for p, val in percentiles:
             name = '%s.%spercentile' % (self.name, int(p * 100))
             metrics.append(self.formatter(
                 hostname=self.hostname,
@@ -329,15 +422,160 @@ class Histogram(Metric):
                 interval=interval,
             ))
 
+        return metrics
+
+
+class SketchHistogram(Histogram):
+    """
+    A histogram keeping its samples in a quantile sketch, so that its memory
+    and flush time don't grow with the number of samples. min, max, sum, avg
+    and count are exact, the median and percentiles are within the relative
+    accuracy of the sketch.
+    """
+    __slots__ = ('relative_accuracy', 'sketch', 'min', 'max', 'sum')
+
+    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
+        super(SketchHistogram, self).__init__(formatter, name, tags, hostname, device_name, extra_config)
+        self.samples = None
+        self.relative_accuracy = extra_config.get('relative_accuracy') if extra_config is not None else None
+        self.relative_accuracy = self.relative_accuracy or DEFAULT_RELATIVE_ACCURACY
+        self._reset()
+
+    def _reset(self):
+        self.count = 0
+        self.sketch = DDSketch(self.relative_accuracy)
+        self.min = None
+        self.max = None
+        self.sum = 0
+
+    def sample(self, value, sample_rate, timestamp=None):
+        self.count += int(1 / sample_rate)
+        self.sketch.add(value)
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        self.last_sample_time = time()
+
+    def merge(self, other):
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+        self.count += other.count
+        self.sum += other.sum
+        self.sketch.merge(other.sketch)
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
+    def _quantile(self, q):
+        # Quantiles are approximated, but never outside of the exact bounds
+        return min(max(self.sketch.quantile(q), self.min), self.max)
+
+    def flush(self, ts, interval):
+        if not self.count:
+            return []
+
+        avg = self.sum / float(self.sketch.count)
+        percentiles = [(p, self._quantile(p)) for p in self.percentiles]
+        metrics = self._format_aggregates(ts, interval, self.min, self.max, self._quantile(0.5),
+                                          avg, self.sum, percentiles)
+
+        self._reset()
+
+        return metrics
+
+
+# Partitions smaller than this are sorted by `select_ranks`
+SELECT_SORT_THRESHOLD = 64
+
+
+def select_ranks(values, ranks):
+    """
+    Return a {rank: value} dict of the values found at the given 0-based ranks
+    of `values` once sorted, without sorting them. Quickselect partitions only
+    the ranges holding one of the requested ranks.
+    """
+    selected = {}
+    partitions = [(values, sorted(set(ranks)), 0)]
+    while partitions:
+        partition, partition_ranks, offset = partitions.pop()
+
+        if len(partition) <= SELECT_SORT_THRESHOLD:
+            partition = sorted(partition)
+            for rank in partition_ranks:
+                selected[rank] = partition[rank - offset]
+            continue
+
+        pivot = partition[random.randint(0, len(partition) - 1)]
+        lows = [v for v in partition if v < pivot]
+        highs = [v for v in partition if v > pivot]
+        highs_offset = offset + len(partition) - len(highs)
+
+        low_ranks, high_ranks = [], []
+        for rank in partition_ranks:
+            if rank < offset + len(lows):
+                low_ranks.append(rank)
+            elif rank < highs_offset:
+                selected[rank] = pivot
+            else:
+                high_ranks.append(rank)
+
+        if low_ranks:
+            partitions.append((lows, low_ranks, offset))
+        if high_ranks:
+            partitions.append((highs, high_ranks, highs_offset))
+
+    return selected
+
+
+class CompactHistogram(Histogram):
+    """
+    A histogram storing its samples as doubles in an array rather than as a
+    list of Python floats, about 4 times smaller. The median and percentiles
+    are selected at flush time instead of sorting every sample.
+    """
+    __slots__ = ()
+
+    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
+        super(CompactHistogram, self).__init__(formatter, name, tags, hostname, device_name, extra_config)
+        self.samples = array('d')
+
+    def flush(self, ts, interval):
+        if not self.count:
+            return []
+
+        samples = self.samples
+        length = len(samples)
+
+        # Same ranks as Histogram, where a negative rank indexes from the end
+        median_rank = int(round(length/2 - 1)) % length
+        percentile_ranks = [(p, int(round(p * length - 1)) % length) for p in self.percentiles]
+        selected = select_ranks(samples, [median_rank] + [rank for _, rank in percentile_ranks])
+
+        sum_ = sum(samples)
+        avg = sum_ / float(length)
+        percentiles = [(p, selected[rank]) for p, rank in percentile_ranks]
+
+        metrics = self._format_aggregates(ts, interval, min(samples), max(samples), selected[median_rank],
+                                          avg, sum_, percentiles)
+
         # Reset our state.
-        self.samples = []
+        self.samples = array('d')
         self.count = 0
 
         return metrics
 
 
+HISTOGRAM_BACKENDS = {
+    'exact': Histogram,
+    'sketch': SketchHistogram,
+}
+
+
 class Set(Metric):
     """ A metric to track the number of unique elements in a set. """
+    __slots__ = ('values',)
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -352,6 +590,10 @@ class Set(Metric):
         self.values.add(value)
         self.last_sample_time = time()
 
+    def merge(self, other):
+        self.values.update(other.values)
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
     def flush(self, timestamp, interval):
         if not self.values:
             return []
@@ -370,8 +612,25 @@ class Set(Metric):
             self.values = set()
 
 
+class CompactSet(Set):
+    """
+    A set keeping its integer members, e.g. ids, as integers rather than as
+    the strings of the packets, the other members are kept as they are.
+    An integer member and its decimal string are counted as one member.
+    """
+    __slots__ = ()
+
+    def sample(self, value, sample_rate, timestamp=None):
+        if value.__class__ is str and value.isdigit() and (value == '0' or value[0] != '0'):
+            # Only the canonical writing, '01' stays a member of its own
+            value = int(value)
+        self.values.add(value)
+        self.last_sample_time = time()
+
+
 class Rate(Metric):
     """ Track the rate of metrics over each flush interval """
+    __slots__ = ('samples',)
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -434,7 +693,8 @@ class Aggregator(object):
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
             formatter=None, recent_point_threshold=None,
             histogram_aggregates=None, histogram_percentiles=None,
-            utf8_decoding=False):
+            utf8_decoding=False, histogram_backend=None,
+            histogram_relative_accuracy=None, compact_storage=False):
         self.events = []
         self.service_checks = []
         self.total_count = 0
@@ -450,16 +710,48 @@ class Aggregator(object):
         self.recent_point_threshold = int(recent_point_threshold)
         self.num_discarded_old_points = 0
 
+        # Class used for histograms and timers, see HISTOGRAM_BACKENDS
+        if histogram_backend is not None and histogram_backend not in HISTOGRAM_BACKENDS:
+            log.warning("Unknown histogram backend %s, using exact histograms", histogram_backend)
+        self.histogram_class = HISTOGRAM_BACKENDS.get(histogram_backend, Histogram)
+
+        # Store the samples of exact histograms and the members of sets in
+        # compact structures
+        if compact_storage and self.histogram_class is Histogram:
+            self.histogram_class = CompactHistogram
+        self.set_class = CompactSet if compact_storage else Set
+
         # Additional config passed when instantiating metric configs
         self.metric_config = {
             Histogram: {
                 'aggregates': histogram_aggregates,
                 'percentiles': histogram_percentiles
+            },
+            SketchHistogram: {
+                'aggregates': histogram_aggregates,
+                'percentiles': histogram_percentiles,
+                'relative_accuracy': histogram_relative_accuracy
+            },
+            CompactHistogram: {
+                'aggregates': histogram_aggregates,
+                'percentiles': histogram_percentiles
             }
         }
 
         self.utf8_decoding = utf8_decoding
 
+        # Parsing caches: one copy of each metric name, and the sorted tuple
+        # for each raw tag string.
+        self.metric_names = LRUCache(METRIC_NAME_CACHE_SIZE)
+        self.tags_by_string = LRUCache(TAGS_CACHE_SIZE)
+        self.contexts = LRUCache(CONTEXT_CACHE_SIZE)
+
+        # Guards the swap of what has been aggregated so far with a new
+        # generation at flush time, when the submissions come from another
+        # thread. Only held for the swap, not while the old generation is
+        # flushed.
+        self.generation_lock = threading.Lock()
+
     def packets_per_second(self, interval):
         if interval == 0:
             return 0
@@ -469,6 +761,57 @@ class Aggregator(object):
         """
         Schema of a dogstatsd packet:
         <name>:<value>|<metric_type>|@<sample_rate>|#<tag1_name>:<tag1_value>,<tag2_name>:<tag2_value>:<value>|<metric_type>...
+
+        Single value packets are parsed in one regex match, the others (and
+        the invalid ones) are handed over to `_parse_metric_packet`.
+        """
+        match = METRIC_PACKET_RE.match(packet)
+        if match is None:
+            return self._parse_metric_packet(packet)
+
+        name, int_value, raw_value, metric_type, sample_rate, tags = match.groups()
+
+        if metric_type in self.IGNORE_TYPES:
+            return []
+        elif metric_type in self.ALLOW_STRINGS:
+            value = raw_value if int_value is None else int_value
+        elif int_value is not None:
+            value = int(int_value)
+        else:
+            try:
+                value = float(raw_value)
+            except ValueError:
+                return self._parse_metric_packet(packet)
+
+        if sample_rate is None:
+            sample_rate = 1
+        else:
+            try:
+                sample_rate = float(sample_rate)
+            except ValueError:
+                return self._parse_metric_packet(packet)
+            # in case it's in a bad state
+            sample_rate = 1 if sample_rate < 0 or sample_rate > 1 else sample_rate
+
+        if tags is not None:
+            tag_string = tags
+            tags = self.tags_by_string.get(tag_string)
+            if tags is None:
+                tags = tuple(sorted(tag_string.split(',')))
+                self.tags_by_string.set(tag_string, tags)
+
+        cached_name = self.metric_names.get(name)
+        if cached_name is None:
+            self.metric_names.set(name, name)
+        else:
+            name = cached_name
+
+        return [(name, value, metric_type, tags, sample_rate)]
+
+    def _parse_metric_packet(self, packet):
+        """
+        Generic parser, handling multiple values per packet and reporting
+        unparseable packets.
         """
         parsed_packets = []
         name_and_metadata = packet.split(':', 1)
@@ -650,6 +993,19 @@ class Aggregator(object):
                     self.submit_metric(name, value, mtype, tags=tags, hostname=hostname,
                                        device_name=device_name, sample_rate=sample_rate)
 
+    def submit_datagrams(self, datagrams):
+        """
+        Submit a batch of datagrams drained from the socket in one wakeup.
+        An unparseable datagram is logged and skipped, the rest of the batch
+        is still aggregated.
+        """
+        submit_packets = self.submit_packets
+        for datagram in datagrams:
+            try:
+                submit_packets(datagram)
+            except Exception:
+                log.exception('Error receiving datagram `%s`', datagram)
+
     def _extract_magic_tags(self, tags):
         """Magic tags (host, device) override metric hostname and device_name attributes"""
         hostname = None
@@ -672,6 +1028,33 @@ class Aggregator(object):
                 tags = tuple(tags) or None
         return hostname, device_name, tags
 
+    def get_context(self, name, tags, hostname, device_name):
+        """
+        Return the context key of a series. Tags are deduped and sorted only
+        the first time a given (name, tags, hostname, device_name) is seen, the
+        same key is returned for the following submissions.
+        """
+        if tags is None or tags.__class__ is tuple:
+            key = (name, tags, hostname, device_name)
+        else:
+            key = (name, tuple(tags), hostname, device_name)
+
+        context = self.contexts.get(key)
+        if context is None:
+            if tags is None:
+                context = (name, tuple(), hostname, device_name)
+            else:
+                context = (name, tuple(sorted(set(key[1]))), hostname, device_name)
+            self.contexts.set(key, context)
+
+        return context
+
+    def context_cache_stats(self):
+        return {
+            'hits': self.contexts.hits,
+            'misses': self.contexts.misses,
+        }
+
     def submit_metric(self, name, value, mtype, tags=None, hostname=None,
                       device_name=None, timestamp=None, sample_rate=1):
         """ Add a metric to be aggregated """
@@ -701,7 +1084,8 @@ class Aggregator(object):
         else:
             event['host'] = self.hostname
 
-        self.events.append(event)
+        with self.generation_lock:
+            self.events.append(event)
 
     def service_check(self, check_name, status, tags=None, timestamp=None,
                       hostname=None, message=None):
@@ -720,15 +1104,17 @@ class Aggregator(object):
         if message is not None:
             service_check['message'] = message
 
-        self.service_checks.append(service_check)
+        with self.generation_lock:
+            self.service_checks.append(service_check)
 
     def flush(self):
         """ Flush aggregated metrics """
         raise NotImplementedError()
 
     def flush_events(self):
-        events = self.events
-        self.events = []
+        with self.generation_lock:
+            events = self.events
+            self.events = []
 
         self.total_count += self.event_count
         self.event_count = 0
@@ -738,8 +1124,9 @@ class Aggregator(object):
         return events
 
     def flush_service_checks(self):
-        service_checks = self.service_checks
-        self.service_checks = []
+        with self.generation_lock:
+            service_checks = self.service_checks
+            self.service_checks = []
 
         self.total_count += self.service_check_count
         self.service_check_count = 0
@@ -759,7 +1146,8 @@ class MetricsBucketAggregator(Aggregator):
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
             formatter=None, recent_point_threshold=None,
             histogram_aggregates=None, histogram_percentiles=None,
-            utf8_decoding=False):
+            utf8_decoding=False, histogram_backend=None,
+            histogram_relative_accuracy=None, compact_storage=False):
         super(MetricsBucketAggregator, self).__init__(
             hostname,
             interval,
@@ -768,7 +1156,10 @@ class MetricsBucketAggregator(Aggregator):
             recent_point_threshold,
             histogram_aggregates,
             histogram_percentiles,
-            utf8_decoding
+            utf8_decoding,
+            histogram_backend,
+            histogram_relative_accuracy,
+            compact_storage
         )
         self.metric_by_bucket = {}
         self.last_sample_time_by_context = {}
@@ -778,9 +1169,9 @@ class MetricsBucketAggregator(Aggregator):
         self.metric_type_to_class = {
             'g': BucketGauge,
             'c': Counter,
-            'h': Histogram,
-            'ms': Histogram,
-            's': Set,
+            'h': self.histogram_class,
+            'ms': self.histogram_class,
+            's': self.set_class,
             'r': Raw
         }
 
@@ -796,10 +1187,7 @@ class MetricsBucketAggregator(Aggregator):
         # Keep hostname with empty string to unset it
         hostname = hostname if hostname is not None else self.hostname
 
-        if tags is None:
-            context = (name, tuple(), hostname, device_name)
-        else:
-            context = (name, tuple(sorted(set(tags))), hostname, device_name)
+        context = self.get_context(name, tags, hostname, device_name)
 
         cur_time = time()
         # Check to make sure that the timestamp that is passed in (if any) is not older than
@@ -811,71 +1199,101 @@ class MetricsBucketAggregator(Aggregator):
             timestamp = timestamp or cur_time
             # Keep track of the buckets using the timestamp at the start time of the bucket
             bucket_start_timestamp = self.calculate_bucket_start(timestamp)
-            if bucket_start_timestamp == self.current_bucket:
-                metric_by_context = self.current_mbc
-            else:
-                if bucket_start_timestamp not in self.metric_by_bucket:
-                    self.metric_by_bucket[bucket_start_timestamp] = {}
-                metric_by_context = self.metric_by_bucket[bucket_start_timestamp]
-                self.current_bucket = bucket_start_timestamp
-                self.current_mbc = metric_by_context
-
-            if context not in metric_by_context:
-                metric_class = self.metric_type_to_class[mtype]
-                metric_by_context[context] = metric_class(self.formatter, name, tags,
-                    hostname, device_name, self.metric_config.get(metric_class))
-
-            metric_by_context[context].sample(value, sample_rate, timestamp)
-
-    def create_empty_metrics(self, sample_time_by_context, expiry_timestamp, flush_timestamp, metrics):
+            with self.generation_lock:
+                if bucket_start_timestamp == self.current_bucket:
+                    metric_by_context = self.current_mbc
+                else:
+                    if bucket_start_timestamp not in self.metric_by_bucket:
+                        self.metric_by_bucket[bucket_start_timestamp] = {}
+                    metric_by_context = self.metric_by_bucket[bucket_start_timestamp]
+                    self.current_bucket = bucket_start_timestamp
+                    self.current_mbc = metric_by_context
+
+                if context not in metric_by_context:
+                    metric_class = self.metric_type_to_class[mtype]
+                    metric_by_context[context] = metric_class(self.formatter, name, tags,
+                        hostname, device_name, self.metric_config.get(metric_class))
+
+                metric_by_context[context].sample(value, sample_rate, timestamp)
+
+    def create_empty_metrics(self, expiry_timestamp, flush_timestamp, metrics, sampled_contexts=None):
         # Even if no data is submitted, Counters keep reporting "0" for expiry_seconds.  The other Metrics
         #  (Set, Gauge, Histogram) do not report if no data is submitted
-        for context, last_sample_time in sample_time_by_context.items():
-            if last_sample_time < expiry_timestamp:
-                log.debug("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
-                self.last_sample_time_by_context.pop(context, None)
-            else:
-                # The expiration currently only applies to Counters
-                # This counts on the ordering of the context created in submit_metric not changing
-                metric = Counter(self.formatter, context[0], context[1], context[2], context[3])
-                metrics += metric.flush(flush_timestamp, self.interval)
+        last_sample_time_by_context = self.last_sample_time_by_context
+        expired_contexts = [context for context, last_sample_time in last_sample_time_by_context.iteritems()
+                            if last_sample_time < expiry_timestamp]
+        for context in expired_contexts:
+            log.debug("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
+            del last_sample_time_by_context[context]
+
+        if sampled_contexts:
+            empty_contexts = last_sample_time_by_context.viewkeys() - sampled_contexts
+        else:
+            empty_contexts = last_sample_time_by_context
+
+        # The points are formatted directly rather than through a Counter per context.
+        # This counts on the ordering of the context created in submit_metric not changing
+        formatter = self.formatter
+        interval = self.interval
+        value = 0 / interval
+        metrics.extend([formatter(
+            metric=context[0],
+            value=value,
+            timestamp=flush_timestamp,
+            tags=context[1],
+            hostname=context[2],
+            device_name=context[3],
+            metric_type=MetricTypes.RATE,
+            interval=interval,
+        ) for context in empty_contexts])
 
     def flush(self):
         cur_time = time()
         flush_cutoff_time = self.calculate_bucket_start(cur_time)
         expiry_timestamp = cur_time - self.expiry_seconds
+        interval = self.interval
+        last_sample_time_by_context = self.last_sample_time_by_context
 
         metrics = []
 
-        if self.metric_by_bucket:
-            # We want to process these in order so that we can check for and expired metrics and
-            #  re-create non-expired metrics.  We also mutate self.metric_by_bucket.
-            for bucket_start_timestamp in sorted(self.metric_by_bucket.keys()):
-                metric_by_context = self.metric_by_bucket[bucket_start_timestamp]
+        # Swap the closed buckets out of the live generation. Submissions only
+        # go to the open buckets from then on, the closed ones are flushed
+        # without holding the lock.
+        with self.generation_lock:
+            has_buckets = bool(self.metric_by_bucket)
+            metric_by_bucket = {}
+            for bucket_start_timestamp in self.metric_by_bucket.keys():
                 if bucket_start_timestamp < flush_cutoff_time:
-                    not_sampled_in_this_bucket = self.last_sample_time_by_context.copy()
-                    # We mutate this dictionary while iterating so don't use an iterator.
-                    for context, metric in metric_by_context.items():
+                    metric_by_bucket[bucket_start_timestamp] = self.metric_by_bucket.pop(bucket_start_timestamp)
+            self.current_bucket = None
+            self.current_mbc = {}
+
+        with gc_paused():
+            if has_buckets:
+                # We want to process these in order so that we can check for and expired metrics and
+                #  re-create non-expired metrics.
+                for bucket_start_timestamp in sorted(metric_by_bucket):
+                    metric_by_context = metric_by_bucket[bucket_start_timestamp]
+
+                    # Counters sampled in this bucket, the others are reported as 0 until they expire
+                    sampled_counters = set()
+                    for context, metric in metric_by_context.iteritems():
                         if metric.last_sample_time < expiry_timestamp:
                             # This should never happen
                             log.warning("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
-                            not_sampled_in_this_bucket.pop(context, None)
-                            self.last_sample_time_by_context.pop(context, None)
+                            last_sample_time_by_context.pop(context, None)
                         else:
-                            metrics += metric.flush(bucket_start_timestamp, self.interval)
-                            if isinstance(metric, Counter):
-                                self.last_sample_time_by_context[context] = metric.last_sample_time
-                                not_sampled_in_this_bucket.pop(context, None)
+                            metrics.extend(metric.flush(bucket_start_timestamp, interval))
+                            if metric.__class__ is Counter:
+                                last_sample_time_by_context[context] = metric.last_sample_time
+                                sampled_counters.add(context)
                     # We need to account for Metrics that have not expired and were not flushed for this bucket
-                    self.create_empty_metrics(not_sampled_in_this_bucket, expiry_timestamp, bucket_start_timestamp, metrics)
-
-                    del self.metric_by_bucket[bucket_start_timestamp]
-        else:
-            # Even if there are no metrics in this flush, there may be some non-expired counters
-            #  We should only create these non-expired metrics if we've passed an interval since the last flush
-            if flush_cutoff_time >= self.last_flush_cutoff_time + self.interval:
-                self.create_empty_metrics(self.last_sample_time_by_context.copy(), expiry_timestamp,
-                                          flush_cutoff_time-self.interval, metrics)
+                    self.create_empty_metrics(expiry_timestamp, bucket_start_timestamp, metrics, sampled_counters)
+            else:
+                # Even if there are no metrics in this flush, there may be some non-expired counters
+                #  We should only create these non-expired metrics if we've passed an interval since the last flush
+                if flush_cutoff_time >= self.last_flush_cutoff_time + self.interval:
+                    self.create_empty_metrics(expiry_timestamp, flush_cutoff_time-self.interval, metrics)
 
         # Log a warning regarding metrics with old timestamps being submitted
         if self.num_discarded_old_points > 0:
@@ -886,11 +1304,65 @@ class MetricsBucketAggregator(Aggregator):
         log.debug("received %s payloads since last flush" % self.count)
         self.total_count += self.count
         self.count = 0
-        self.current_bucket = None
-        self.current_mbc = {}
         self.last_flush_cutoff_time = flush_cutoff_time
         return metrics
 
+    def flush_shard(self):
+        """
+        Hand over everything aggregated so far, including the buckets that are
+        still open, so that it can be merged into another aggregator with
+        `merge_shard`. Used by the sharded stsstatsd workers.
+        """
+        with self.generation_lock:
+            shard = {
+                'metric_by_bucket': self.metric_by_bucket,
+                'events': self.events,
+                'service_checks': self.service_checks,
+                'count': self.count,
+                'event_count': self.event_count,
+                'service_check_count': self.service_check_count,
+                'num_discarded_old_points': self.num_discarded_old_points,
+            }
+            self.metric_by_bucket = {}
+            self.current_bucket = None
+            self.current_mbc = {}
+            self.events = []
+            self.service_checks = []
+            self.total_count += self.count + self.event_count + self.service_check_count
+            self.count = 0
+            self.event_count = 0
+            self.service_check_count = 0
+            self.num_discarded_old_points = 0
+        return shard
+
+    def merge_shard(self, shard):
+        """
+        Merge a shard returned by `flush_shard` into this aggregator. Points of
+        the same bucket and context are rolled up as if they had been submitted
+        here: counters are summed, sets are unioned, histogram samples are
+        concatenated and the most recent gauge wins.
+        """
+        with self.generation_lock:
+            for bucket_start_timestamp, shard_metric_by_context in shard['metric_by_bucket'].iteritems():
+                metric_by_context = self.metric_by_bucket.setdefault(bucket_start_timestamp, {})
+                for context, metric in shard_metric_by_context.iteritems():
+                    if context in metric_by_context:
+                        metric_by_context[context].merge(metric)
+                    else:
+                        metric.formatter = self.formatter
+                        metric_by_context[context] = metric
+
+            # The current bucket dict may have been replaced by a merged one
+            self.current_bucket = None
+            self.current_mbc = {}
+
+            self.events.extend(shard['events'])
+            self.service_checks.extend(shard['service_checks'])
+            self.count += shard['count']
+            self.event_count += shard['event_count']
+            self.service_check_count += shard['service_check_count']
+            self.num_discarded_old_points += shard['num_discarded_old_points']
+
 
 class MetricsAggregator(Aggregator):
     """
@@ -900,7 +1372,8 @@ class MetricsAggregator(Aggregator):
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
             formatter=None, recent_point_threshold=None,
             histogram_aggregates=None, histogram_percentiles=None,
-            utf8_decoding=False):
+            utf8_decoding=False, histogram_backend=None,
+            histogram_relative_accuracy=None, compact_storage=False):
         super(MetricsAggregator, self).__init__(
             hostname,
             interval,
@@ -909,7 +1382,10 @@ class MetricsAggregator(Aggregator):
             recent_point_threshold,
             histogram_aggregates,
             histogram_percentiles,
-            utf8_decoding
+            utf8_decoding,
+            histogram_backend,
+            histogram_relative_accuracy,
+            compact_storage
         )
         self.metrics = {}
         self.metric_type_to_class = {
@@ -917,9 +1393,9 @@ class MetricsAggregator(Aggregator):
             'ct': Count,
             'ct-c': MonotonicCount,
             'c': Counter,
-            'h': Histogram,
-            'ms': Histogram,
-            's': Set,
+            'h': self.histogram_class,
+            'ms': self.histogram_class,
+            's': self.set_class,
             '_dd-r': Rate,
             'r': Raw,
         }
@@ -931,10 +1407,7 @@ class MetricsAggregator(Aggregator):
         # Keep hostname with empty string to unset it
         hostname = hostname if hostname is not None else self.hostname
 
-        if tags is None:
-            context = (name, tuple(), hostname, device_name)
-        else:
-            context = (name, tuple(sorted(set(tags))), hostname, device_name)
+        context = self.get_context(name, tags, hostname, device_name)
         if context not in self.metrics:
             metric_class = self.metric_type_to_class[mtype]
             self.metrics[context] = metric_class(self.formatter, name, tags,
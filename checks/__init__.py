@@ -7,6 +7,7 @@ The Check class is being deprecated so don't write new checks with it.
 # stdlib
 from collections import defaultdict
 import copy
+import json
 import logging
 import numbers
 import os
@@ -40,6 +41,9 @@ DEFAULT_PSUTIL_METHODS = ['memory_info', 'io_counters']
 
 AGENT_METRICS_CHECK_NAME = 'agent_metrics'
 
+# Seconds between the full snapshots of the topology instances sent incrementally
+DEFAULT_TOPOLOGY_RESYNC_INTERVAL = 30 * 60
+
 
 # Konstants
 class CheckException(Exception):
@@ -305,26 +309,153 @@ class Check(object):
                 pass
         return metrics
 
+def _topology_element_hash(data):
+    return hash(json.dumps(data, sort_keys=True, default=repr))
+
+
+class TopologyState(object):
+    """
+    Content hashes of the components and relations of a topology instance,
+    by external id, as of its last snapshot sent.
+
+    Snapshots are then sent as the changes since the last one: the
+    components and relations added or changed, and the external ids of the
+    ones deleted. A full snapshot is still sent every `resync_interval`
+    seconds.
+
+    Enabled by the `incremental_topology` option of the init_config of a
+    check, `topology_resync_interval` setting the resync interval.
+    """
+    def __init__(self, resync_interval=DEFAULT_TOPOLOGY_RESYNC_INTERVAL):
+        self.resync_interval = resync_interval
+        self.component_hashes = None
+        self.relation_hashes = None
+        self.last_resync = None
+        # Hashes of the snapshot in progress
+        self._component_hashes = {}
+        self._relation_hashes = {}
+
+    def reset(self):
+        """ Send the next snapshot in full. """
+        self.component_hashes = None
+        self.relation_hashes = None
+        self.last_resync = None
+
+    def needs_resync(self, now):
+        return self.last_resync is None or now - self.last_resync >= self.resync_interval
+
+    def start_snapshot(self, now):
+        """
+        Start a snapshot, return whether it's sent as the changes since the
+        last one.
+        """
+        self._component_hashes = {}
+        self._relation_hashes = {}
+        if self.needs_resync(now):
+            self.last_resync = now
+            return False
+        return True
+
+    @staticmethod
+    def _add(data, hashes, previous_hashes):
+        external_id = data['externalId']
+        element_hash = _topology_element_hash(data)
+        hashes[external_id] = element_hash
+        return previous_hashes is None or previous_hashes.get(external_id) != element_hash
+
+    def add_component(self, data):
+        """
+        Record a component of the snapshot, return whether it was added or
+        changed since the last snapshot.
+        """
+        return self._add(data, self._component_hashes, self.component_hashes)
+
+    def add_relation(self, data):
+        return self._add(data, self._relation_hashes, self.relation_hashes)
+
+    def stop_snapshot(self):
+        """
+        Stop the snapshot, return the external ids deleted since the last one.
+        """
+        deleted = []
+        for hashes, previous_hashes in ((self._component_hashes, self.component_hashes),
+                                        (self._relation_hashes, self.relation_hashes)):
+            if previous_hashes is not None:
+                deleted.extend(sorted(external_id for external_id in previous_hashes
+                                      if external_id not in hashes))
+        self.component_hashes, self.relation_hashes = self._component_hashes, self._relation_hashes
+        self._component_hashes, self._relation_hashes = {}, {}
+        return deleted
+
+
 class TopologyInstance:
-    def __init__(self, instance_key):
+    def __init__(self, instance_key, state=None, batch_size=None, flush=None):
         self._instance_key = instance_key
         self._in_snapshot = False
         self._components = []
         self._relations = []
         self._start_snapshot = False
         self._stop_snapshot = False
+        # TopologyState of the instance, when its snapshots are sent incrementally
+        self._state = state
+        # Whether the snapshot in progress is sent as the changes since the last one
+        self._diffing = False
+        self._delete_ids = []
+        # Components and relations are passed to `flush` by batches of `batch_size`,
+        # it returns whether the batch was sent
+        self._batch_size = batch_size
+        self._flush = flush
+        # Set when a batch of the snapshot in progress couldn't be sent
+        self._aborted = False
 
     def add_component(self, data):
         if self._stop_snapshot:
             raise Exception("Cannot add component to %s after stopping snapshot in a check run" % self._instance_key)
 
+        if self._aborted:
+            return
+        if self._state is not None and self._in_snapshot:
+            if not self._state.add_component(data) and self._diffing:
+                return
         self._components.append(data)
+        self._flush_batch()
 
     def add_relation(self, data):
         if self._stop_snapshot:
             raise Exception("Cannot add relation to %s after stopping snapshot in a check run" % self._instance_key)
 
+        if self._aborted:
+            return
+        if self._state is not None and self._in_snapshot:
+            if not self._state.add_relation(data) and self._diffing:
+                return
         self._relations.append(data)
+        self._flush_batch()
+
+    def _flush_batch(self):
+        if self._flush is None or not self._batch_size:
+            return
+        if len(self._components) + len(self._relations) < self._batch_size:
+            return
+
+        sent = self._flush(self.get_topology())
+        self._components = []
+        self._relations = []
+        # The next batches continue the snapshot
+        self._start_snapshot = False
+        if not sent and self._in_snapshot:
+            self._abort_snapshot()
+
+    def _abort_snapshot(self):
+        """
+        Drop the rest of the snapshot in progress, a batch of it was lost: it
+        isn't stopped, so the receiver doesn't take the elements of the batch
+        as deleted, and the next snapshot is sent in full.
+        """
+        self._aborted = True
+        self._diffing = False
+        if self._state is not None:
+            self._state.reset()
 
     def start_snapshot(self):
         if self._stop_snapshot:
@@ -335,18 +466,40 @@ class TopologyInstance:
 
         self._in_snapshot = True
         self._start_snapshot = True
+        if self._state is not None:
+            self._diffing = self._state.start_snapshot(time.time())
 
     def stop_snapshot(self):
         if not self._in_snapshot:
             raise Exception("Cannot stop snapshot on instance %s which is not started" % self._instance_key)
 
         self._in_snapshot = False
+        if self._aborted:
+            return
         self._stop_snapshot = True
+        if self._state is not None:
+            self._delete_ids = self._state.stop_snapshot()
 
     def is_in_snapshot(self):
         return self._in_snapshot
 
     def get_topology(self):
+        if self._aborted:
+            return {
+                "instance": self._instance_key,
+                "components": [],
+                "relations": []
+            }
+
+        if self._diffing:
+            # Not a snapshot anymore, the components and relations not sent are unchanged
+            return {
+                "instance": self._instance_key,
+                "components": self._components,
+                "relations": self._relations,
+                "delete_ids": self._delete_ids
+            }
+
         result = {
             "instance" : self._instance_key,
             "components": self._components,
@@ -365,8 +518,12 @@ class TopologyInstance:
         self._relations = []
         self._start_snapshot = False
         self._stop_snapshot = False
+        self._delete_ids = []
         if clear_in_snapshot:
             self._in_snapshot = False
+        if not self._in_snapshot:
+            self._diffing = False
+            self._aborted = False
 
 class AgentCheck(object):
     OK, WARNING, CRITICAL, UNKNOWN = (0, 1, 2, 3)
@@ -419,12 +576,26 @@ class AgentCheck(object):
             formatter=agent_formatter,
             recent_point_threshold=agentConfig.get('recent_point_threshold', None),
             histogram_aggregates=agentConfig.get('histogram_aggregates'),
-            histogram_percentiles=agentConfig.get('histogram_percentiles')
+            histogram_percentiles=agentConfig.get('histogram_percentiles'),
+            histogram_backend=agentConfig.get('histogram_backend'),
+            histogram_relative_accuracy=agentConfig.get('histogram_relative_accuracy'),
+            compact_storage=agentConfig.get('compact_metric_storage', False)
         )
 
         self.events = []
         self.service_checks = []
         self.topology_instances = {}
+        # Send the topology snapshots as the changes since the last one, see TopologyState
+        self.incremental_topology = _is_affirmative(self.init_config.get('incremental_topology', False))
+        self.topology_resync_interval = float(self.init_config.get('topology_resync_interval',
+                                                                   DEFAULT_TOPOLOGY_RESYNC_INTERVAL))
+        self._topology_states = {}
+        # Components and relations are emitted by batches of this size while the check runs
+        self.topology_batch_size = int(agentConfig.get('topology_batch_size') or 0)
+        # Emits batches of topology, returns whether they were sent. Set by the collector
+        self.topology_emitter = None
+        # Batches flushed with no emitter to send them
+        self._topology_batches = []
         self.instances = instances or []
         self.warnings = []
         self.check_version = None
@@ -704,7 +875,26 @@ class AgentCheck(object):
 
     def _assure_instance(self, instance_key):
         key = tuple(sorted(instance_key.items()))
-        return self.topology_instances.setdefault(key, TopologyInstance(instance_key))
+        topology_instance = self.topology_instances.get(key)
+        if topology_instance is None:
+            state = None
+            if self.incremental_topology:
+                state = self._topology_states.get(key)
+                if state is None:
+                    state = self._topology_states[key] = TopologyState(self.topology_resync_interval)
+            topology_instance = self.topology_instances[key] = TopologyInstance(
+                instance_key, state, batch_size=self.topology_batch_size, flush=self._flush_topology)
+        return topology_instance
+
+    def _flush_topology(self, topology):
+        if self.topology_emitter is None:
+            self._topology_batches.append(topology)
+            return True
+        if not self.topology_emitter([topology]):
+            self.log.warning("Unable to emit a topology batch of %s, aborting its snapshot",
+                             topology['instance'])
+            return False
+        return True
 
     def _add_component(self, instance_key, data):
         topology_instance = self._assure_instance(instance_key)
@@ -856,7 +1046,9 @@ class AgentCheck(object):
         Return a list of created topology instances, clears the data
         :return: object with topology changes
         """
-        result = [instance.get_topology() for instance in self.topology_instances.values()]
+        result = self._topology_batches
+        self._topology_batches = []
+        result.extend(instance.get_topology() for instance in self.topology_instances.values())
 
         for instance in self.topology_instances.values():
             instance.clear_topology_and_snapshot(clear_in_snapshot=False)
@@ -966,8 +1158,11 @@ class AgentCheck(object):
         self._internal_profiling_stats = None
         return stats
 
-    def run(self):
-        """ Run all instances. """
+    def run(self, instance_ids=None):
+        """
+        Run all instances, or the ones at `instance_ids` when they are
+        scheduled by the collector rather than by `min_collection_interval`.
+        """
 
         # Store run statistics if needed
         before, after = None, None
@@ -979,11 +1174,13 @@ class AgentCheck(object):
 
         instance_statuses = []
         for i, instance in enumerate(self.instances):
+            if instance_ids is not None and i not in instance_ids:
+                continue
             try:
                 min_collection_interval = instance.get('min_collection_interval', self.min_collection_interval)
 
                 now = time.time()
-                if now - self.last_collection_time[i] < min_collection_interval:
+                if instance_ids is None and now - self.last_collection_time[i] < min_collection_interval:
                     self.log.debug("Not running instance #{0} of check {1} as it ran less than {2}s ago".format(i, self.name, min_collection_interval))
                     continue
 
@@ -1038,6 +1235,9 @@ class AgentCheck(object):
 
     def commit_failure(self):
         """ Report commit failure """
+        # The topology changes were lost, send the next snapshots in full
+        for state in self._topology_states.itervalues():
+            state.reset()
         for instance in self.instances:
             self.commit_failed(copy.deepcopy(instance))
 
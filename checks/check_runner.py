@@ -0,0 +1,184 @@
+# stdlib
+import logging
+import threading
+import time
+
+# project
+from checks.libs.thread_pool import Pool
+
+log = logging.getLogger(__name__)
+
+# Seconds a check can run, when checks run in parallel
+DEFAULT_CHECK_TIMEOUT = 60
+
+
+class CheckRun(object):
+    """
+    One run of a checks.d check: the data it collected, and the time it
+    spent queued and running.
+    """
+    def __init__(self, check, instance_ids=None):
+        self.check = check
+        # Instances to run, all of them when None
+        self.instance_ids = instance_ids
+        self.submit_time = time.time()
+        self.start_time = None
+        self.end_time = None
+        # Set when the run timed out before a worker picked it up
+        self.cancelled = False
+        self.instance_statuses = []
+        self.metrics = []
+        self.events = []
+        self.topology_instances = []
+        self.service_metadata = []
+        self.check_stats = None
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    @property
+    def queue_time(self):
+        start_time = self.start_time
+        if start_time is None:
+            return time.time() - self.submit_time
+        return start_time - self.submit_time
+
+    @property
+    def run_time(self):
+        start_time = self.start_time
+        if start_time is None:
+            return 0
+        return (self.end_time or time.time()) - start_time
+
+    def wait(self, timeout):
+        return self._done.wait(timeout)
+
+    def cancel(self):
+        """
+        Cancel the run if it didn't start yet, return whether it was cancelled.
+        """
+        with self._lock:
+            if self.start_time is None:
+                self.cancelled = True
+            return self.cancelled
+
+    def process(self):
+        with self._lock:
+            if self.cancelled:
+                return
+            self.start_time = time.time()
+
+        check = self.check
+        try:
+            if self.instance_ids is None:
+                self.instance_statuses = check.run()
+            else:
+                self.instance_statuses = check.run(self.instance_ids)
+            self.metrics = check.get_metrics()
+            self.events = check.get_events()
+            self.topology_instances = check.get_topology_instances()
+            self.check_stats = check._get_internal_profiling_stats()
+            self.service_metadata = check.get_service_metadata()
+        except Exception:
+            log.exception("Error running check %s" % check.name)
+        finally:
+            self.end_time = time.time()
+            self._done.set()
+
+
+class CheckRunner(object):
+    """
+    Runs the checks.d checks of a collection run, one after the other or on a
+    bounded pool of threads, and yields their runs in the order of the checks.
+
+    On the pool, each check has `timeout` seconds to run. Threads can't be
+    interrupted, so a check which times out keeps running in its worker: it
+    isn't scheduled again until it completes, and the data it collected is
+    then yielded with the next collection run. A check still queued after
+    `timeout` seconds, because the workers are busy with such checks, is
+    cancelled.
+    """
+    def __init__(self, concurrency=1, timeout=DEFAULT_CHECK_TIMEOUT):
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self._pool = None
+        # Runs which timed out and are still in progress, by check
+        self._pending = {}
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = Pool(self.concurrency, name="Checks", daemon=True)
+        return self._pool
+
+    def is_running(self, check):
+        run = self._pending.get(check)
+        return run is not None and not run.done
+
+    def run(self, checks, instance_ids=None, scheduled_checks=None):
+        """
+        Run `checks`, only the instances listed for them in `instance_ids`
+        when it's set. `scheduled_checks` are all the checks still scheduled,
+        `checks` when not set: the timed out runs of the other ones are
+        forgotten.
+        """
+        instance_ids = instance_ids or {}
+        if self.concurrency == 1:
+            for check in checks:
+                run = CheckRun(check, instance_ids.get(check))
+                run.process()
+                yield run
+            return
+
+        # Forget the checks unscheduled since, e.g. by a configuration reload
+        if scheduled_checks is None:
+            scheduled_checks = checks
+        self._pending = dict((check, self._pending[check]) for check in scheduled_checks
+                             if check in self._pending)
+        runs = []
+        for check in checks:
+            run = self._pending.get(check)
+            if run is None:
+                run = CheckRun(check, instance_ids.get(check))
+                self._get_pool().apply_async(run.process)
+            runs.append(run)
+
+        for run in runs:
+            if run.check in self._pending:
+                # Timed out during a previous collection run
+                if run.done:
+                    del self._pending[run.check]
+            elif not self._wait(run):
+                if run.cancelled:
+                    log.warning("Check %s timed out after %.2f s in the queue, cancelling it",
+                                run.check.name, run.queue_time)
+                else:
+                    log.warning("Check %s timed out after running %.2f s, skipping it until it completes",
+                                run.check.name, run.run_time)
+                    self._pending[run.check] = run
+            yield run
+
+    def _wait(self, run):
+        """
+        Wait for `run` to complete, return False if it timed out.
+        """
+        queue_deadline = time.time() + self.timeout
+        while True:
+            if run.start_time is None and time.time() >= queue_deadline and run.cancel():
+                return False
+            if run.start_time is None:
+                deadline = queue_deadline
+            else:
+                deadline = run.start_time + self.timeout
+
+            if run.wait(max(0, deadline - time.time())):
+                return True
+            if run.start_time is not None and time.time() >= run.start_time + self.timeout:
+                return False
+
+    def stop(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
@@ -0,0 +1,112 @@
+# stdlib
+from collections import defaultdict
+import heapq
+import itertools
+import logging
+import random
+
+log = logging.getLogger(__name__)
+
+# Share of its interval the first run of an instance is randomly delayed by,
+# to spread the instances of the checks over time
+DEFAULT_JITTER_RATIO = 0.1
+# Shortest interval an instance runs at, in seconds
+MIN_INTERVAL = 1
+
+
+class CheckScheduler(object):
+    """
+    Schedules each instance of the checks.d checks on its own interval: its
+    `min_collection_interval`, or `default_interval` when it doesn't set one.
+
+    The first run of an instance is delayed by a random jitter, up to its
+    `collection_jitter` seconds (instance or init_config option) or to
+    `DEFAULT_JITTER_RATIO` of its interval. The following runs are at a fixed
+    interval from it, and a run which is late doesn't make up for the runs it
+    missed.
+
+    Next runs are kept in a heap, outdated entries are skipped when popped.
+    """
+    def __init__(self, default_interval):
+        self.default_interval = default_interval
+        # [next run time, sequence number, (check, instance index)]
+        self._heap = []
+        # (check, instance index) -> its current entry of the heap
+        self._entries = {}
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_interval(self, check, instance):
+        interval = instance.get('min_collection_interval', check.min_collection_interval)
+        if not interval or interval <= 0:
+            interval = self.default_interval
+        return max(MIN_INTERVAL, float(interval))
+
+    def get_jitter(self, check, instance):
+        jitter = instance.get('collection_jitter', check.init_config.get('collection_jitter'))
+        if jitter is None:
+            jitter = self.get_interval(check, instance) * DEFAULT_JITTER_RATIO
+        return random.uniform(0, float(jitter))
+
+    def _push(self, key, next_run):
+        entry = [next_run, next(self._sequence), key]
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+
+    def update(self, checks, now):
+        """
+        Schedule the instances of new checks, and forget the ones of the
+        checks which aren't in `checks` anymore.
+        """
+        keys = set()
+        for check in checks:
+            for i, instance in enumerate(check.instances):
+                key = (check, i)
+                keys.add(key)
+                if key not in self._entries:
+                    self._push(key, now + self.get_jitter(check, instance))
+
+        for key in self._entries.keys():
+            if key not in keys:
+                del self._entries[key]
+
+        if len(self._heap) > 2 * len(self._entries) + 1:
+            self._heap = self._entries.values()
+            heapq.heapify(self._heap)
+
+    def pop_due(self, now):
+        """
+        Return the indexes of the instances to run by check, and schedule
+        their next runs.
+        """
+        due = defaultdict(list)
+        while self._heap and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            key = entry[2]
+            if self._entries.get(key) is not entry:
+                continue
+
+            check, i = key
+            due[check].append(i)
+            interval = self.get_interval(check, check.instances[i])
+            next_run = entry[0] + interval
+            if next_run <= now:
+                log.debug("Instance #%s of check %s is late, skipping the runs it missed", i, check.name)
+                next_run = now + interval
+            self._push(key, next_run)
+
+        for instance_ids in due.itervalues():
+            instance_ids.sort()
+        return due
+
+    def next_run_time(self):
+        """
+        Time of the next instance to run, None if there is none.
+        """
+        while self._heap and self._entries.get(self._heap[0][2]) is not self._heap[0]:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return None
+        return self._heap[0][0]
@@ -331,7 +331,8 @@ class CheckStatus(object):
                  service_metadata=[],
                  init_failed_error=None, init_failed_traceback=None,
                  library_versions=None, source_type_name=None,
-                 check_stats=None, check_version=AGENT_VERSION):
+                 check_stats=None, check_version=AGENT_VERSION,
+                 context_cache_stats=None, queue_time=None, run_time=None):
         self.name = check_name
         self.source_type_name = source_type_name
         self.instance_statuses = instance_statuses
@@ -343,8 +344,12 @@ class CheckStatus(object):
         self.init_failed_traceback = init_failed_traceback
         self.library_versions = library_versions
         self.check_stats = check_stats
+        self.context_cache_stats = context_cache_stats
         self.service_metadata = service_metadata
         self.check_version = check_version
+        # Seconds the last run waited for a worker, and ran
+        self.queue_time = queue_time
+        self.run_time = run_time
 
     @property
     def status(self):
@@ -456,6 +461,17 @@ class CollectorStatus(AgentStatus):
                     "    - Stats: %s" % pretty_statistics(cs.check_stats)
                 ]
 
+            if cs.run_time is not None:
+                check_lines += [
+                    "    - Last run: %.2f s, queued %.2f s" % (cs.run_time, cs.queue_time)
+                ]
+
+            if cs.context_cache_stats is not None:
+                check_lines += [
+                    "    - Context cache: %s hits, %s misses" % (
+                        cs.context_cache_stats['hits'], cs.context_cache_stats['misses'])
+                ]
+
             if cs.library_versions is not None:
                 check_lines += [
                     "    - Dependencies:"]
@@ -601,6 +617,17 @@ class CollectorStatus(AgentStatus):
                             "    - Stats: %s" % pretty_statistics(cs.check_stats)
                         ]
 
+                    if cs.run_time is not None:
+                        check_lines += [
+                            "    - Last run: %.2f s, queued %.2f s" % (cs.run_time, cs.queue_time)
+                        ]
+
+                    if cs.context_cache_stats is not None:
+                        check_lines += [
+                            "    - Context cache: %s hits, %s misses" % (
+                                cs.context_cache_stats['hits'], cs.context_cache_stats['misses'])
+                        ]
+
                     if cs.library_versions is not None:
                         check_lines += [
                             "    - Dependencies:"]
@@ -711,6 +738,8 @@ class CollectorStatus(AgentStatus):
                 status_info['checks'][cs.name]['metric_count'] = cs.metric_count
                 status_info['checks'][cs.name]['event_count'] = cs.event_count
                 status_info['checks'][cs.name]['service_check_count'] = cs.service_check_count
+                status_info['checks'][cs.name]['run_time'] = cs.run_time
+                status_info['checks'][cs.name]['queue_time'] = cs.queue_time
 
         # Emitter status
         status_info['emitter'] = []
@@ -756,7 +785,8 @@ class DogstatsdStatus(AgentStatus):
     NAME = 'StsStatsD'
 
     def __init__(self, flush_count=0, packet_count=0, packets_per_second=0,
-                 metric_count=0, event_count=0, service_check_count=0):
+                 metric_count=0, event_count=0, service_check_count=0,
+                 datagrams_per_wakeup=0, socket_drops=None, context_cache_stats=None):
         AgentStatus.__init__(self)
         self.flush_count = flush_count
         self.packet_count = packet_count
@@ -764,6 +794,9 @@ class DogstatsdStatus(AgentStatus):
         self.metric_count = metric_count
         self.event_count = event_count
         self.service_check_count = service_check_count
+        self.datagrams_per_wakeup = datagrams_per_wakeup
+        self.socket_drops = socket_drops
+        self.context_cache_stats = context_cache_stats or {}
 
     def has_error(self):
         return self.flush_count == 0 and self.packet_count == 0 and self.metric_count == 0
@@ -776,6 +809,10 @@ class DogstatsdStatus(AgentStatus):
             "Metric count: %s" % self.metric_count,
             "Event count: %s" % self.event_count,
             "Service check count: %s" % self.service_check_count,
+            "Datagrams per wakeup: %s" % self.datagrams_per_wakeup,
+            "Socket drops: %s" % ('N/A' if self.socket_drops is None else self.socket_drops),
+            "Context cache: %s hits, %s misses" % (
+                self.context_cache_stats.get('hits', 0), self.context_cache_stats.get('misses', 0)),
         ]
         return lines
 
@@ -788,6 +825,9 @@ class DogstatsdStatus(AgentStatus):
             'metric_count': self.metric_count,
             'event_count': self.event_count,
             'service_check_count': self.service_check_count,
+            'datagrams_per_wakeup': self.datagrams_per_wakeup,
+            'socket_drops': self.socket_drops,
+            'context_cache_stats': self.context_cache_stats,
         })
         return status_info
 
@@ -808,7 +848,7 @@ class ForwarderStatus(AgentStatus):
     NAME = 'Forwarder'
 
     def __init__(self, queue_length=0, queue_size=0, flush_count=0, transactions_received=0,
-                 transactions_flushed=0, transactions_rejected=0):
+                 transactions_flushed=0, transactions_rejected=0, spilled_count=None, spilled_size=None):
         AgentStatus.__init__(self)
         self.queue_length = queue_length
         self.queue_size = queue_size
@@ -818,11 +858,20 @@ class ForwarderStatus(AgentStatus):
         self.hidden_username = None
         self.hidden_password = None
         self.transactions_rejected = transactions_rejected
+        # Transactions spilled to disk, None when spilling is disabled
+        self.spilled_count = spilled_count
+        self.spilled_size = spilled_size
 
     def body_lines(self):
         lines = [
             "Queue Size: %s bytes" % self.queue_size,
             "Queue Length: %s" % self.queue_length,
+        ]
+        if self.spilled_count is not None:
+            lines += [
+                "Spilled to disk: %s transactions, %s bytes" % (self.spilled_count, self.spilled_size),
+            ]
+        lines += [
             "Flush Count: %s" % self.flush_count,
             "Transactions received: %s" % self.transactions_received,
             "Transactions flushed: %s" % self.transactions_flushed,
@@ -844,7 +893,9 @@ class ForwarderStatus(AgentStatus):
             'queue_size': self.queue_size,
             'transactions_rejected': self.transactions_rejected,
             'transactions_received': self.transactions_received,
-            'transactions_flushed': self.transactions_flushed
+            'transactions_flushed': self.transactions_flushed,
+            'spilled_count': self.spilled_count,
+            'spilled_size': self.spilled_size,
         })
         return status_info
 
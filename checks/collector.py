@@ -18,16 +18,19 @@ import simplejson as json
 
 # project
 from checks import AGENT_METRICS_CHECK_NAME, AgentCheck, create_service_check
+from checks.check_runner import CheckRunner, DEFAULT_CHECK_TIMEOUT
+from checks.check_scheduler import CheckScheduler
 from checks.check_status import (
     CheckStatus,
     CollectorStatus,
     EmitterStatus,
+    InstanceStatus,
     STATUS_ERROR,
     STATUS_OK,
 )
 from checks.datadog import Dogstreams
 from checks.ganglia import Ganglia
-from config import get_system_stats, get_version
+from config import _is_affirmative, DEFAULT_CHECK_FREQUENCY, get_system_stats, get_version
 import checks.system.unix as u
 import checks.system.win32 as w32
 import modules
@@ -190,6 +193,19 @@ class Collector(object):
         self.hostname_metadata_cache = None
         self.initialized_checks_d = []
         self.init_failed_checks_d = {}
+        self.check_frequency = int(agentConfig.get('check_freq', DEFAULT_CHECK_FREQUENCY))
+        # Instances of the checks.d checks run on their own intervals when enabled,
+        # all of them every `check_freq` seconds otherwise
+        self._check_scheduler = None
+        self._next_system_run = None
+        self._check_statuses = {}
+        if _is_affirmative(agentConfig.get('check_scheduler', False)):
+            self._check_scheduler = CheckScheduler(self.check_frequency)
+        # checks.d checks run one after the other, unless a concurrency is set
+        self._check_runner = CheckRunner(
+            concurrency=int(agentConfig.get('check_concurrency', 1)),
+            timeout=float(agentConfig.get('check_timeout', DEFAULT_CHECK_TIMEOUT))
+        )
 
         if Platform.is_linux() and psutil is not None:
             procfs_path = agentConfig.get('procfs_path', '/proc').rstrip('/')
@@ -246,47 +262,67 @@ class Collector(object):
         # in which case we'll get a misleading error in the logs.
         # Best to not even try.
         self.continue_running = False
+        self._check_runner.stop()
         for check in self.initialized_checks_d:
             check.stop()
 
-    @staticmethod
-    def _stats_for_display(raw_stats):
-        return pprint.pformat(raw_stats, indent=4)
-
-    @log_exceptions(log)
-    def run(self, checksd=None, start_event=True, configs_reloaded=False):
+    def get_next_run_delay(self):
         """
-        Collect data from each check and submit their data.
+        Seconds until the next collection run: until an instance of a check
+        or the system checks are due when checks are scheduled on their own.
         """
-        log.debug("Found {num_checks} checks".format(num_checks=len(checksd['initialized_checks'])))
-        timer = Timer()
-        if not Platform.is_windows():
-            cpu_clock = time.clock()
-        self.run_count += 1
-        log.debug("Starting collection run #%s" % self.run_count)
-
-        if checksd:
-            self.initialized_checks_d = checksd['initialized_checks']  # is a list of AgentCheck instances
-            self.init_failed_checks_d = checksd['init_failed_checks']  # is of type {check_name: {error, traceback}}
-
+        if self._check_scheduler is None:
+            return self.check_frequency
+        if self._next_system_run is None:
+            return 0
+        next_run = self._next_system_run
+        next_check_run = self._check_scheduler.next_run_time()
+        if next_check_run is not None:
+            next_run = min(next_run, next_check_run)
+        return max(0, next_run - time.time())
+
+    def _system_checks_due(self, now):
+        if self._next_system_run is not None and now < self._next_system_run:
+            return False
+        next_run = (self._next_system_run or now) + self.check_frequency
+        if next_run <= now:
+            next_run = now + self.check_frequency
+        self._next_system_run = next_run
+        return True
+
+    def _latest_check_statuses(self, check_statuses):
+        """
+        Statuses of the checks which ran, and the last ones of the checks
+        which weren't due.
+        """
+        for check_status in check_statuses:
+            self._check_statuses[check_status.name] = check_status
+        names = [check.name for check in self.initialized_checks_d] + self.init_failed_checks_d.keys()
+        self._check_statuses = dict((name, self._check_statuses[name]) for name in names
+                                    if name in self._check_statuses)
+        return [self._check_statuses[name] for name in names if name in self._check_statuses]
+
+    def _emit_topology(self, topologies):
+        """
+        Emit batches of topology of a check still running, return whether
+        they were sent.
+        """
+        if not self.continue_running:
+            return False
         payload = AgentPayload()
-
-        # Find the AgentMetrics check and pop it out
-        # This check must run at the end of the loop to collect info on agent performance
-        if not self._agent_metrics or configs_reloaded:
-            for check in self.initialized_checks_d:
-                if check.name == AGENT_METRICS_CHECK_NAME:
-                    self._agent_metrics = check
-                    self.initialized_checks_d.remove(check)
-                    break
-
-        # Initialize payload
         self._build_payload(payload)
+        payload['topologies'] = topologies
+        payload['topologyOnly'] = True
+        emitter_statuses = payload.emit(log, self.agentConfig, self.emitters, self.continue_running)
+        return all(emitter_status.error is None for emitter_status in emitter_statuses)
 
+    def _run_system_checks(self, payload):
+        """
+        Run the system checks and the old-style checks, whose data isn't
+        collected by checks.d checks.
+        """
         metrics = payload['metrics']
         events = payload['events']
-        service_checks = payload['service_checks']
-        topologies = payload['topologies']
 
         # Run the system checks. Checks will depend on the OS
         if Platform.is_windows():
@@ -390,62 +426,129 @@ class Collector(object):
             if res:
                 metrics.extend(res)
 
+    @staticmethod
+    def _timed_out_check_status(check_run, error):
+        check = check_run.check
+        instance_statuses = [
+            InstanceStatus(i, STATUS_ERROR, error=error) for i in xrange(len(check.instances))
+        ] or [InstanceStatus(0, STATUS_ERROR, error=error)]
+        return CheckStatus(
+            check.name, instance_statuses, service_metadata=[{}] * len(instance_statuses),
+            library_versions=check.get_library_info(),
+            source_type_name=check.SOURCE_TYPE_NAME or check.name,
+            check_version=check.check_version,
+            queue_time=check_run.queue_time, run_time=check_run.run_time
+        )
+
+    @staticmethod
+    def _stats_for_display(raw_stats):
+        return pprint.pformat(raw_stats, indent=4)
+
+    @log_exceptions(log)
+    def run(self, checksd=None, start_event=True, configs_reloaded=False):
+        """
+        Collect data from each check and submit their data.
+        """
+        log.debug("Found {num_checks} checks".format(num_checks=len(checksd['initialized_checks'])))
+        timer = Timer()
+        if not Platform.is_windows():
+            cpu_clock = time.clock()
+
+        if checksd:
+            self.initialized_checks_d = checksd['initialized_checks']  # is a list of AgentCheck instances
+            self.init_failed_checks_d = checksd['init_failed_checks']  # is of type {check_name: {error, traceback}}
+
+        # Find the AgentMetrics check and pop it out
+        # This check must run at the end of the loop to collect info on agent performance
+        if not self._agent_metrics or configs_reloaded:
+            for check in self.initialized_checks_d:
+                if check.name == AGENT_METRICS_CHECK_NAME:
+                    self._agent_metrics = check
+                    self.initialized_checks_d.remove(check)
+                    break
+
+        # Run all the checks, or only the instances due when they are scheduled on their own.
+        # The system checks then run every `check_freq` seconds.
+        checks_to_run = self.initialized_checks_d
+        instance_ids = None
+        run_system_checks = True
+        if self._check_scheduler is not None:
+            now = time.time()
+            self._check_scheduler.update(self.initialized_checks_d, now)
+            instance_ids = self._check_scheduler.pop_due(now)
+            checks_to_run = [check for check in self.initialized_checks_d if check in instance_ids]
+            run_system_checks = self._system_checks_due(now)
+            if not checks_to_run and not run_system_checks:
+                return None, False
+
+        self.run_count += 1
+        log.debug("Starting collection run #%s" % self.run_count)
+
+        payload = AgentPayload()
+
+        # Initialize payload
+        self._build_payload(payload)
+
+        metrics = payload['metrics']
+        events = payload['events']
+        service_checks = payload['service_checks']
+        topologies = payload['topologies']
+
+        if run_system_checks:
+            self._run_system_checks(payload)
+
         # Use `info` log level for some messages on the first run only, then `debug`
         log_at_first_run = log.info if self._is_first_run() else log.debug
 
         # checks.d checks
         check_statuses = []
-        for check in self.initialized_checks_d:
-            if not self.continue_running:
-                return
+        # Checks whose data is in this payload, to commit after its emission
+        collected_checks = []
+        for check in checks_to_run:
             log_at_first_run("Running check %s", check.name)
-            instance_statuses = []
-            metric_count = 0
-            event_count = 0
-            service_check_count = 0
-            check_start_time = time.time()
-            check_stats = None
+            check.topology_emitter = self._emit_topology
 
-            try:
-                # Run the check.
-                instance_statuses = check.run()
-
-                # Collect the metrics and events.
-                current_check_metrics = check.get_metrics()
-                current_check_events = check.get_events()
-                current_check_topology_instances = check.get_topology_instances()
-                check_stats = check._get_internal_profiling_stats()
-
-                topologies += current_check_topology_instances
-
-                # Collect metadata
-                current_check_metadata = check.get_service_metadata()
+        for check_run in self._check_runner.run(checks_to_run, instance_ids, self.initialized_checks_d):
+            if not self.continue_running:
+                return
+            check = check_run.check
+            service_check_tags = ["check:%s" % check.name]
 
-                # Save metrics & events for the payload.
-                metrics.extend(current_check_metrics)
-                if current_check_events:
-                    if check.name not in events:
-                        events[check.name] = current_check_events
-                    else:
-                        events[check.name] += current_check_events
+            if not check_run.done:
+                if check_run.cancelled:
+                    error = "Check timed out after %.2f s in the queue" % check_run.queue_time
+                else:
+                    error = "Check timed out, still running after %.2f s" % check_run.run_time
+                check_statuses.append(self._timed_out_check_status(check_run, error))
+                service_checks.append(create_service_check(
+                    'stackstate.agent.check_status', AgentCheck.CRITICAL,
+                    tags=service_check_tags, hostname=self.hostname, message=error))
+                continue
 
-                # Save the status of the check.
-                metric_count = len(current_check_metrics)
-                event_count = len(current_check_events)
+            collected_checks.append(check)
+            current_check_metrics = check_run.metrics
+            current_check_events = check_run.events
+            topologies += check_run.topology_instances
 
-            except Exception:
-                log.exception("Error running check %s" % check.name)
+            # Save metrics & events for the payload.
+            metrics.extend(current_check_metrics)
+            if current_check_events:
+                if check.name not in events:
+                    events[check.name] = current_check_events
+                else:
+                    events[check.name] += current_check_events
 
             check_status = CheckStatus(
-                check.name, instance_statuses, metric_count,
-                event_count, service_check_count, service_metadata=current_check_metadata,
+                check.name, check_run.instance_statuses, len(current_check_metrics),
+                len(current_check_events), 0, service_metadata=check_run.service_metadata,
                 library_versions=check.get_library_info(),
                 source_type_name=check.SOURCE_TYPE_NAME or check.name,
-                check_stats=check_stats, check_version=check.check_version
+                check_stats=check_run.check_stats, check_version=check.check_version,
+                context_cache_stats=check.aggregator.context_cache_stats(),
+                queue_time=check_run.queue_time, run_time=check_run.run_time
             )
 
             # Service check for Agent checks failures
-            service_check_tags = ["check:%s" % check.name]
             if check_status.status == STATUS_OK:
                 status = AgentCheck.OK
             elif check_status.status == STATUS_ERROR:
@@ -463,14 +566,15 @@ class Collector(object):
             check_status.service_check_count = service_check_count
             check_statuses.append(check_status)
 
-            check_run_time = time.time() - check_start_time
-            log.debug("Check %s ran in %.2f s" % (check.name, check_run_time))
+            log.debug("Check %s ran in %.2f s, after %.2f s in the queue" %
+                      (check.name, check_run.run_time, check_run.queue_time))
 
             # Intrument check run timings if enabled.
             if self.check_timings:
-                metric = 'stackstate.agent.check_run_time'
-                meta = {'tags': ["check:%s" % check.name]}
-                metrics.append((metric, time.time(), check_run_time, meta))
+                meta = {'tags': service_check_tags}
+                metrics.append(('stackstate.agent.check_run_time', time.time(), check_run.run_time, meta))
+                if self._check_runner.concurrency > 1:
+                    metrics.append(('stackstate.agent.check_queue_time', time.time(), check_run.queue_time, meta))
 
         for check_name, info in self.init_failed_checks_d.iteritems():
             if not self.continue_running:
@@ -496,7 +600,7 @@ class Collector(object):
 
         collect_duration = timer.step()
 
-        if self._agent_metrics:
+        if self._agent_metrics and run_system_checks:
             metric_context = {
                 'collection_time': collect_duration,
                 'emit_time': self.emit_duration,
@@ -524,7 +628,7 @@ class Collector(object):
         emit_success = all(emitter_status.error is None for emitter_status in emitter_statuses)
         continue_immediately = False
         try:
-            for check in self.initialized_checks_d:
+            for check in collected_checks:
                 if emit_success:
                     continue_immediately = continue_immediately or check.commit_success()
                 else:
@@ -533,6 +637,8 @@ class Collector(object):
             log.exception("Error committing check work")
 
         # Persist the status of the collection run.
+        if self._check_scheduler is not None:
+            check_statuses = self._latest_check_statuses(check_statuses)
         try:
             CollectorStatus(check_statuses, emitter_statuses,
                             self.hostname_metadata_cache).persist()
@@ -594,7 +700,8 @@ class Collector(object):
             event_count, service_check_count, topology_count,
             library_versions=check.get_library_info(),
             source_type_name=check.SOURCE_TYPE_NAME or check.name,
-            check_stats=check_stats
+            check_stats=check_stats,
+            context_cache_stats=check.aggregator.context_cache_stats()
         )
 
         return check_status
@@ -305,6 +305,34 @@ def get_histogram_percentiles(configstr=None):
     return result
 
 
+def get_histogram_backend(configstr=None):
+    if configstr is None:
+        return None
+
+    backend = configstr.strip().lower()
+    if backend not in ('exact', 'sketch'):
+        log.warning("Ignored histogram backend {0}, must be `exact` or `sketch`".format(configstr))
+        return None
+
+    return backend
+
+
+def get_histogram_relative_accuracy(configstr=None):
+    if configstr is None:
+        return None
+
+    try:
+        accuracy = float(configstr)
+        if accuracy <= 0 or accuracy >= 1:
+            raise ValueError
+    except ValueError:
+        log.warning("Bad histogram relative accuracy {0}, must be float in ]0;1[, skipping"
+                    .format(configstr))
+        return None
+
+    return accuracy
+
+
 def clean_dd_url(url):
     url = url.strip()
     if not url.startswith('http'):
@@ -468,6 +496,16 @@ def get_config(parse_args=True, cfg_path=None, options=None, can_query_registry=
         if config.has_option('Main', 'histogram_percentiles'):
             agentConfig['histogram_percentiles'] = get_histogram_percentiles(config.get('Main', 'histogram_percentiles'))
 
+        if config.has_option('Main', 'histogram_backend'):
+            agentConfig['histogram_backend'] = get_histogram_backend(config.get('Main', 'histogram_backend'))
+
+        if config.has_option('Main', 'compact_metric_storage'):
+            agentConfig['compact_metric_storage'] = _is_affirmative(config.get('Main', 'compact_metric_storage'))
+
+        if config.has_option('Main', 'histogram_relative_accuracy'):
+            agentConfig['histogram_relative_accuracy'] = get_histogram_relative_accuracy(
+                config.get('Main', 'histogram_relative_accuracy'))
+
         # Disable Watchdog (optionally)
         if config.has_option('Main', 'watchdog'):
             if config.get('Main', 'watchdog').lower() in ('no', 'false'):
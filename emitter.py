@@ -9,10 +9,10 @@ import unicodedata
 
 # 3p
 import requests
-import simplejson as json
 
 # project
 from config import get_version
+from utils import json_codec
 
 from utils.proxy import set_no_proxy_settings
 set_no_proxy_settings()
@@ -29,9 +29,17 @@ control_char_re = re.compile('[%s]' % re.escape(control_chars))
 
 # Only enforced for the metrics API on our end, for now
 MAX_COMPRESSED_SIZE = 2 << 20  # 2MB, the backend should accept up to 3MB but let's be conservative here
-# maximum depth of recursive calls to payload splitting function, a bit arbitrary (we don't want too much
-# depth in the recursive calls, but we want to give up only when some metrics are clearly too large)
-MAX_SPLIT_DEPTH = 2
+# Upper bound of what closing a compressed chunk adds to it: end of the JSON
+# document, last deflate block and checksum
+CHUNK_END_SIZE = 64
+# Bytes buffered before calling the compressor
+COMPRESS_BLOCK_SIZE = 64 << 10
+SERIES_HEADER = '{"series": ['
+SERIES_SEPARATOR = ', '
+SERIES_FOOTER = ']}'
+# Series are serialized in groups of up to 1/16th of the compressed size of a chunk
+SERIES_GROUP_RATIO = 16
+MAX_SERIES_GROUP_COUNT = 1000
 
 
 def remove_control_chars(s, log):
@@ -88,14 +96,14 @@ def post_payload(url, message, serialize_func, agentConfig, log):
     except UnicodeDecodeError:
         log.exception('http_emitter: Unable to convert message to json')
         # early return as we can't actually process the message
-        return
+        return False
     except RuntimeError:
         log.exception('http_emitter: runtime error dumping message to json')
         # early return as we can't actually process the message
-        return
+        return False
     except Exception:
         log.exception('http_emitter: unknown exception processing message')
-        return
+        return False
 
     for payload in payloads:
         try:
@@ -115,19 +123,21 @@ def post_payload(url, message, serialize_func, agentConfig, log):
                 pass
             raise Exception("Posting payload failed")
 
+    return True
+
 
 def serialize_payload(message, log):
     payload = ""
     try:
-        payload = json.dumps(message)
+        payload = json_codec.dumps(message)
     except UnicodeDecodeError:
         newmessage = sanitize_payload(message, log, remove_control_chars)
         try:
-            payload = json.dumps(newmessage)
+            payload = json_codec.dumps(newmessage)
         except UnicodeDecodeError:
             log.info('Removing undecodable characters from payload')
             newmessage = sanitize_payload(newmessage, log, remove_undecodable_chars)
-            payload = json.dumps(newmessage)
+            payload = json_codec.dumps(newmessage)
 
     return payload
 
@@ -151,47 +161,134 @@ def serialize_and_compress_legacy_payload(legacy_payload, max_compressed_size, d
     return compressed_payloads
 
 
+def max_deflate_size(size):
+    """
+    Compressed size of `size` bytes in the worst case, when they don't
+    compress at all (see deflateBound() in zlib), with the end of a chunk.
+    """
+    return size + (size >> 10) + CHUNK_END_SIZE
+
+
+class CompressedChunk(object):
+    """
+    Compressed JSON document being written, with an upper bound of its final
+    compressed size.
+    """
+    def __init__(self, header):
+        self._compressor = zlib.compressobj()
+        self._buffer = []
+        self._buffer_size = 0
+        self._parts = []
+        self.compressed_size = 0
+        # Written but not compressed yet, buffered here or by the compressor
+        self.pending_size = 0
+        self.size = 0
+        self.write(header)
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffer_size += len(data)
+        self.pending_size += len(data)
+        self.size += len(data)
+        if self._buffer_size >= COMPRESS_BLOCK_SIZE:
+            self._compress()
+
+    def _compress(self):
+        self._append(self._compressor.compress(''.join(self._buffer)))
+        self._buffer = []
+        self._buffer_size = 0
+
+    def _append(self, compressed):
+        if compressed:
+            self._parts.append(compressed)
+            self.compressed_size += len(compressed)
+
+    def max_size(self, extra_size=0):
+        """
+        Compressed size of the chunk if `extra_size` more bytes are written
+        and it is closed, at most.
+        """
+        return self.compressed_size + max_deflate_size(self.pending_size + extra_size)
+
+    def sync(self):
+        """ Compress the pending bytes, to know the compressed size exactly. """
+        self._compress()
+        self._append(self._compressor.flush(zlib.Z_SYNC_FLUSH))
+        self.pending_size = 0
+
+    def close(self, footer):
+        self.write(footer)
+        self._compress()
+        self._append(self._compressor.flush())
+        self.pending_size = 0
+        return ''.join(self._parts)
+
+
 def serialize_and_compress_metrics_payload(metrics_payload, max_compressed_size, depth, log):
     """
-    Serialize and compress the metrics payload
-    If the compressed payload is too big, we attempt to split it into smaller payloads and call this
-    function recursively on each smaller payload
+    Serialize and compress the metrics payload, in chunks smaller than
+    `max_compressed_size` once compressed
+    Small groups of series are serialized at once and streamed to the
+    compressor of the current chunk, which is closed as soon as the next group
+    could make it too big.
     """
     compressed_payloads = []
-
-    serialized_payload = serialize_payload(metrics_payload, log)
-    zipped = zlib.compress(serialized_payload)
-    compression_ratio = float(len(serialized_payload))/float(len(zipped))
-    log.debug("payload_size=%d, compressed_size=%d, compression_ratio=%.3f"
-              % (len(serialized_payload), len(zipped), compression_ratio))
-
-    if len(zipped) < max_compressed_size:
-        compressed_payloads.append(zipped)
-    else:
-        series = metrics_payload["series"]
-
-        if depth > MAX_SPLIT_DEPTH:
-            log.error("Maximum depth of payload splitting reached, dropping the %d metrics in this chunk", len(series))
-            return compressed_payloads
-
-        # Try to account for the compression when estimating the number of chunks needed to get small-enough chunks
-        n_chunks = len(zipped)/max_compressed_size + 1 + int(compression_ratio/2)
-        log.debug("payload is too big (%d bytes), splitting it in %d chunks", len(zipped), n_chunks)
-
-        series_per_chunk = len(series)/n_chunks + 1
-
-        for i in range(n_chunks):
-            # Create each chunk and make them go through this function recursively ; increment the `depth` of the recursive call
-            compressed_payloads.extend(
-                serialize_and_compress_metrics_payload(
-                    {
-                        "series": series[i*series_per_chunk:(i+1)*series_per_chunk]
-                    },
-                    max_compressed_size,
-                    depth+1,
-                    log
-                )
-            )
+    # Current chunk, in a list to be replaced by the nested functions
+    chunks = [None]
+
+    def close_chunk():
+        chunk = chunks[0]
+        zipped = chunk.close(SERIES_FOOTER)
+        log.debug("payload_size=%d, compressed_size=%d, compression_ratio=%.3f"
+                  % (chunk.size, len(zipped), float(chunk.size)/float(len(zipped))))
+        if len(zipped) < max_compressed_size:
+            compressed_payloads.append(zipped)
+        else:
+            # Only a chunk of a single serie can end up too big
+            log.error("Dropping a serie of %d bytes, too big once compressed (%d bytes)", chunk.size, len(zipped))
+        chunks[0] = None
+
+    def write_series(serialized_series):
+        chunk = chunks[0]
+        if chunk is not None:
+            extra_size = len(SERIES_SEPARATOR) + len(serialized_series) + len(SERIES_FOOTER)
+            if chunk.max_size(extra_size) >= max_compressed_size:
+                chunk.sync()
+                if chunk.max_size(extra_size) >= max_compressed_size:
+                    close_chunk()
+                    chunk = None
+
+        if chunk is None:
+            chunk = chunks[0] = CompressedChunk(SERIES_HEADER)
+        else:
+            chunk.write(SERIES_SEPARATOR)
+        chunk.write(serialized_series)
+
+    series = metrics_payload["series"]
+    group_size = max(1, max_compressed_size / SERIES_GROUP_RATIO)
+    group_count = 1
+    start = 0
+    while start < len(series):
+        group = series[start:start + group_count]
+        start += len(group)
+        # Serialized list of series, without its brackets
+        serialized_group = serialize_payload(group, log)[1:-1]
+        if len(group) > 1 and max_deflate_size(len(SERIES_HEADER) + len(serialized_group)) >= max_compressed_size:
+            # A serie is much bigger than the others, don't let it take them down with it
+            for serie in group:
+                write_series(serialize_payload(serie, log))
+        else:
+            write_series(serialized_group)
+        # Size the next group after the series seen so far
+        group_count = max(1, min(MAX_SERIES_GROUP_COUNT, group_size * len(group) / max(1, len(serialized_group))))
+
+    if chunks[0] is None:
+        # No series, the payload is still sent
+        chunks[0] = CompressedChunk(SERIES_HEADER)
+    close_chunk()
+
+    if len(compressed_payloads) > 1:
+        log.debug("payload split in %d chunks", len(compressed_payloads))
 
     return compressed_payloads
 
@@ -242,11 +339,11 @@ def split_payload(legacy_payload):
 
         metrics_payload["series"].append(sample)
 
-    del legacy_payload['metrics']
-
     checkruns_payload = legacy_payload["service_checks"]
 
-    del legacy_payload["service_checks"]
+    # The message is left as it is for the other emitters
+    legacy_payload = dict((key, value) for key, value in legacy_payload.iteritems()
+                          if key not in ('metrics', 'service_checks', 'topologyOnly'))
 
     return legacy_payload, metrics_payload, checkruns_payload
 
@@ -264,10 +361,19 @@ def http_emitter(message, log, agentConfig, endpoint):
     metrics_endpoint = "{0}/api/v1/series?api_key={1}".format(agentConfig['dd_url'], api_key)
     checkruns_endpoint = "{0}/api/v1/check_run?api_key={1}".format(agentConfig['dd_url'], api_key)
 
+    # The batches of topology emitted while a check runs carry no metrics nor check runs
+    topology_only = message.get('topologyOnly', False)
+
     legacy_payload, metrics_payload, checkruns_payload = split_payload(message)
 
     # Post legacy payload
-    post_payload(legacy_url, legacy_payload, serialize_and_compress_legacy_payload, agentConfig, log)
+    posted = post_payload(legacy_url, legacy_payload, serialize_and_compress_legacy_payload, agentConfig, log)
+
+    if topology_only:
+        # The check aborts the snapshot of a batch which wasn't sent
+        if not posted:
+            raise Exception("Unable to serialize the topology batch")
+        return
 
     # Post metrics payload
     post_payload(metrics_endpoint, metrics_payload, serialize_and_compress_metrics_payload, agentConfig, log)
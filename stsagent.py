@@ -20,16 +20,17 @@ import zlib
 os.umask(022)
 
 # 3p
-import simplejson as json
 try:
     import pycurl
+    from tornado.curl_httpclient import CurlAsyncHTTPClient
 except ImportError:
     # For the source install, pycurl might not be installed
     pycurl = None
-from tornado.escape import json_decode
 import tornado.httpclient
 import tornado.httpserver
+from tornado.httputil import HTTPHeaders
 import tornado.ioloop
+import tornado.simple_httpclient
 from tornado.options import define, options, parse_command_line
 import tornado.web
 
@@ -45,6 +46,8 @@ from config import (
 import modules
 from transaction import Transaction, TransactionManager
 from util import get_uuid
+from utils.disk_queue import DiskQueue
+from utils import json_codec
 from utils.net import DEFAULT_DNS_TTL, DNSCache
 
 
@@ -79,6 +82,12 @@ MAX_WAIT_FOR_REPLAY = timedelta(seconds=90)
 # Maximum queue size in bytes (when this is reached, old messages are dropped)
 MAX_QUEUE_SIZE = 30 * 1024 * 1024  # 30MB
 
+# Maximum size of the payload of queued API transactions merged into one request
+MAX_BATCH_SIZE = 1024 * 1024  # 1MB
+
+# Maximum size on disk of the transactions spilled beyond MAX_QUEUE_SIZE, when enabled
+DEFAULT_SPILL_MAX_SIZE_MB = 512
+
 # Some responses should be rejected, rather than replayed. This list will be rejected.
 RESPONSES_TO_REJECT = [413, 400]
 
@@ -86,6 +95,12 @@ THROTTLING_DELAY = timedelta(microseconds=1000000 / 2)  # 2 msg/second
 
 
 class EmitterThread(threading.Thread):
+    """Run an emitter on the payloads it's given.
+
+    Emitters are called with the decoded payload, or with the payload as
+    received and its headers if they have a true `accepts_raw_payload`
+    attribute, to skip the decoding.
+    """
 
     def __init__(self, *args, **kwargs):
         self.__name = kwargs['name']
@@ -94,6 +109,7 @@ class EmitterThread(threading.Thread):
         self.__config = kwargs.pop('config')
         self.__max_queue_size = kwargs.pop('max_queue_size', 100)
         self.__queue = Queue(self.__max_queue_size)
+        self.accepts_raw_payload = getattr(self.__emitter, 'accepts_raw_payload', False)
         threading.Thread.__init__(self, *args, **kwargs)
         self.daemon = True
 
@@ -102,7 +118,10 @@ class EmitterThread(threading.Thread):
             (data, headers) = self.__queue.get()
             try:
                 self.__logger.debug('Emitter %r handling a packet', self.__name)
-                self.__emitter(data, self.__logger, self.__config)
+                if self.accepts_raw_payload:
+                    self.__emitter(data, self.__logger, self.__config, headers)
+                else:
+                    self.__emitter(data, self.__logger, self.__config)
             except Exception:
                 self.__logger.error('Failure during operation of emitter %r', self.__name, exc_info=True)
 
@@ -113,38 +132,95 @@ class EmitterThread(threading.Thread):
             self.__logger.warn('Dropping packet for %r due to backlog', self.__name)
 
 
+class PayloadDecoderThread(threading.Thread):
+    """Decompress and decode the payloads, once for all the emitters which
+    don't take them raw, outside of the IOLoop"""
+
+    def __init__(self, *args, **kwargs):
+        self.__logger = kwargs.pop('logger')
+        self.__max_queue_size = kwargs.pop('max_queue_size', 100)
+        self.__queue = Queue(self.__max_queue_size)
+        self.emitterThreads = []
+        threading.Thread.__init__(self, *args, **kwargs)
+        self.daemon = True
+
+    def run(self):
+        while True:
+            (data, headers) = self.__queue.get()
+            try:
+                if headers and headers.get('Content-Encoding') == 'deflate':
+                    data = zlib.decompress(data)
+                data = json_codec.loads(data)
+            except Exception:
+                self.__logger.error('Unable to decode a packet for the emitters', exc_info=True)
+                continue
+            for emitterThread in self.emitterThreads:
+                emitterThread.enqueue(data, headers)
+
+    def enqueue(self, data, headers):
+        try:
+            self.__queue.put((data, headers), block=False)
+        except Full:
+            self.__logger.warn('Dropping packet for the emitters due to decoding backlog')
+
+
 class EmitterManager(object):
     """Track custom emitters"""
 
     def __init__(self, config):
         self.agentConfig = config
         self.emitterThreads = []
+        self.rawEmitterThreads = []
+        self.decoderThread = None
         for emitter_spec in [s.strip() for s in self.agentConfig.get('custom_emitters', '').split(',')]:
             if len(emitter_spec) == 0:
                 continue
             logging.info('Setting up custom emitter %r', emitter_spec)
             try:
-                thread = EmitterThread(
-                    name=emitter_spec,
-                    emitter=modules.load(emitter_spec, 'emitter'),
-                    logger=logging,
-                    config=config,
-                )
-                thread.start()
-                self.emitterThreads.append(thread)
+                self.add_emitter(emitter_spec, modules.load(emitter_spec, 'emitter'))
             except Exception:
                 logging.error('Unable to start thread for emitter: %r', emitter_spec, exc_info=True)
         logging.info('Done with custom emitters')
 
+    def add_emitter(self, name, emitter):
+        thread = EmitterThread(
+            name=name,
+            emitter=emitter,
+            logger=logging,
+            config=self.agentConfig,
+        )
+        if thread.accepts_raw_payload:
+            self.rawEmitterThreads.append(thread)
+        else:
+            if self.decoderThread is None:
+                self.decoderThread = PayloadDecoderThread(name='emitter payload decoder', logger=logging)
+                self.decoderThread.start()
+            self.decoderThread.emitterThreads.append(thread)
+        thread.start()
+        self.emitterThreads.append(thread)
+
     def send(self, data, headers=None):
-        if not self.emitterThreads:
-            return  # bypass decompression/decoding
-        if headers and headers.get('Content-Encoding') == 'deflate':
-            data = zlib.decompress(data)
-        data = json_decode(data)
-        for emitterThread in self.emitterThreads:
+        # Nothing is decoded here, not to block the IOLoop
+        for emitterThread in self.rawEmitterThreads:
             logging.info('Queueing for emitter %r', emitterThread.name)
             emitterThread.enqueue(data, headers)
+        if self.decoderThread is not None:
+            logging.info('Queueing for the emitters decoding payloads')
+            self.decoderThread.enqueue(data, headers)
+
+
+if pycurl is not None:
+    class ForwarderCurlHTTPClient(CurlAsyncHTTPClient):
+        """CurlAsyncHTTPClient counting the connections opened by curl, to tell
+           how many requests reused a kept-alive connection"""
+
+        def initialize(self, io_loop, **kwargs):
+            super(ForwarderCurlHTTPClient, self).initialize(io_loop, **kwargs)
+            self.connection_count = 0
+
+        def _finish(self, curl, curl_error=None, curl_message=None):
+            self.connection_count += curl.getinfo(pycurl.NUM_CONNECTS)
+            super(ForwarderCurlHTTPClient, self)._finish(curl, curl_error, curl_message)
 
 
 class AgentTransaction(Transaction):
@@ -180,6 +256,12 @@ class AgentTransaction(Transaction):
         self._data = data
         self._headers = headers
         self._headers['DD-Forwarder-Version'] = get_version()
+        # Remove headers that were passed by the emitter. Those don't apply anymore
+        # This is pretty hacky though as it should be done in pycurl or curl or tornado
+        for h in HEADERS_TO_REMOVE:
+            if h in self._headers:
+                del self._headers[h]
+                log.debug("Removing {0} header.".format(h))
         self._msg_type = msg_type
 
         # Call after data has been set (size is computed in Transaction's init)
@@ -202,6 +284,16 @@ class AgentTransaction(Transaction):
     def __sizeof__(self):
         return sys.getsizeof(self._data)
 
+    def __getstate__(self):
+        # HTTPHeaders can't be unpickled, e.g. from the spill queue
+        state = self.__dict__.copy()
+        state['_headers'] = dict(self._headers)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._headers = HTTPHeaders(self._headers)
+
     def get_url(self, endpoint, api_key):
         endpoint_base_url = get_url_endpoint(endpoint)
         if self._application.agent_dns_caching:
@@ -209,66 +301,17 @@ class AgentTransaction(Transaction):
         return "{0}/intake/{1}?api_key={2}".format(endpoint_base_url, self._msg_type, api_key)
 
     def flush(self):
-        # Getting proxy settings
-        proxy_settings = self._application._agentConfig.get('proxy_settings', None)
-
-        tornado_client_params = {
-            'method': 'POST',
-            'body': self._data,
-            'headers': self._headers,
-            'validate_cert': not self._application.skip_ssl_validation,
-            'allow_ipv6': True,
-            'request_timeout': self._request_timeout,
-        }
-
-        # Remove headers that were passed by the emitter. Those don't apply anymore
-        # This is pretty hacky though as it should be done in pycurl or curl or tornado
-        for h in HEADERS_TO_REMOVE:
-            if h in tornado_client_params['headers']:
-                del tornado_client_params['headers'][h]
-                log.debug("Removing {0} header.".format(h))
-
-        force_use_curl = False
-
-        if proxy_settings is not None:
-            force_use_curl = True
-            if pycurl is not None:
-                log.debug("Configuring tornado to use proxy settings: %s:****@%s:%s" % (proxy_settings['user'],
-                          proxy_settings['host'], proxy_settings['port']))
-                tornado_client_params['proxy_host'] = proxy_settings['host']
-                tornado_client_params['proxy_port'] = proxy_settings['port']
-                tornado_client_params['proxy_username'] = proxy_settings['user']
-                tornado_client_params['proxy_password'] = proxy_settings['password']
-
-                if self._application._agentConfig.get('proxy_forbid_method_switch'):
-                    # See http://stackoverflow.com/questions/8156073/curl-violate-rfc-2616-10-3-2-and-switch-from-post-to-get
-                    tornado_client_params['prepare_curl_callback'] = lambda curl: curl.setopt(pycurl.POSTREDIR, pycurl.REDIR_POST_ALL)
-
-        if (not self._application.use_simple_http_client or force_use_curl) and pycurl is not None:
-            ssl_certificate = self._application._agentConfig.get('ssl_certificate', None)
-            tornado_client_params['ca_certs'] = ssl_certificate
-
-        use_curl = force_use_curl or self._application._agentConfig.get("use_curl_http_client") and not self._application.use_simple_http_client
-
-        if use_curl:
-            if pycurl is None:
-                log.error("sts-agent is configured to use the Curl HTTP Client, but pycurl is not available on this system.")
-            else:
-                log.debug("Using CurlAsyncHTTPClient")
-                tornado.httpclient.AsyncHTTPClient.configure("tornado.curl_httpclient.CurlAsyncHTTPClient")
-        else:
-            log.debug("Using SimpleHTTPClient")
-        http = tornado.httpclient.AsyncHTTPClient()
-
         url = self.get_url(self._endpoint, self._api_key)
         log.debug(
             u"Sending %s to endpoint %s at %s",
             self._type, self._endpoint, url
         )
-        req = tornado.httpclient.HTTPRequest(url=url, **tornado_client_params)
-        http.fetch(req, callback=self.on_response)
+        # The other settings are the defaults of the application's client
+        req = tornado.httpclient.HTTPRequest(url=url, method='POST', body=self._data, headers=self._headers)
+        self._application.http_client.fetch(req, callback=self.on_response)
 
     def on_response(self, response):
+        self._application.http_request_count += 1
         if response.error:
             log.error("Response: %s" % response)
             if response.code in RESPONSES_TO_REJECT:
@@ -296,6 +339,30 @@ class APIMetricTransaction(MetricTransaction):
     def get_data(self):
         return self._data
 
+    def get_merge_key(self):
+        return (self.__class__, self._endpoint, self._api_key)
+
+    def merge(self, transactions):
+        series = []
+        for tr in transactions:
+            data = tr._data
+            if tr._headers.get('Content-Encoding') == 'deflate':
+                data = zlib.decompress(data)
+            payload = json_codec.loads(data)
+            if payload.keys() != ['series']:
+                raise ValueError("Unexpected keys in series payload: %s" % ', '.join(payload))
+            series.extend(payload['series'])
+
+        # Don't go through __init__, the batch isn't queued
+        batch = copy.copy(self)
+        Transaction.__init__(batch)
+        # The headers of the transactions merged are left as they are
+        batch._headers = HTTPHeaders(dict(self._headers))
+        batch._headers['Content-Type'] = 'application/json'
+        batch._headers['Content-Encoding'] = 'deflate'
+        batch._data = zlib.compress(json_codec.dumps({'series': series}))
+        return batch
+
 
 class APIServiceCheckTransaction(AgentTransaction):
     _type = "service checks"
@@ -321,6 +388,12 @@ class StatusHandler(tornado.web.RequestHandler):
                 (tr.get_id(), tr.get_size(), tr.get_error_count(), tr.get_next_flush()))
         self.write("</table>")
 
+        stats = self.application.get_http_client_stats()
+        self.write("<table><tr><td>HTTP requests</td><td>New connections</td><td>Reused connections</td></tr>")
+        self.write("<tr><td>%s</td><td>%s</td><td>%s</td></tr>" %
+            (stats['requests'], stats['connections'], stats['reused']))
+        self.write("</table>")
+
         if threshold >= 0:
             if len(transactions) > threshold:
                 self.set_status(503)
@@ -390,7 +463,6 @@ class ApiCheckRunHandler(tornado.web.RequestHandler):
 
 class Application(tornado.web.Application):
 
-    NO_PARALLELISM = 1
     DEFAULT_PARALLELISM = 5
 
     def __init__(self, port, agentConfig, watchdog=True,
@@ -405,14 +477,25 @@ class Application(tornado.web.Application):
             log.warning(u"No valid endpoint found. Forwarder will drop all incoming payloads.")
         AgentTransaction.set_request_timeout(agentConfig['forwarder_timeout'])
 
-        max_parallelism = self.NO_PARALLELISM
-        # Multiple endpoints => enable parallelism
-        if len(agentConfig['endpoints']) > 1:
-            max_parallelism = self.DEFAULT_PARALLELISM
+        # Every endpoint flushes up to DEFAULT_PARALLELISM transactions at once,
+        # depending on how well it keeps up
+        max_parallelism = self.DEFAULT_PARALLELISM * max(1, len(agentConfig['endpoints']))
+
+        spill_queue = None
+        spill_path = agentConfig.get('forwarder_spill_path')
+        if spill_path:
+            spill_max_size = int(agentConfig.get('forwarder_spill_max_size_mb') or DEFAULT_SPILL_MAX_SIZE_MB)
+            try:
+                spill_queue = DiskQueue(spill_path, spill_max_size * 1024 * 1024)
+            except (IOError, OSError):
+                log.exception("Unable to spill transactions to %s, keeping them in memory only", spill_path)
 
         self._tr_manager = TransactionManager(MAX_WAIT_FOR_REPLAY,
                                               MAX_QUEUE_SIZE, THROTTLING_DELAY,
-                                              max_parallelism=max_parallelism)
+                                              max_parallelism=max_parallelism,
+                                              spill_queue=spill_queue,
+                                              max_endpoint_parallelism=self.DEFAULT_PARALLELISM,
+                                              max_batch_size=MAX_BATCH_SIZE)
         AgentTransaction.set_tr_manager(self._tr_manager)
 
         self._watchdog = None
@@ -424,6 +507,8 @@ class Application(tornado.web.Application):
         self.use_simple_http_client = use_simple_http_client
         if self.skip_ssl_validation:
             log.info("Skipping SSL hostname validation, useful when using a transparent proxy")
+        self.http_client = self._create_http_client(max_parallelism)
+        self.http_request_count = 0
 
         # Monitor activity
         if watchdog:
@@ -432,6 +517,68 @@ class Application(tornado.web.Application):
                                              max_resets=WATCHDOG_HIGH_ACTIVITY_THRESHOLD)
 
 
+    def _create_http_client(self, max_clients):
+        """Create the HTTP client shared by the transactions, with up to
+           `max_clients` concurrent requests. The curl client keeps its
+           connections alive between the requests."""
+        agentConfig = self._agentConfig
+        defaults = {
+            'validate_cert': not self.skip_ssl_validation,
+            'allow_ipv6': True,
+            'request_timeout': AgentTransaction._request_timeout,
+        }
+
+        # Getting proxy settings
+        proxy_settings = agentConfig.get('proxy_settings', None)
+        force_use_curl = proxy_settings is not None
+
+        if (not self.use_simple_http_client or force_use_curl) and pycurl is not None:
+            defaults['ca_certs'] = agentConfig.get('ssl_certificate', None)
+
+        use_curl = force_use_curl or agentConfig.get("use_curl_http_client") and not self.use_simple_http_client
+        if use_curl and pycurl is None:
+            log.error("sts-agent is configured to use the Curl HTTP Client, but pycurl is not available on this system.")
+        if not use_curl or pycurl is None:
+            log.debug("Using SimpleHTTPClient")
+            return tornado.simple_httpclient.SimpleAsyncHTTPClient(
+                force_instance=True, max_clients=max_clients, defaults=defaults)
+
+        forbid_method_switch = False
+        if proxy_settings is not None:
+            log.debug("Configuring tornado to use proxy settings: %s:****@%s:%s" % (proxy_settings['user'],
+                      proxy_settings['host'], proxy_settings['port']))
+            defaults['proxy_host'] = proxy_settings['host']
+            defaults['proxy_port'] = proxy_settings['port']
+            defaults['proxy_username'] = proxy_settings['user']
+            defaults['proxy_password'] = proxy_settings['password']
+            forbid_method_switch = agentConfig.get('proxy_forbid_method_switch')
+
+        def prepare_curl(curl):
+            # Keep at most one idle connection per concurrent request
+            curl.setopt(pycurl.MAXCONNECTS, max_clients)
+            if hasattr(pycurl, 'TCP_KEEPALIVE'):
+                curl.setopt(pycurl.TCP_KEEPALIVE, 1)
+            if forbid_method_switch:
+                # See http://stackoverflow.com/questions/8156073/curl-violate-rfc-2616-10-3-2-and-switch-from-post-to-get
+                curl.setopt(pycurl.POSTREDIR, pycurl.REDIR_POST_ALL)
+        defaults['prepare_curl_callback'] = prepare_curl
+
+        log.debug("Using CurlAsyncHTTPClient")
+        return ForwarderCurlHTTPClient(force_instance=True, max_clients=max_clients, defaults=defaults)
+
+    def get_http_client_stats(self):
+        """Requests sent by the HTTP client, and how many of them reused a
+           connection (None when the client doesn't tell)"""
+        connection_count = getattr(self.http_client, 'connection_count', None)
+        reused_count = None
+        if connection_count is not None:
+            reused_count = max(0, self.http_request_count - connection_count)
+        return {
+            'requests': self.http_request_count,
+            'connections': connection_count,
+            'reused': reused_count,
+        }
+
     def get_from_dns_cache(self, url):
         if not self.agent_dns_caching:
             log.debug('Caching disabled, not resolving.')
@@ -480,7 +627,7 @@ class Application(tornado.web.Application):
             self._metrics['uuid'] = get_uuid()
             self._metrics['internalHostname'] = get_hostname(self._agentConfig)
             self._metrics['apiKey'] = self._agentConfig['api_key']
-            MetricTransaction(json.dumps(self._metrics),
+            MetricTransaction(json_codec.dumps(self._metrics),
                               headers={'Content-Type': 'application/json'})
             self._metrics = {}
 
@@ -565,12 +712,16 @@ class Application(tornado.web.Application):
         self.mloop.start()
         log.info("Stopped")
 
+        # Keep the unsent transactions for the next run
+        self._tr_manager.spill_transactions()
+
     def stop(self):
         self.mloop.stop()
 
 
 def init(skip_ssl_validation=False, use_simple_http_client=False):
     agentConfig = get_config(parse_args=False)
+    json_codec.configure(agentConfig)
 
     port = agentConfig.get('listen_port', 18123)
     if port is None:
@@ -13,12 +13,16 @@ set_no_proxy_settings()
 
 # stdlib
 import copy
+import errno
 import os
 import logging
+import multiprocessing
 import optparse
+import re
 import select
 import signal
 import socket
+import stat
 import string
 import sys
 import threading
@@ -31,7 +35,6 @@ os.umask(022)
 
 # 3rd party
 import requests
-import simplejson as json
 
 # project
 from aggregator import get_formatter, MetricsBucketAggregator
@@ -52,9 +55,11 @@ from daemon import (
 from util import chunks, get_uuid, plural
 from utils.hostname import get_hostname
 from utils.http import get_expvar_stats
-from utils.net import inet_pton
-from utils.net import IPV6_V6ONLY, IPPROTO_IPV6
+from utils import json_codec
+from utils.net import get_peer_credentials, get_udp_socket_drops, inet_pton
+from utils.net import IPV6_V6ONLY, IPPROTO_IPV6, SO_REUSEPORT
 from utils.pidfile import PidFile
+from utils.platform import Platform
 from utils.watchdog import Watchdog
 
 # urllib3 logs a bunch of stuff at the info level
@@ -81,6 +86,30 @@ FLUSH_LOGGING_INITIAL = 10
 FLUSH_LOGGING_COUNT = 5
 EVENT_CHUNK_SIZE = 50
 COMPRESS_THRESHOLD = 1024
+# Maximum number of datagrams drained from the socket per select wakeup.
+# 1 keeps the historical one datagram per wakeup behavior.
+DEFAULT_RECV_BATCH_SIZE = 1
+# recv errors meaning the socket has been drained
+WOULD_BLOCK_ERRNOS = (errno.EAGAIN, errno.EWOULDBLOCK)
+# Sharded mode: messages sent by the reporter to the worker processes, and how
+# long it waits for a worker to hand over its shard.
+SHARD_FLUSH = 'flush'
+SHARD_STOP = 'stop'
+SHARD_COLLECT_TIMEOUT = 5
+# Types of the optional Unix socket listener
+UNIX_SOCKET_DGRAM = 'dgram'
+UNIX_SOCKET_STREAM = 'stream'
+UNIX_SOCKET_TYPES = {
+    UNIX_SOCKET_DGRAM: socket.SOCK_DGRAM,
+    UNIX_SOCKET_STREAM: socket.SOCK_STREAM,
+}
+# Lets the clients of any user send to the Unix socket
+UNIX_SOCKET_MODE = 0722
+UNIX_SOCKET_BACKLOG = 128
+# Bytes buffered for an incomplete line of a Unix stream connection
+UNIX_STREAM_MAX_PENDING = 64 * 1024
+# Container id in the /proc/<pid>/cgroup of a client, for origin detection
+CONTAINER_ID_RE = re.compile(r'[0-9a-f]{64}')
 
 
 def add_serialization_status_metric(status, hostname):
@@ -119,16 +148,16 @@ def unicode_metrics(metrics):
 def serialize_metrics(metrics, hostname):
     try:
         metrics.append(add_serialization_status_metric("success", hostname))
-        serialized = json.dumps({"series": metrics})
+        serialized = json_codec.dumps({"series": metrics})
     except UnicodeDecodeError as e:
         log.exception("Unable to serialize payload. Trying to replace bad characters. %s", e)
         metrics.append(add_serialization_status_metric("failure", hostname))
         try:
             log.error(metrics)
-            serialized = json.dumps({"series": unicode_metrics(metrics)})
+            serialized = json_codec.dumps({"series": unicode_metrics(metrics)})
         except Exception as e:
             log.exception("Unable to serialize payload. Giving up. %s", e)
-            serialized = json.dumps({"series": [add_serialization_status_metric("permanent_failure", hostname)]})
+            serialized = json_codec.dumps({"series": [add_serialization_status_metric("permanent_failure", hostname)]})
 
     if len(serialized) > COMPRESS_THRESHOLD:
         headers = {'Content-Type': 'application/json',
@@ -140,7 +169,7 @@ def serialize_metrics(metrics, hostname):
 
 
 def serialize_event(event):
-    return json.dumps(event)
+    return json_codec.dumps(event)
 
 
 def mapto_v6(addr):
@@ -199,11 +228,13 @@ class Reporter(threading.Thread):
     """
 
     def __init__(self, interval, metrics_aggregator, api_host, api_key=None,
-                 use_watchdog=False, event_chunk_size=None):
+                 use_watchdog=False, event_chunk_size=None, server=None):
         threading.Thread.__init__(self)
         self.interval = int(interval)
         self.finished = threading.Event()
         self.metrics_aggregator = metrics_aggregator
+        self.server = server
+        self.receive_stats = {}
         self.flush_count = 0
         self.log_count = 0
         self.hostname = get_hostname()
@@ -230,7 +261,10 @@ class Reporter(threading.Thread):
 
         while not self.finished.isSet():  # Use camel case isSet for 2.4 support.
             self.finished.wait(self.interval)
+            if isinstance(self.server, ShardedServer):
+                self.server.merge_shards()
             self.metrics_aggregator.send_packet_count('stackstate.stsstatsd.packet.count')
+            self.send_receive_stats()
             self.flush()
             if self.watchdog:
                 self.watchdog.reset()
@@ -239,6 +273,19 @@ class Reporter(threading.Thread):
         log.debug("Stopped reporter")
         DogstatsdStatus.remove_latest_status()
 
+    def send_receive_stats(self):
+        """
+        Submit the receive loop counters of the server accumulated since the
+        last flush.
+        """
+        if self.server is None:
+            return
+
+        self.receive_stats = self.server.flush_receive_stats()
+        for name, value in self.receive_stats.iteritems():
+            if value is not None:
+                self.metrics_aggregator.submit_metric('stackstate.stsstatsd.%s' % name, value, 'g')
+
     def flush(self):
         try:
             self.flush_count += 1
@@ -280,6 +327,9 @@ class Reporter(threading.Thread):
                 metric_count=count,
                 event_count=event_count,
                 service_check_count=service_check_count,
+                datagrams_per_wakeup=self.receive_stats.get('datagrams_per_wakeup', 0),
+                socket_drops=self.receive_stats.get('socket_drops'),
+                context_cache_stats=self.metrics_aggregator.context_cache_stats(),
             ).persist()
 
         except Exception:
@@ -314,7 +364,7 @@ class Reporter(threading.Thread):
                 params['api_key'] = self.api_key
             url = '%s/intake?%s' % (self.api_host, urlencode(params))
 
-            self.submit_http(url, json.dumps(payload), headers)
+            self.submit_http(url, json_codec.dumps(payload), headers)
 
     def submit_http(self, url, data, headers):
         headers["DD-Dogstatsd-Version"] = get_version()
@@ -345,14 +395,16 @@ class Reporter(threading.Thread):
             params['api_key'] = self.api_key
 
         url = '{0}/api/v1/check_run?{1}'.format(self.api_host, urlencode(params))
-        self.submit_http(url, json.dumps(service_checks), headers)
+        self.submit_http(url, json_codec.dumps(service_checks), headers)
 
 
 class Server(object):
     """
     A statsd udp server.
     """
-    def __init__(self, metrics_aggregator, host, port, forward_to_host=None, forward_to_port=None, so_rcvbuf=None):
+    def __init__(self, metrics_aggregator, host, port, forward_to_host=None, forward_to_port=None, so_rcvbuf=None,
+                 recv_batch_size=None, reuse_port=False, socket_path=None, socket_type=None,
+                 origin_detection=False):
         self.sockaddr = None
         self.socket = None
         self.metrics_aggregator = metrics_aggregator
@@ -360,6 +412,26 @@ class Server(object):
         self.port = port
         self.buffer_size = 1024 * 8
         self.so_rcvbuf = so_rcvbuf
+        self.reuse_port = reuse_port
+        self.recv_batch_size = max(1, int(recv_batch_size or DEFAULT_RECV_BATCH_SIZE))
+
+        # Optional Unix socket listener, next to the UDP one
+        self.socket_path = socket_path
+        self.socket_type = socket_type or UNIX_SOCKET_DGRAM
+        if self.socket_type not in UNIX_SOCKET_TYPES:
+            log.warning("Unknown statsd_socket_type %s, using %s", self.socket_type, UNIX_SOCKET_DGRAM)
+            self.socket_type = UNIX_SOCKET_DGRAM
+        self.origin_detection = origin_detection
+        self.unix_socket = None
+        # Unix stream connection -> [incomplete last line, origin tags]
+        self.unix_connections = {}
+        self.select_sockets = []
+
+        # Receive loop counters, reset at every flush of the reporter
+        self.wakeup_count = 0
+        self.datagram_count = 0
+        self.max_datagrams_per_wakeup = 0
+        self.last_socket_drops = None
 
         self.running = False
 
@@ -400,6 +472,11 @@ class Server(object):
 
         self.socket.setblocking(0)
 
+        # Let several processes bind the same port, the kernel balances
+        # the datagrams between them.
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+
         #let's get the sockaddr
         self.sockaddr = get_socket_address(self.host, int(self.port), ipv4_only=ipv4_only)
 
@@ -410,12 +487,22 @@ class Server(object):
             return
 
         log.info('Listening on socket address: %s', str(self.sockaddr))
+        if self.recv_batch_size > 1:
+            log.info('Draining up to %s datagrams per wakeup', self.recv_batch_size)
+        self.last_socket_drops = get_udp_socket_drops(self.socket)
+
+        self.select_sockets = [self.socket]
+        listen_unix = self.socket_path is not None and self.bind_unix_socket()
 
         # Inline variables for quick look-up.
         buffer_size = self.buffer_size
+        recv_batch_size = self.recv_batch_size
         aggregator_submit = self.metrics_aggregator.submit_packets
-        sock = [self.socket]
+        aggregator_submit_batch = self.metrics_aggregator.submit_datagrams
+        sock = self.select_sockets
         socket_recv = self.socket.recv
+        socket_error = socket.error
+        would_block = WOULD_BLOCK_ERRNOS
         select_select = select.select
         select_error = select.error
         timeout = UDP_SOCKET_TIMEOUT
@@ -427,13 +514,38 @@ class Server(object):
         message = None
         while self.running:
             try:
-                ready = select_select(sock, [], [], timeout)
-                if ready[0]:
-                    message = socket_recv(buffer_size)
-                    aggregator_submit(message)
+                readable = select_select(sock, [], [], timeout)[0]
+                if listen_unix and readable:
+                    readable = self.receive_unix(readable)
+                if readable:
+                    if recv_batch_size == 1:
+                        message = socket_recv(buffer_size)
+                        messages = [message]
+                        aggregator_submit(message)
+                    else:
+                        # Drain the socket until it would block so that a
+                        # single wakeup handles every datagram already queued.
+                        messages = []
+                        message = None
+                        try:
+                            while len(messages) < recv_batch_size:
+                                messages.append(socket_recv(buffer_size))
+                        except socket_error as e:
+                            if e.args[0] not in would_block:
+                                raise
+                        if not messages:
+                            continue
+                        aggregator_submit_batch(messages)
+
+                    datagram_count = len(messages)
+                    self.wakeup_count += 1
+                    self.datagram_count += datagram_count
+                    if datagram_count > self.max_datagrams_per_wakeup:
+                        self.max_datagrams_per_wakeup = datagram_count
 
                     if should_forward:
-                        forward_udp_sock.send(message)
+                        for message in messages:
+                            forward_udp_sock.send(message)
             except select_error as se:
                 # Ignore interrupted system calls from sigterm.
                 errno = se[0]
@@ -444,6 +556,377 @@ class Server(object):
             except Exception:
                 log.exception('Error receiving datagram `%s`', message)
 
+        if listen_unix:
+            self.close_unix_socket()
+
+    def bind_unix_socket(self):
+        """
+        Listen on the Unix socket at `socket_path`, replacing the one left by
+        a previous run. Return False if it can't be bound.
+        """
+        path = self.socket_path
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+        except OSError:
+            pass
+
+        try:
+            unix_socket = socket.socket(socket.AF_UNIX, UNIX_SOCKET_TYPES[self.socket_type])
+            if self.so_rcvbuf is not None:
+                unix_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, int(self.so_rcvbuf))
+            unix_socket.bind(path)
+            os.chmod(path, UNIX_SOCKET_MODE)
+            if self.socket_type == UNIX_SOCKET_STREAM:
+                unix_socket.listen(UNIX_SOCKET_BACKLOG)
+            unix_socket.setblocking(0)
+        except (socket.error, OSError):
+            log.exception('Unable to listen on the Unix socket %s', path)
+            return False
+
+        log.info('Listening on Unix %s socket: %s', self.socket_type, path)
+        if self.origin_detection and self.socket_type == UNIX_SOCKET_DGRAM:
+            # Datagram credentials come as ancillary data, which needs recvmsg
+            log.warning('Origin detection is only available with the %s socket type', UNIX_SOCKET_STREAM)
+
+        self.unix_socket = unix_socket
+        self.select_sockets.append(unix_socket)
+        return True
+
+    def receive_unix(self, readable):
+        """
+        Receive from the Unix sockets among the `readable` sockets returned by
+        select, and return the other ones.
+        """
+        others = []
+        for ready_socket in readable:
+            if ready_socket is self.unix_socket:
+                if self.socket_type == UNIX_SOCKET_STREAM:
+                    self.accept_unix_connection()
+                else:
+                    self.receive_unix_datagrams()
+            elif ready_socket in self.unix_connections:
+                self.receive_unix_stream(ready_socket)
+            else:
+                others.append(ready_socket)
+        return others
+
+    def receive_unix_datagrams(self):
+        messages = []
+        try:
+            while len(messages) < self.recv_batch_size:
+                messages.append(self.unix_socket.recv(self.buffer_size))
+        except socket.error as e:
+            if e.args[0] not in WOULD_BLOCK_ERRNOS:
+                raise
+        if messages:
+            self.submit_unix(messages)
+
+    def accept_unix_connection(self):
+        try:
+            connection, _ = self.unix_socket.accept()
+        except socket.error as e:
+            if e.args[0] in WOULD_BLOCK_ERRNOS:
+                return
+            raise
+        connection.setblocking(0)
+
+        origin_tags = None
+        if self.origin_detection:
+            origin_tags = get_origin_tags(get_peer_credentials(connection))
+        self.unix_connections[connection] = ['', origin_tags]
+        self.select_sockets.append(connection)
+
+    def receive_unix_stream(self, connection):
+        """
+        Stream connections carry newline separated packets, a line is submitted
+        once complete.
+        """
+        pending = self.unix_connections[connection]
+        try:
+            data = connection.recv(self.buffer_size)
+        except socket.error as e:
+            if e.args[0] in WOULD_BLOCK_ERRNOS:
+                return
+            log.warning('Error receiving from a Unix stream connection: %s', e)
+            data = ''
+
+        if not data:
+            self.close_unix_connection(connection)
+            if pending[0]:
+                self.submit_unix([pending[0]], pending[1])
+            return
+
+        data = pending[0] + data
+        end = data.rfind('\n')
+        if end == -1:
+            if len(data) > UNIX_STREAM_MAX_PENDING:
+                log.warning('Dropping %s bytes received without a line break on a Unix stream connection', len(data))
+                data = ''
+            pending[0] = data
+            return
+
+        pending[0] = data[end + 1:]
+        self.submit_unix([data[:end]], pending[1])
+
+    def submit_unix(self, messages, origin_tags=None):
+        if origin_tags:
+            messages = [add_origin_tags(message, origin_tags) for message in messages]
+        self.metrics_aggregator.submit_datagrams(messages)
+
+        datagram_count = len(messages)
+        self.wakeup_count += 1
+        self.datagram_count += datagram_count
+        if datagram_count > self.max_datagrams_per_wakeup:
+            self.max_datagrams_per_wakeup = datagram_count
+
+        if self.should_forward:
+            for message in messages:
+                self.forward_udp_sock.send(message)
+
+    def close_unix_connection(self, connection):
+        self.unix_connections.pop(connection, None)
+        if connection in self.select_sockets:
+            self.select_sockets.remove(connection)
+        connection.close()
+
+    def close_unix_socket(self):
+        for connection in self.unix_connections.keys():
+            self.close_unix_connection(connection)
+        if self.unix_socket is not None:
+            self.select_sockets.remove(self.unix_socket)
+            self.unix_socket.close()
+            self.unix_socket = None
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+
+    def flush_receive_stats(self):
+        """
+        Return the receive loop counters accumulated since the last call and
+        reset them. `socket_drops` is None where the kernel counter can't be read.
+        """
+        wakeup_count, datagram_count = self.wakeup_count, self.datagram_count
+        max_datagrams_per_wakeup = self.max_datagrams_per_wakeup
+        self.wakeup_count = 0
+        self.datagram_count = 0
+        self.max_datagrams_per_wakeup = 0
+
+        socket_drops = None
+        if self.socket is not None:
+            total_drops = get_udp_socket_drops(self.socket)
+            if total_drops is not None and self.last_socket_drops is not None:
+                socket_drops = max(0, total_drops - self.last_socket_drops)
+            self.last_socket_drops = total_drops
+
+        return {
+            'datagram.count': datagram_count,
+            'datagrams_per_wakeup': round(float(datagram_count) / wakeup_count, 2) if wakeup_count else 0,
+            'max_datagrams_per_wakeup': max_datagrams_per_wakeup,
+            'socket_drops': socket_drops,
+        }
+
+    def stop(self):
+        self.running = False
+
+
+def get_origin_tags(credentials, procfs_path='/proc'):
+    """
+    Return the tag identifying the container of the client with the given
+    (pid, uid, gid) credentials, or None if it doesn't run in a container.
+    """
+    if credentials is None:
+        return None
+
+    try:
+        with open(os.path.join(procfs_path, str(credentials[0]), 'cgroup')) as f:
+            match = CONTAINER_ID_RE.search(f.read())
+    except IOError:
+        return None
+
+    if match is None:
+        return None
+    return 'container_id:%s' % match.group(0)
+
+
+def add_origin_tags(packet, origin_tags):
+    """
+    Append the origin tags to every metric of a packet, events and service
+    checks are left as is.
+    """
+    lines = []
+    for line in packet.splitlines():
+        if not line or line.startswith('_e') or line.startswith('_sc'):
+            lines.append(line)
+            continue
+        # The tags aren't always the last field, e.g. before the sample rate
+        fields = line.split('|')
+        for i in xrange(1, len(fields)):
+            if fields[i].startswith('#'):
+                fields[i] = '%s,%s' % (fields[i], origin_tags) if len(fields[i]) > 1 else '#' + origin_tags
+                break
+        else:
+            fields.append('#' + origin_tags)
+        lines.append('|'.join(fields))
+    return '\n'.join(lines)
+
+
+def merge_receive_stats(receive_stats):
+    """
+    Combine the receive loop counters of several servers.
+    """
+    datagram_count = sum(stats['datagram.count'] for stats in receive_stats)
+    wakeup_count = sum(
+        stats['datagram.count'] / stats['datagrams_per_wakeup']
+        for stats in receive_stats if stats['datagrams_per_wakeup']
+    )
+    socket_drops = [stats['socket_drops'] for stats in receive_stats if stats['socket_drops'] is not None]
+
+    return {
+        'datagram.count': datagram_count,
+        'datagrams_per_wakeup': round(datagram_count / wakeup_count, 2) if wakeup_count else 0,
+        'max_datagrams_per_wakeup': max([stats['max_datagrams_per_wakeup'] for stats in receive_stats] or [0]),
+        'socket_drops': sum(socket_drops) if socket_drops else None,
+    }
+
+
+def run_shard_worker(conn, aggregator_config, host, port, server_kwargs):
+    """
+    Entry point of a sharded stsstatsd worker process. It runs its own server
+    and aggregator and hands the aggregated shard over `conn` each time the
+    reporter asks for it.
+    """
+    aggregator = MetricsBucketAggregator(**aggregator_config)
+    server = Server(aggregator, host, port, reuse_port=True, **server_kwargs)
+
+    def handle_stop(signum, frame):
+        server.stop()
+
+    signal.signal(signal.SIGTERM, handle_stop)
+    signal.signal(signal.SIGINT, handle_stop)
+
+    def serve_reporter():
+        while True:
+            try:
+                request = conn.recv()
+            except (EOFError, IOError):
+                request = SHARD_STOP
+
+            if request == SHARD_STOP:
+                server.stop()
+                return
+
+            shard = aggregator.flush_shard()
+            shard['receive_stats'] = server.flush_receive_stats()
+            conn.send(shard)
+
+    reporter_thread = threading.Thread(target=serve_reporter)
+    reporter_thread.daemon = True
+    reporter_thread.start()
+
+    server.start()
+
+
+class ShardedServer(object):
+    """
+    Spreads the statsd ingestion over several worker processes bound to the
+    same UDP port with SO_REUSEPORT. Each worker aggregates its own shard, the
+    shards are merged into `metrics_aggregator` before every flush of the
+    reporter.
+    """
+    def __init__(self, metrics_aggregator, host, port, workers, aggregator_config, **server_kwargs):
+        self.sockaddr = None
+        self.metrics_aggregator = metrics_aggregator
+        self.host = host
+        self.port = port
+        self.workers = int(workers)
+        self.aggregator_config = aggregator_config
+        self.server_kwargs = server_kwargs
+        self.processes = []
+        self.connections = []
+        self.receive_stats = merge_receive_stats([])
+        self.running = False
+
+    def start(self):
+        """
+        Start the workers and block until stopped or until a worker dies.
+        """
+        for i in xrange(self.workers):
+            # A Unix socket path can only be bound once, the first worker listens on it
+            server_kwargs = self.server_kwargs if i == 0 else dict(self.server_kwargs, socket_path=None)
+            conn, worker_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=run_shard_worker,
+                name='stsstatsd-shard-%s' % i,
+                args=(worker_conn, self.aggregator_config, self.host, self.port, server_kwargs)
+            )
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+            self.connections.append(conn)
+
+        log.info('Started %s stsstatsd workers on port %s', self.workers, self.port)
+
+        self.running = True
+        try:
+            while self.running:
+                sleep(1)
+                dead = [p.name for p in self.processes if not p.is_alive()]
+                if dead:
+                    log.error('StsStatsd worker(s) %s exited unexpectedly, stopping', ', '.join(dead))
+                    break
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            self.running = False
+            self._stop_workers()
+
+    def _stop_workers(self):
+        for conn in self.connections:
+            try:
+                conn.send(SHARD_STOP)
+            except (IOError, OSError):
+                pass
+
+        for process in self.processes:
+            process.join(UDP_SOCKET_TIMEOUT + 1)
+            if process.is_alive():
+                log.warning('StsStatsd worker %s did not stop, terminating it', process.name)
+                process.terminate()
+
+    def merge_shards(self):
+        """
+        Collect the shard of every worker and merge it into the aggregator.
+        """
+        requested = []
+        for conn in list(self.connections):
+            try:
+                conn.send(SHARD_FLUSH)
+                requested.append(conn)
+            except (IOError, OSError):
+                log.warning('Unable to reach a stsstatsd worker, skipping its shard')
+
+        receive_stats = []
+        for conn in requested:
+            if not conn.poll(SHARD_COLLECT_TIMEOUT):
+                log.warning('A stsstatsd worker did not hand over its shard within %ss', SHARD_COLLECT_TIMEOUT)
+                continue
+            # Also pick up the shards of requests that timed out previously
+            while conn.poll(0):
+                try:
+                    shard = conn.recv()
+                except (EOFError, IOError):
+                    break
+                receive_stats.append(shard.pop('receive_stats'))
+                self.metrics_aggregator.merge_shard(shard)
+
+        self.receive_stats = merge_receive_stats(receive_stats)
+
+    def flush_receive_stats(self):
+        receive_stats, self.receive_stats = self.receive_stats, merge_receive_stats([])
+        return receive_stats
+
     def stop(self):
         self.running = False
 
@@ -587,6 +1070,8 @@ def init5(agent_config=None, use_watchdog=False, use_forwarder=False, args=None)
     event_chunk_size = agent_config.get('event_chunk_size')
     recent_point_threshold = agent_config.get('recent_point_threshold', None)
     so_rcvbuf = agent_config.get('statsd_so_rcvbuf', None)
+    recv_batch_size = agent_config.get('statsd_recv_batch_size', None)
+    workers = int(agent_config.get('statsd_workers') or 1)
     server_host = agent_config['bind_host']
 
     target = agent_config['dd_url']
@@ -600,18 +1085,18 @@ def init5(agent_config=None, use_watchdog=False, use_forwarder=False, args=None)
     # server and reporting threads.
     assert 0 < interval
 
-    aggregator = MetricsBucketAggregator(
-        hostname,
-        aggregator_interval,
+    aggregator_config = dict(
+        hostname=hostname,
+        interval=aggregator_interval,
         recent_point_threshold=recent_point_threshold,
-        formatter=get_formatter(agent_config),
         histogram_aggregates=agent_config.get('histogram_aggregates'),
         histogram_percentiles=agent_config.get('histogram_percentiles'),
+        histogram_backend=agent_config.get('histogram_backend'),
+        histogram_relative_accuracy=agent_config.get('histogram_relative_accuracy'),
+        compact_storage=agent_config.get('compact_metric_storage', False),
         utf8_decoding=agent_config['utf8_decoding']
     )
-
-    # Start the reporting thread.
-    reporter = Reporter(interval, aggregator, target, api_key, use_watchdog, event_chunk_size)
+    aggregator = MetricsBucketAggregator(formatter=get_formatter(agent_config), **aggregator_config)
 
     # NOTICE: when `non_local_traffic` is passed we need to bind to any interface on the box. The forwarder uses
     # Tornado which takes care of sockets creation (more than one socket can be used at once depending on the
@@ -622,7 +1107,26 @@ def init5(agent_config=None, use_watchdog=False, use_forwarder=False, args=None)
     if non_local_traffic:
         server_host = '0.0.0.0'
 
-    server = Server(aggregator, server_host, port, forward_to_host=forward_to_host, forward_to_port=forward_to_port, so_rcvbuf=so_rcvbuf)
+    server_kwargs = dict(
+        forward_to_host=forward_to_host,
+        forward_to_port=forward_to_port,
+        so_rcvbuf=so_rcvbuf,
+        recv_batch_size=recv_batch_size,
+        socket_path=agent_config.get('statsd_socket_path') or None,
+        socket_type=agent_config.get('statsd_socket_type'),
+        origin_detection=_is_affirmative(agent_config.get('statsd_origin_detection'))
+    )
+    if workers > 1 and not Platform.is_linux():
+        log.warning("statsd_workers requires SO_REUSEPORT support, only available on Linux. Using a single process.")
+        workers = 1
+
+    if workers > 1:
+        server = ShardedServer(aggregator, server_host, port, workers, aggregator_config, **server_kwargs)
+    else:
+        server = Server(aggregator, server_host, port, **server_kwargs)
+
+    # Start the reporting thread.
+    reporter = Reporter(interval, aggregator, target, api_key, use_watchdog, event_chunk_size, server=server)
 
     return reporter, server
 
@@ -678,6 +1182,7 @@ def main(config_path=None):
     opts, args = parser.parse_args()
 
     c = get_config(parse_args=False, cfg_path=config_path)
+    json_codec.configure(c)
     dsd6_enabled = Dogstatsd6.enabled(c)
     in_developer_mode = False
     if not args or args[0] in COMMANDS_START_DOGSTATSD:
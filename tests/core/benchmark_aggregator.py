@@ -2,8 +2,19 @@
 """
 Performance tests for the agent/dogstatsd metrics aggregator.
 """
+# stdlib
+import gc
+import logging
+from time import sleep, time
+
+# 3p
+import psutil
+
+# project
 from aggregator import MetricsAggregator, MetricsBucketAggregator
 
+log = logging.getLogger(__name__)
+
 
 class TestAggregatorPerf(object):
 
@@ -51,6 +62,64 @@ class TestAggregatorPerf(object):
                     ma.set('set.%s' % j, float(i))
             ma.flush()
 
+    def test_metric_packet_parsing_perf(self):
+        ma = MetricsBucketAggregator('my.host')
+        packets = []
+        for j in xrange(self.METRIC_COUNT):
+            packets += [
+                'counter.%s:%s|c' % (j, j),
+                'gauge.%s:%s|g|#tag1,tag2' % (j, j * 1.5),
+                'histogram.%s:%s|h|@0.5|#env:prod,role:db,service:web' % (j, j),
+                'set.%s:%s|s|#tag1' % (j, j),
+            ]
+
+        loops = self.LOOPS_PER_FLUSH * self.FLUSH_COUNT / 10
+        for label, parse in [('generic parser', ma._parse_metric_packet),
+                             ('fast path parser', ma.parse_metric_packet)]:
+            start = time()
+            for _ in xrange(loops):
+                for packet in packets:
+                    parse(packet)
+            elapsed = time() - start
+            log.info("%s: %d packets/s", label, loops * len(packets) / elapsed)
+
+    CONTEXT_COUNT = 100000
+
+    def test_bucket_flush_perf(self):
+        ma = MetricsBucketAggregator('my.host')
+        for i in xrange(self.CONTEXT_COUNT):
+            ma.submit_packets('counter.%s:1|c' % i)
+        sleep(ma.interval)
+        ma.flush()
+
+        # Only a few counters are sampled, the others are reported as 0
+        for i in xrange(self.CONTEXT_COUNT / 100):
+            ma.submit_packets('counter.%s:1|c' % i)
+        sleep(ma.interval)
+
+        start = time()
+        metrics = ma.flush()
+        log.info("flushed %d points in %.3fs", len(metrics), time() - start)
+
+    def test_memory_per_context(self):
+        process = psutil.Process()
+        for metric_type in ('c', 'g', 'h', 's'):
+            gc.collect()
+            rss_before = process.memory_info().rss
+
+            ma = MetricsBucketAggregator('my.host')
+            for i in xrange(self.CONTEXT_COUNT):
+                ma.submit_packets('metric.%s:1|%s|#tag:%s' % (metric_type, metric_type, i))
+
+            # Drop the parsing caches, only the contexts are measured
+            ma.metric_names.clear()
+            ma.tags_by_string.clear()
+            ma.contexts.clear()
+            gc.collect()
+            rss_after = process.memory_info().rss
+            log.info("%s: %d bytes per context", metric_type, (rss_after - rss_before) / self.CONTEXT_COUNT)
+            del ma
+
     def create_event_packet(self, title, text):
         p = "_e{{{title_len},{text_len}}}:{title}|{text}".format(
             title_len=len(title),
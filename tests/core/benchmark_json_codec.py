@@ -0,0 +1,45 @@
+"""
+Performance tests of the JSON codecs on collector payloads.
+"""
+# stdlib
+import os
+from time import time
+
+# project
+from emitter import split_payload
+from utils import json_codec
+
+FIXTURE_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fixtures', 'payloads')
+
+
+class TestJSONCodecPerf(object):
+
+    LOOPS = 200
+
+    def load_payloads(self):
+        codec = json_codec.get_codecs()['json']
+        with open(os.path.join(FIXTURE_PATH, 'legacy_payload.json')) as f:
+            legacy_payload = codec.loads(f.read())
+
+        # What the collector and the emitters serialize
+        payloads = [('collector', legacy_payload)]
+        payloads.extend(zip(('legacy', 'series', 'service checks'), split_payload(dict(legacy_payload))))
+        return payloads
+
+    def test_codecs_perf(self):
+        codecs = json_codec.get_codecs().values() + [json_codec.get_default_codec()]
+        for name, payload in self.load_payloads():
+            for codec in codecs:
+                start = time()
+                for _ in xrange(self.LOOPS):
+                    serialized = codec.dumps(payload)
+                dumps_time = time() - start
+
+                start = time()
+                for _ in xrange(self.LOOPS):
+                    codec.loads(serialized)
+                loads_time = time() - start
+
+                print "%s payload (%d bytes), %s: dumps %.2fms, loads %.2fms" % (
+                    name, len(serialized), codec.name,
+                    1000 * dumps_time / self.LOOPS, 1000 * loads_time / self.LOOPS)
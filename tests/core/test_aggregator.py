@@ -163,6 +163,31 @@ class TestMetricsAggregator(unittest.TestCase):
         nt.assert_equal(fourth['points'][0][1], 16)
         nt.assert_equal(fourth['device_name'], 'floppy')
 
+    def test_context_interning(self):
+        stats = MetricsAggregator('myhost')
+        stats.gauge('my.gauge', 1, tags=['b', 'a', 'a'])
+        stats.gauge('my.gauge', 2, tags=['b', 'a', 'a'])
+        stats.gauge('my.gauge', 3, tags=('a', 'b'))
+        stats.gauge('my.gauge', 4)
+
+        nt.assert_equal(stats.context_cache_stats(), {'hits': 1, 'misses': 3})
+        nt.assert_equal(len(stats.metrics), 2)
+        nt.assert_true(
+            stats.get_context('my.gauge', ['b', 'a', 'a'], 'myhost', None) is
+            stats.get_context('my.gauge', ['b', 'a', 'a'], 'myhost', None)
+        )
+
+        metrics = self.sort_metrics(stats.flush())
+        nt.assert_equal(len(metrics), 2)
+        nt.assert_equal(metrics[0]['tags'], None)
+        nt.assert_equal(metrics[1]['points'][0][1], 3)
+
+    def test_context_tags_iterator(self):
+        # Tags which can only be iterated once keep all of them
+        stats = MetricsAggregator('myhost')
+        context = stats.get_context('my.gauge', (t for t in ['b', 'a', 'a']), 'myhost', None)
+        nt.assert_equal(context, ('my.gauge', ('a', 'b'), 'myhost', None))
+
     def test_tags_gh442(self):
         import stsstatsd
         from aggregator import api_formatter
@@ -565,6 +590,51 @@ class TestMetricsAggregator(unittest.TestCase):
             else:
                 assert False, 'invalid : %s' % packet
 
+    def test_fast_path_parser(self):
+        packets = [
+            'counter:1|c',
+            'counter:-12|c|@0.5',
+            'counter: 3 |c',
+            'counter:+3|c',
+            'gauge:1.5|g|#tag2,tag1',
+            'gauge:1e3|g|@0.1|#tag:with:colons,host:abc',
+            'gauge:inf|g',
+            'sample.rate:1|c|@1.5',
+            'tags.first:1|c|#tag1|@0.5',
+            'empty.tags:1|c|#',
+            'multi.value:1|c:2.5|g|#tag1,tag2:3|h',
+            'set:abc|s',
+            'set: 12|s|#tag1',
+            'distribution:1|d',
+            u'unicode.metric:1|c|#t\xe9g',
+            'unknown.metadata:1|c|x',
+        ]
+
+        stats = MetricsAggregator('myhost')
+        for packet in packets:
+            parsed = stats.parse_metric_packet(packet)
+            nt.assert_equal(parsed, stats._parse_metric_packet(packet), packet)
+            # ints keep their precision
+            nt.assert_equal([type(p[1]) for p in parsed],
+                            [type(p[1]) for p in stats._parse_metric_packet(packet)], packet)
+
+        # Names and tag tuples are shared between packets
+        first = stats.parse_metric_packet('shared.name:1|c|#b,a')[0]
+        second = stats.parse_metric_packet('shared.name:2|c|#b,a')[0]
+        nt.assert_true(first[0] is second[0])
+        nt.assert_true(first[3] is second[3])
+        nt.assert_equal(first[3], ('a', 'b'))
+
+    def test_fast_path_parser_errors(self):
+        stats = MetricsAggregator('myhost')
+        for packet in ['string.value:abc|c', 'empty.value:|c', 'bad.rate:1|c|@abc', 'bad.rate:1|c|@']:
+            nt.assert_raises(Exception, stats.parse_metric_packet, packet)
+
+        # Set values can't contain colons, as with the generic parser
+        for packet in ['users:a:b|s', 'users:a:b|s|#tag1']:
+            nt.assert_raises(Exception, stats._parse_metric_packet, packet)
+            nt.assert_raises(Exception, stats.parse_metric_packet, packet)
+
     @attr(requires='core_integration')
     def test_metrics_expiry(self):
         # Ensure metrics eventually expire and stop submitting.
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 # stdlib
+import pickle
 import random
+import threading
 import time
 import unittest
 
@@ -736,6 +738,68 @@ class TestUnitMetricsBucketAggregator(unittest.TestCase):
         assert gauge['points'][0][1] == 1
 
 
+    def test_datagram_batch_submission(self):
+        stats = MetricsBucketAggregator('myhost', interval=self.interval)
+        stats.submit_datagrams(['counter:1|c', 'counter:1|c\ngauge:1|g', 'bad_packet', 'counter:1|c'])
+        self.assertEqual(stats.count, 4)
+
+        self.sleep_for_interval_length()
+        metrics = self.sort_metrics(stats.flush())
+        self.assertEqual(len(metrics), 2)
+        counter, gauge = metrics
+        self.assertEqual(counter['points'][0][1], 3 / self.interval)
+        self.assertEqual(gauge['points'][0][1], 1)
+
+    def test_shard_merge(self):
+        reporter = MetricsBucketAggregator('myhost', interval=self.interval)
+        shards = [MetricsBucketAggregator('myhost', interval=self.interval) for _ in range(2)]
+
+        self.wait_for_bucket_boundary()
+        shards[0].submit_packets('counter:1|c\nset:a|s\nset:b|s\nhisto:1|h\nhisto:2|h\ngauge:1|g')
+        shards[1].submit_packets('counter:2|c\nset:b|s\nset:c|s\nhisto:3|h\ngauge:2|g')
+        shards[1].submit_packets('_e{5,4}:title|text')
+        for shard in shards:
+            # shards are sent to the reporter process through a pipe
+            reporter.merge_shard(pickle.loads(pickle.dumps(shard.flush_shard(), 2)))
+
+        self.assertEqual(reporter.count, 11)
+        self.assertEqual(len(reporter.flush_events()), 1)
+        self.assertEqual(shards[0].flush_shard()['metric_by_bucket'], {})
+
+        self.sleep_for_interval_length()
+        metrics = self.sort_metrics(reporter.flush())
+        values = dict((m['metric'], m['points'][0][1]) for m in metrics)
+        self.assertEqual(values['counter'], 3 / self.interval)
+        self.assertEqual(values['set'], 3)
+        self.assertEqual(values['histo.count'], 3 / self.interval)
+        self.assertEqual(values['histo.max'], 3)
+        self.assertEqual(values['gauge'], 2)
+
+    def test_flush_while_submitting(self):
+        stats = MetricsBucketAggregator('myhost', interval=self.interval)
+        packet_count = 50000
+        done = threading.Event()
+
+        def submit():
+            for i in xrange(packet_count):
+                stats.submit_packets('counter:1|c\nset:%s|s' % i)
+            done.set()
+
+        # Flush from this thread while the packets are submitted from another
+        metrics = []
+        submitter = threading.Thread(target=submit)
+        submitter.start()
+        while not done.is_set():
+            metrics += stats.flush()
+            time.sleep(0.01)
+        submitter.join()
+
+        self.sleep_for_interval_length()
+        metrics += stats.flush()
+        self.assertEqual(sum(m['points'][0][1] for m in metrics if m['metric'] == 'counter') * self.interval,
+                         packet_count)
+        self.assertEqual(sum(m['points'][0][1] for m in metrics if m['metric'] == 'set'), packet_count)
+
     def test_bad_packets_throw_errors(self):
         packets = [
             'missing.value.and.type',
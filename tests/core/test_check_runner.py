@@ -0,0 +1,177 @@
+# stdlib
+import threading
+import time
+import unittest
+
+# project
+from checks import AgentCheck
+from checks.check_runner import CheckRunner
+from checks.check_status import STATUS_ERROR, STATUS_OK
+from checks.collector import Collector
+from checks.libs.thread_pool import Pool
+
+
+class SleepCheck(AgentCheck):
+    def __init__(self, name, delay, event=None):
+        AgentCheck.__init__(self, name, {}, {}, instances=[{}])
+        self.delay = delay
+        self.event = event
+        self.run_count = 0
+
+    def check(self, instance):
+        self.run_count += 1
+        if self.event is not None:
+            self.event.wait(10)
+        time.sleep(self.delay)
+        self.gauge('sleep.delay', self.delay)
+
+
+class TestCheckRunner(unittest.TestCase):
+    def single_worker_runner(self, timeout):
+        # Checks run off the collector thread, but one at a time
+        runner = CheckRunner(concurrency=2, timeout=timeout)
+        runner._pool = Pool(1, daemon=True)
+        return runner
+
+    def tearDown(self):
+        if getattr(self, 'runner', None) is not None:
+            self.runner.stop()
+
+    def test_sequential(self):
+        checks = [SleepCheck('first', 0), SleepCheck('second', 0)]
+        self.runner = CheckRunner()
+        runs = list(self.runner.run(checks))
+
+        self.assertEqual([run.check for run in runs], checks)
+        for run in runs:
+            self.assertTrue(run.done)
+            self.assertEqual(len(run.metrics), 1)
+            self.assertEqual(len(run.instance_statuses), 1)
+
+    def test_parallel(self):
+        # The slowest check comes first, its results are still yielded first
+        checks = [SleepCheck('check%s' % i, 0.3 - 0.1 * i) for i in xrange(3)]
+        self.runner = CheckRunner(concurrency=3)
+        start = time.time()
+        runs = list(self.runner.run(checks))
+
+        self.assertLess(time.time() - start, 0.55)
+        self.assertEqual([run.check for run in runs], checks)
+        for run in runs:
+            self.assertTrue(run.done)
+            self.assertEqual(run.metrics[0][2], run.check.delay)
+            self.assertGreaterEqual(run.run_time, run.check.delay)
+
+    def test_queue_time(self):
+        checks = [SleepCheck('check%s' % i, 0.1) for i in xrange(2)]
+        # The second check waits for the first one
+        self.runner = self.single_worker_runner(60)
+        runs = list(self.runner.run(checks))
+
+        self.assertLess(runs[0].queue_time, 0.1)
+        self.assertGreaterEqual(runs[1].queue_time, 0.09)
+
+    def test_timeout(self):
+        release = threading.Event()
+        slow = SleepCheck('slow', 0, event=release)
+        fast = SleepCheck('fast', 0)
+        self.runner = CheckRunner(concurrency=2, timeout=0.2)
+
+        runs = list(self.runner.run([slow, fast]))
+        self.assertFalse(runs[0].done)
+        self.assertFalse(runs[0].cancelled)
+        self.assertTrue(self.runner.is_running(slow))
+        self.assertTrue(runs[1].done)
+
+        # The slow check isn't run again while it's still running
+        runs = list(self.runner.run([slow, fast]))
+        self.assertFalse(runs[0].done)
+        self.assertEqual(slow.run_count, 1)
+        self.assertEqual(fast.run_count, 2)
+
+        # Once it completes, its data comes with the next collection run
+        release.set()
+        time.sleep(0.1)
+        self.assertFalse(self.runner.is_running(slow))
+        runs = list(self.runner.run([slow, fast]))
+        self.assertTrue(runs[0].done)
+        self.assertEqual(len(runs[0].metrics), 1)
+        self.assertEqual(slow.run_count, 1)
+
+        runs = list(self.runner.run([slow, fast]))
+        self.assertTrue(runs[0].done)
+        self.assertEqual(slow.run_count, 2)
+
+    def test_timeout_not_due(self):
+        release = threading.Event()
+        slow = SleepCheck('slow', 0, event=release)
+        fast = SleepCheck('fast', 0)
+        self.runner = CheckRunner(concurrency=3, timeout=0.2)
+
+        try:
+            list(self.runner.run([slow, fast]))
+            # The slow check isn't due, its run is still tracked
+            list(self.runner.run([fast], scheduled_checks=[slow, fast]))
+            self.assertTrue(self.runner.is_running(slow))
+            runs = list(self.runner.run([slow], scheduled_checks=[slow, fast]))
+            self.assertFalse(runs[0].done)
+            self.assertEqual(slow.run_count, 1)
+        finally:
+            release.set()
+        time.sleep(0.1)
+        self.assertEqual(slow.run_count, 1)
+
+    def test_timeout_in_queue(self):
+        release = threading.Event()
+        slow = SleepCheck('slow', 0, event=release)
+        queued = SleepCheck('queued', 0)
+        self.runner = self.single_worker_runner(0.2)
+
+        runs = list(self.runner.run([slow, queued]))
+        self.assertFalse(runs[1].done)
+        self.assertTrue(runs[1].cancelled)
+        self.assertFalse(self.runner.is_running(queued))
+
+        # The cancelled run is skipped by the worker
+        release.set()
+        time.sleep(0.1)
+        self.assertEqual(queued.run_count, 0)
+
+
+class TestCollectorCheckRunner(unittest.TestCase):
+    def test_collector_timeout(self):
+        agentConfig = {
+            'api_key': 'test_apikey',
+            'check_timings': True,
+            'collect_ec2_tags': False,
+            'collect_orchestrator_tags': False,
+            'collect_instance_metadata': False,
+            'create_dd_check_tags': False,
+            'version': 'test',
+            'tags': '',
+            'check_concurrency': '2',
+            'check_timeout': '0.2',
+        }
+        release = threading.Event()
+        slow = SleepCheck('slow', 0, event=release)
+        fast = SleepCheck('fast', 0)
+        collector = Collector(agentConfig, [], {}, 'foo')
+        try:
+            payload, _ = collector.run({
+                'initialized_checks': [slow, fast],
+                'init_failed_checks': {}
+            })
+        finally:
+            release.set()
+            collector._check_runner._pending[slow].wait(1)
+            collector.stop()
+
+        self.assertEqual([m[0] for m in payload['metrics'] if m[0].startswith('sleep.')], ['sleep.delay'])
+        timing_tags = [m[3]['tags'] for m in payload['metrics']
+                       if m[0] == 'stackstate.agent.check_queue_time']
+        self.assertEqual(timing_tags, [['check:fast']])
+
+        status_checks = dict((sc['tags'][0], sc['status']) for sc in payload['service_checks']
+                             if sc['check'] == 'stackstate.agent.check_status')
+        self.assertEqual(status_checks, {'check:slow': AgentCheck.CRITICAL, 'check:fast': AgentCheck.OK})
+        self.assertEqual(payload['service_checks'][0]['check'], 'stackstate.agent.check_status')
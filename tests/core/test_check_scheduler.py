@@ -0,0 +1,130 @@
+# stdlib
+import unittest
+
+# 3p
+import mock
+
+# project
+from checks import AgentCheck
+from checks.check_scheduler import CheckScheduler
+from checks.collector import Collector
+
+
+class CountCheck(AgentCheck):
+    def __init__(self, name, instances, init_config=None):
+        AgentCheck.__init__(self, name, init_config or {}, {'checksd_hostname': 'foo'}, instances=instances)
+        self.runs = []
+
+    def check(self, instance):
+        self.runs.append(instance['name'])
+        self.gauge('count.run', 1, tags=['instance:%s' % instance['name']])
+
+
+class TestCheckScheduler(unittest.TestCase):
+    def test_intervals(self):
+        fast = CountCheck('fast', [{'name': 'a', 'min_collection_interval': 10},
+                                   {'name': 'b', 'min_collection_interval': 5}])
+        slow = CountCheck('slow', [{'name': 'c'}], init_config={'min_collection_interval': 300})
+        default = CountCheck('default', [{'name': 'd', 'collection_jitter': 0}])
+        scheduler = CheckScheduler(15)
+        self.assertEqual(scheduler.get_interval(fast, fast.instances[1]), 5)
+        self.assertEqual(scheduler.get_interval(slow, slow.instances[0]), 300)
+        self.assertEqual(scheduler.get_interval(default, default.instances[0]), 15)
+
+        scheduler.update([fast, slow, default], 1000)
+        self.assertEqual(len(scheduler), 4)
+        # The first runs are delayed by a jitter of up to 10% of the interval
+        self.assertLessEqual(scheduler.next_run_time(), 1030)
+        self.assertEqual(scheduler.pop_due(999), {})
+
+        runs = dict((check.name, []) for check in [fast, slow, default])
+        for now in xrange(1000, 1600):
+            for check, instance_ids in scheduler.pop_due(now).iteritems():
+                runs[check.name].append((now, instance_ids))
+            self.assertGreater(scheduler.next_run_time(), now)
+
+        self.assertEqual(len([r for r in runs['fast'] if 1 in r[1]]), 120)
+        self.assertEqual(len([r for r in runs['fast'] if 0 in r[1]]), 60)
+        self.assertEqual(len(runs['slow']), 2)
+        self.assertEqual(runs['default'], [(now, [0]) for now in xrange(1000, 1600, 15)])
+
+    def test_late_run(self):
+        check = CountCheck('check', [{'name': 'a', 'min_collection_interval': 10, 'collection_jitter': 0}])
+        scheduler = CheckScheduler(15)
+        scheduler.update([check], 0)
+        self.assertEqual(scheduler.pop_due(0), {check: [0]})
+        # The runs missed aren't made up for
+        self.assertEqual(scheduler.pop_due(35), {check: [0]})
+        self.assertEqual(scheduler.next_run_time(), 45)
+
+    def test_update(self):
+        first = CountCheck('first', [{'name': 'a', 'collection_jitter': 0}])
+        second = CountCheck('second', [{'name': 'b', 'collection_jitter': 0}])
+        scheduler = CheckScheduler(15)
+        scheduler.update([first, second], 0)
+        self.assertEqual(len(scheduler.pop_due(0)), 2)
+
+        # e.g. after a configuration reload
+        scheduler.update([second], 10)
+        self.assertEqual(len(scheduler), 1)
+        self.assertEqual(scheduler.pop_due(15), {second: [0]})
+        for now in xrange(15, 1000, 15):
+            scheduler.update([second], now)
+            scheduler.pop_due(now)
+        self.assertLessEqual(len(scheduler._heap), 3)
+
+    def test_agent_check_instance_ids(self):
+        check = CountCheck('check', [{'name': 'a', 'min_collection_interval': 60}, {'name': 'b'}])
+        statuses = check.run([1])
+        self.assertEqual(check.runs, ['b'])
+        self.assertEqual([s.instance_id for s in statuses], [1])
+
+        # The scheduler takes over min_collection_interval
+        check.run([0])
+        check.run([0])
+        self.assertEqual(check.runs, ['b', 'a', 'a'])
+        check.run()
+        self.assertEqual(check.runs, ['b', 'a', 'a', 'b'])
+
+
+class TestCollectorScheduling(unittest.TestCase):
+    def test_collector(self):
+        agentConfig = {
+            'api_key': 'test_apikey',
+            'collect_ec2_tags': False,
+            'collect_orchestrator_tags': False,
+            'collect_instance_metadata': False,
+            'create_dd_check_tags': False,
+            'version': 'test',
+            'tags': '',
+            'check_freq': 15,
+            'check_scheduler': 'yes',
+        }
+        fast = CountCheck('fast', [{'name': 'a', 'min_collection_interval': 5, 'collection_jitter': 0}])
+        slow = CountCheck('slow', [{'name': 'b', 'collection_jitter': 0}])
+        checksd = {'initialized_checks': [fast, slow], 'init_failed_checks': {}}
+        collector = Collector(agentConfig, [], {}, 'foo')
+        self.assertEqual(collector.get_next_run_delay(), 0)
+
+        with mock.patch.object(collector, '_run_system_checks') as run_system_checks:
+            with mock.patch('checks.collector.time.time', return_value=1000):
+                payload, _ = collector.run(checksd)
+                self.assertEqual(fast.runs, ['a'])
+                self.assertEqual(slow.runs, ['b'])
+                self.assertEqual(run_system_checks.call_count, 1)
+                self.assertEqual(collector.get_next_run_delay(), 5)
+                self.assertEqual(collector.run(checksd), (None, False))
+
+            with mock.patch('checks.collector.time.time', return_value=1005):
+                payload, _ = collector.run(checksd)
+                self.assertEqual(fast.runs, ['a', 'a'])
+                self.assertEqual(slow.runs, ['b'])
+                self.assertEqual(run_system_checks.call_count, 1)
+                self.assertEqual(len([m for m in payload['metrics'] if m[0] == 'count.run']), 1)
+
+            with mock.patch('checks.collector.time.time', return_value=1015):
+                collector.run(checksd)
+                self.assertEqual(fast.runs, ['a', 'a', 'a'])
+                self.assertEqual(slow.runs, ['b', 'b'])
+                self.assertEqual(run_system_checks.call_count, 2)
+        collector.stop()
@@ -603,6 +603,39 @@ class TestCollectionInterval(unittest.TestCase):
         assertTopology(emitted_topologies[2], check2, 4)
         assertTopology(emitted_topologies[3], check2, 3)
 
+    def test_topology_batches(self):
+        agentConfig = {
+            'api_key': 'test_apikey',
+            'collect_ec2_tags': False,
+            'collect_orchestrator_tags': False,
+            'collect_instance_metadata': False,
+            'create_dd_check_tags': False,
+            'version': 'test',
+            'tags': '',
+            'topology_batch_size': '2',
+        }
+        check = DummyTopologyCheck(1, 'dummy_topology_check', {}, agentConfig,
+                                   instances=[{"instance_id": 1, "pass": True}], snapshot=True)
+
+        emitted_topologies = []
+
+        def mock_emitter(message, log, agentConfig, endpoint):
+            emitted_topologies.append(message['topologies'])
+
+        c = Collector(agentConfig, [mock_emitter], {}, get_hostname(agentConfig))
+        payload, _ = c.run({
+            'initialized_checks': [check],
+            'init_failed_checks': {}
+        })
+
+        # The batch is emitted while the check runs, the payload ends the snapshot
+        self.assertEqual(len(emitted_topologies), 2)
+        batch = emitted_topologies[0][0]
+        self.assertEqual(batch['components'], check.expected_components(1))
+        self.assertEqual((batch['start_snapshot'], batch['stop_snapshot']), (True, False))
+        self.assertEqual(payload['topologies'][0]['relations'], check.expected_relations())
+        self.assertEqual(payload['topologies'][0]['stop_snapshot'], True)
+
     def test_apptags(self):
         '''
         Tests that the app tags are sent if specified so
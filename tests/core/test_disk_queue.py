@@ -0,0 +1,100 @@
+# stdlib
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+# project
+from utils.disk_queue import DiskQueue, RECORD_HEADER
+
+
+class TestDiskQueue(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def segments(self):
+        return sorted(name for name in os.listdir(self.path) if name.endswith('.seg'))
+
+    def test_fifo(self):
+        queue = DiskQueue(self.path, 1024 * 1024, segment_size=100)
+        records = ['record %s' % i for i in xrange(50)]
+        for record in records:
+            queue.append(record)
+        self.assertEqual(len(queue), 50)
+        self.assertGreater(len(self.segments()), 1)
+
+        # records are popped in order, as many as fit in the given size
+        self.assertEqual(queue.pop(len(records[0]) * 3), records[:3])
+        self.assertEqual(queue.pop(1), records[3:4])
+        self.assertEqual(queue.pop(1024 * 1024), records[4:])
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(queue.size, 0)
+        self.assertEqual(queue.pop(1024), [])
+        # read segments are removed
+        self.assertEqual(self.segments(), [])
+
+        queue.append('again')
+        self.assertEqual(queue.pop(1024), ['again'])
+
+    def test_persistence(self):
+        queue = DiskQueue(self.path, 1024 * 1024, segment_size=100)
+        for i in xrange(20):
+            queue.append('record %s' % i)
+        self.assertEqual(queue.pop(1), ['record 0'])
+        queue.close()
+
+        queue = DiskQueue(self.path, 1024 * 1024, segment_size=100)
+        self.assertEqual(len(queue), 19)
+        queue.prepend(['head 0', 'head 1'])
+        queue.append('record 20')
+        queue.close()
+
+        queue = DiskQueue(self.path, 1024 * 1024, segment_size=100)
+        self.assertEqual(queue.pop(1024 * 1024),
+                         ['head 0', 'head 1'] + ['record %s' % i for i in xrange(1, 21)])
+
+    def test_incomplete_record(self):
+        queue = DiskQueue(self.path, 1024 * 1024)
+        queue.append('complete')
+        queue.append('incomplete')
+        queue.close()
+
+        # the process died while writing the last record
+        segment = os.path.join(self.path, self.segments()[0])
+        with open(segment, 'r+b') as f:
+            f.truncate(os.path.getsize(segment) - 3)
+
+        queue = DiskQueue(self.path, 1024 * 1024)
+        self.assertEqual(len(queue), 1)
+        self.assertEqual(queue.pop(1024), ['complete'])
+
+    def test_corrupted_record(self):
+        queue = DiskQueue(self.path, 1024 * 1024)
+        for record in ('first', 'second', 'third'):
+            queue.append(record)
+        queue.close()
+
+        segment = os.path.join(self.path, self.segments()[0])
+        with open(segment, 'r+b') as f:
+            f.seek(RECORD_HEADER.size * 2 + len('first'))
+            f.write('X')
+
+        queue = DiskQueue(self.path, 1024 * 1024)
+        self.assertEqual(queue.pop(1024), ['first', 'third'])
+        self.assertEqual(queue.dropped_count, 1)
+
+    def test_max_size(self):
+        queue = DiskQueue(self.path, 1000)
+        for i in xrange(100):
+            queue.append('%05d' % i + 'x' * 45)
+
+        self.assertLessEqual(queue.size, 1000)
+        self.assertEqual(len(queue) + queue.dropped_count, 100)
+        # the oldest records are dropped
+        records = queue.pop(1000)
+        self.assertEqual(len(records), 100 - queue.dropped_count)
+        self.assertTrue(records[-1].startswith('00099'))
+        self.assertEqual(records, sorted(records))
@@ -1,8 +1,12 @@
 # stdlib
 from unittest import TestCase
+import errno
 import os
+import shutil
 import socket
+import tempfile
 import threading
+import time
 import Queue
 from collections import defaultdict
 
@@ -13,9 +17,12 @@ import unittest
 # project
 from stsstatsd import mapto_v6, get_socket_address
 from stsstatsd import (
+    add_origin_tags,
+    get_origin_tags,
     Server,
     init5,
-    init6
+    init6,
+    merge_receive_stats
 )
 from utils.net import IPV6_V6ONLY, IPPROTO_IPV6
 
@@ -75,6 +82,129 @@ class TestFunctions(TestCase):
         _, kwargs = s.call_args
         self.assertEqual(kwargs['so_rcvbuf'], '1024')
 
+    @mock.patch('stsstatsd.Server')
+    def test_init_with_recv_batch_size(self, s):
+        cfg = defaultdict(str)
+        cfg['use_dogstatsd'] = True
+        cfg['statsd_recv_batch_size'] = '64'
+
+        reporter, _ = init5(cfg)
+
+        s.assert_called_once()
+        _, kwargs = s.call_args
+        self.assertEqual(kwargs['recv_batch_size'], '64')
+        self.assertEqual(reporter.server, s.return_value)
+
+    @mock.patch('stsstatsd.Platform.is_linux', return_value=True)
+    @mock.patch('stsstatsd.ShardedServer')
+    @mock.patch('stsstatsd.Server')
+    def test_init_with_workers(self, s, sharded, _):
+        cfg = defaultdict(str)
+        cfg['use_dogstatsd'] = True
+        cfg['statsd_workers'] = '4'
+
+        reporter, server = init5(cfg)
+
+        self.assertFalse(s.called)
+        sharded.assert_called_once()
+        args, kwargs = sharded.call_args
+        self.assertEqual(args[3], 4)
+        # workers aggregate with the same bucket size as the reporter
+        self.assertEqual(args[4]['interval'], args[0].interval)
+        self.assertNotIn('formatter', args[4])
+        self.assertEqual(reporter.server, server)
+
+    @mock.patch('stsstatsd.Platform.is_linux', return_value=False)
+    @mock.patch('stsstatsd.ShardedServer')
+    @mock.patch('stsstatsd.Server')
+    def test_init_with_workers_unsupported(self, s, sharded, _):
+        cfg = defaultdict(str)
+        cfg['use_dogstatsd'] = True
+        cfg['statsd_workers'] = '4'
+
+        init5(cfg)
+
+        self.assertFalse(sharded.called)
+        s.assert_called_once()
+
+    def test_merge_receive_stats(self):
+        stats = merge_receive_stats([
+            {'datagram.count': 10, 'datagrams_per_wakeup': 5.0, 'max_datagrams_per_wakeup': 8, 'socket_drops': 2},
+            {'datagram.count': 30, 'datagrams_per_wakeup': 10.0, 'max_datagrams_per_wakeup': 12, 'socket_drops': None},
+            {'datagram.count': 0, 'datagrams_per_wakeup': 0, 'max_datagrams_per_wakeup': 0, 'socket_drops': 1},
+        ])
+        self.assertEqual(stats['datagram.count'], 40)
+        self.assertEqual(stats['datagrams_per_wakeup'], 8)
+        self.assertEqual(stats['max_datagrams_per_wakeup'], 12)
+        self.assertEqual(stats['socket_drops'], 3)
+
+        stats = merge_receive_stats([])
+        self.assertEqual(stats['datagram.count'], 0)
+        self.assertIsNone(stats['socket_drops'])
+
+    @mock.patch('stsstatsd.get_udp_socket_drops')
+    @mock.patch('stsstatsd.get_socket_address')
+    @mock.patch('stsstatsd.select')
+    @mock.patch('stsstatsd.socket.socket')
+    def test_batched_receive(self, sock_cls, select, get_socket_address, get_udp_socket_drops):
+        datagrams = ['a:1|c', 'b:2|c\nc:3|g', 'd:4|h']
+        sock = sock_cls.return_value
+        sock.recv.side_effect = datagrams + [socket.error(errno.EAGAIN, 'Resource temporarily unavailable')]
+        select.select.side_effect = [([sock], [], []), KeyboardInterrupt]
+        select.error = Exception
+        get_udp_socket_drops.side_effect = [10, 15]
+
+        aggregator = mock.MagicMock()
+        server = Server(aggregator, '127.0.0.1', '8225', recv_batch_size=10)
+        server.start()
+
+        # every queued datagram is handed to the aggregator in a single call
+        aggregator.submit_datagrams.assert_called_once_with(datagrams)
+        self.assertFalse(aggregator.submit_packets.called)
+
+        stats = server.flush_receive_stats()
+        self.assertEqual(stats['datagram.count'], 3)
+        self.assertEqual(stats['datagrams_per_wakeup'], 3)
+        self.assertEqual(stats['max_datagrams_per_wakeup'], 3)
+        self.assertEqual(stats['socket_drops'], 5)
+
+        # counters are reset after each flush
+        get_udp_socket_drops.side_effect = None
+        get_udp_socket_drops.return_value = None
+        stats = server.flush_receive_stats()
+        self.assertEqual(stats['datagram.count'], 0)
+        self.assertEqual(stats['datagrams_per_wakeup'], 0)
+        self.assertIsNone(stats['socket_drops'])
+
+    def test_add_origin_tags(self):
+        packet = 'a:1|c\nb:2|g|#env:prod\n_e{1,1}:t|t\n_sc|check|0'
+        self.assertEqual(
+            add_origin_tags(packet, 'container_id:abc'),
+            'a:1|c|#container_id:abc\nb:2|g|#env:prod,container_id:abc\n_e{1,1}:t|t\n_sc|check|0'
+        )
+        # The tags are extended where they are, the fields after them are kept
+        self.assertEqual(
+            add_origin_tags('a:1|c|#env:prod|@0.5\nb:2|c|@0.5|#env:prod|c:123', 'container_id:abc'),
+            'a:1|c|#env:prod,container_id:abc|@0.5\nb:2|c|@0.5|#env:prod,container_id:abc|c:123'
+        )
+
+    def test_get_origin_tags(self):
+        procfs_path = tempfile.mkdtemp()
+        try:
+            container_id = 'a' * 64
+            for pid, cgroup in [(1, '1:name=systemd:/init.scope\n'),
+                                (2, '1:cpu:/kubepods/burstable/pod1/%s\n' % container_id)]:
+                os.mkdir(os.path.join(procfs_path, str(pid)))
+                with open(os.path.join(procfs_path, str(pid), 'cgroup'), 'w') as f:
+                    f.write(cgroup)
+
+            self.assertIsNone(get_origin_tags(None, procfs_path))
+            self.assertIsNone(get_origin_tags((1, 0, 0), procfs_path))
+            self.assertIsNone(get_origin_tags((3, 0, 0), procfs_path))
+            self.assertEqual(get_origin_tags((2, 0, 0), procfs_path), 'container_id:%s' % container_id)
+        finally:
+            shutil.rmtree(procfs_path)
+
 
 @unittest.skip("StackState: These don't work on travis due to absence of ipv6. Skip for now because we do not use dogstatsd.")
 class TestServer(TestCase):
@@ -157,3 +287,62 @@ class TestServer(TestCase):
         client_sock.sendto('msg6', ('::1', 12345))
         msg = results.get(True, 1)
         self.assertEqual(msg[0], 'msg6')
+
+
+class TestUnixSocketServer(TestCase):
+    def _start_unix_server(self, socket_type, **kwargs):
+        socket_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, socket_dir)
+        received = Queue.Queue()
+        aggregator = mock.MagicMock()
+        aggregator.submit_datagrams.side_effect = received.put
+
+        server = Server(aggregator, '127.0.0.1', '0', socket_path=os.path.join(socket_dir, 'statsd.sock'),
+                        socket_type=socket_type, **kwargs)
+        thread = threading.Thread(target=server.start)
+        thread.daemon = True
+        with mock.patch('stsstatsd.UDP_SOCKET_TIMEOUT', 0.1):
+            thread.start()
+            for _ in xrange(50):
+                if server.running:
+                    break
+                time.sleep(0.1)
+
+        def stop():
+            server.stop()
+            thread.join(5)
+        self.addCleanup(stop)
+        return server, received
+
+    def test_unix_socket_dgram(self):
+        server, received = self._start_unix_server('dgram')
+        self.assertEqual(os.stat(server.socket_path).st_mode & 0777, 0722)
+
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        client.sendto('a:1|c\nb:2|g', server.socket_path)
+        self.assertEqual(received.get(True, 2), ['a:1|c\nb:2|g'])
+        self.assertEqual(server.flush_receive_stats()['datagram.count'], 1)
+
+        server.stop()
+        for _ in xrange(50):
+            if not os.path.exists(server.socket_path):
+                break
+            time.sleep(0.1)
+        self.assertFalse(os.path.exists(server.socket_path))
+
+    @mock.patch('stsstatsd.get_origin_tags', return_value='container_id:abc')
+    def test_unix_socket_stream(self, get_origin_tags):
+        server, received = self._start_unix_server('stream', origin_detection=True)
+
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(server.socket_path)
+        # lines are only submitted once complete
+        client.sendall('a:1|c\nb:2|')
+        self.assertEqual(received.get(True, 2), ['a:1|c|#container_id:abc'])
+        client.sendall('g\nc:3|c')
+        self.assertEqual(received.get(True, 2), ['b:2|g|#container_id:abc'])
+        client.close()
+        self.assertEqual(received.get(True, 2), ['c:3|c|#container_id:abc'])
+
+        credentials = get_origin_tags.call_args[0][0]
+        self.assertEqual(credentials[0], os.getpid())
@@ -3,9 +3,12 @@
 import mock
 import unittest
 import simplejson as json
+import zlib
 
 # project
+from checks.collector import Collector
 from emitter import (
+    http_emitter,
     remove_control_chars,
     remove_undecodable_chars,
     sanitize_payload,
@@ -103,12 +106,10 @@ class TestEmitter(unittest.TestCase):
             self.assertEqual(good, remove_undecodable_chars(bad, log))
             self.assertEqual(log_called, log.warning.called)
 
-    # Make compression a no-op for the tests
-    @mock.patch('zlib.compress', side_effect=lambda x: x)
-    def test_metrics_payload_chunks(self, compress_mock):
+    def test_metrics_payload_chunks(self):
         log = mock.Mock()
         nb_series = 10000
-        max_compressed_size = 1 << 10  # 1KB, well below the original size of our payload of 10000 metrics
+        max_compressed_size = 16 << 10  # 16KB, well below the original size of our payload of 10000 metrics
 
         metrics_payload = {"series": [
             {
@@ -118,19 +119,97 @@ class TestEmitter(unittest.TestCase):
             } for i in xrange(nb_series)
         ]}
 
-        compressed_payloads = serialize_and_compress_metrics_payload(metrics_payload, max_compressed_size, 0, log)
+        serialized_series = []
+        json_dumps = json.dumps
+
+        def dumps(obj):
+            serialized_series.extend(obj)
+            return json_dumps(obj)
+
+        with mock.patch('utils.json_codec.dumps', side_effect=dumps):
+            compressed_payloads = serialize_and_compress_metrics_payload(metrics_payload, max_compressed_size, 0, log)
+        # each serie is serialized once
+        self.assertEqual(len(serialized_series), nb_series)
 
-        # check that all the payloads are smaller than the max size
+        # check that all the payloads are smaller than the max size, and not much smaller
         for compressed_payload in compressed_payloads:
             self.assertLess(len(compressed_payload), max_compressed_size)
+        for compressed_payload in compressed_payloads[:-1]:
+            self.assertGreater(len(compressed_payload), max_compressed_size * 3 / 4)
 
         # check that all the series are there (correct number + correct metric names)
         series_after = []
         for compressed_payload in compressed_payloads:
-            series_after.extend(json.loads(compressed_payload)["series"])
+            series_after.extend(json.loads(zlib.decompress(compressed_payload))["series"])
 
         self.assertEqual(nb_series, len(series_after))
 
         metrics_sorted = sorted([int(metric["metric"]) for metric in series_after])
         for i, metric_name in enumerate(metrics_sorted):
             self.assertEqual(i, metric_name)
+
+    def test_metrics_payload_too_big_serie(self):
+        log = mock.Mock()
+        max_compressed_size = 1 << 10
+        big_serie = {"metric": "big", "points": [(i, i * 7919 % 10007) for i in xrange(1000)]}
+        metrics_payload = {"series": [{"metric": "small", "points": [(0, 0)]}, big_serie,
+                                      {"metric": "small", "points": [(1, 1)]}]}
+
+        compressed_payloads = serialize_and_compress_metrics_payload(metrics_payload, max_compressed_size, 0, log)
+
+        # the serie too big to be sent is dropped, the others are kept
+        series_after = []
+        for compressed_payload in compressed_payloads:
+            self.assertLess(len(compressed_payload), max_compressed_size)
+            series_after.extend(json.loads(zlib.decompress(compressed_payload))["series"])
+        self.assertEqual([serie["metric"] for serie in series_after], ["small", "small"])
+        self.assertTrue(log.error.called)
+
+        # an empty payload is still sent
+        compressed_payloads = serialize_and_compress_metrics_payload({"series": []}, max_compressed_size, 0, log)
+        self.assertEqual([json.loads(zlib.decompress(p)) for p in compressed_payloads], [{"series": []}])
+
+    def test_http_emitter_topology_only(self):
+        agentConfig = {'dd_url': 'http://localhost:17123'}
+
+        def emit(**payload):
+            message = dict(apiKey='key', metrics=[], service_checks=[], topologies=[], **payload)
+            with mock.patch('emitter.post_payload', return_value=True) as post_payload:
+                http_emitter(message, mock.Mock(), agentConfig, '')
+            # The message is left as it is for the next emitters
+            self.assertEqual(message, dict(apiKey='key', metrics=[], service_checks=[], topologies=[], **payload))
+            self.assertNotIn('topologyOnly', post_payload.call_args_list[0][0][1])
+            return [call[0][0].split('?')[0] for call in post_payload.call_args_list]
+
+        # empty metrics and check runs are still posted
+        self.assertEqual(emit(), ['http://localhost:17123/intake/', 'http://localhost:17123/api/v1/series',
+                                  'http://localhost:17123/api/v1/check_run'])
+        # but not for the batches of topology emitted while a check runs
+        self.assertEqual(emit(topologyOnly=True), ['http://localhost:17123/intake/'])
+
+    def test_topology_batch_failure(self):
+        agentConfig = {
+            'api_key': 'test_apikey',
+            'dd_url': 'http://localhost:17123',
+            'collect_ec2_tags': False,
+            'collect_orchestrator_tags': False,
+            'collect_instance_metadata': False,
+            'create_dd_check_tags': False,
+            'version': 'test',
+            'tags': '',
+        }
+        collector = Collector(agentConfig, [http_emitter], {}, 'foo')
+        topologies = [{"instance": {"type": "test"}, "components": [], "relations": [], "start_snapshot": True}]
+        try:
+            with mock.patch('emitter.requests.post') as post:
+                post.return_value.status_code = 200
+                self.assertTrue(collector._emit_topology(topologies))
+                self.assertEqual(post.call_count, 1)
+
+            # A batch which isn't sent is reported, for the check to abort its snapshot
+            with mock.patch('emitter.requests.post', side_effect=Exception("connection refused")):
+                self.assertFalse(collector._emit_topology(topologies))
+            with mock.patch('emitter.serialize_and_compress_legacy_payload', side_effect=RuntimeError):
+                self.assertFalse(collector._emit_topology(topologies))
+        finally:
+            collector.stop()
@@ -1,9 +1,22 @@
 # stdlib
+import random
 import unittest
 
 # project
-from aggregator import Histogram, MetricsAggregator
-from config import get_histogram_aggregates, get_histogram_percentiles
+from aggregator import (
+    CompactHistogram,
+    CompactSet,
+    Histogram,
+    MetricsAggregator,
+    select_ranks,
+    SketchHistogram,
+)
+from config import (
+    get_histogram_aggregates,
+    get_histogram_backend,
+    get_histogram_percentiles,
+    get_histogram_relative_accuracy,
+)
 
 class TestHistogram(unittest.TestCase):
     def test_default(self):
@@ -152,3 +165,103 @@ class TestHistogram(unittest.TestCase):
         self.assertEquals(value_by_type['max'], 19, value_by_type)
         self.assertEquals(value_by_type['sum'], 190, value_by_type)
         self.assertEquals(value_by_type['95percentile'], 18, value_by_type)
+
+    def test_sketch_backend(self):
+        stats = MetricsAggregator(
+            'myhost',
+            histogram_aggregates=get_histogram_aggregates('min, max, median, avg, sum, count'),
+            histogram_percentiles=get_histogram_percentiles('0.5, 0.95, 0.99'),
+            histogram_backend=get_histogram_backend('sketch'),
+            histogram_relative_accuracy=get_histogram_relative_accuracy('0.01')
+        )
+
+        for i in xrange(1, 10001):
+            stats.submit_packets('myhistogram:{0}|h'.format(i))
+        stats.submit_packets('myhistogram:1|h|@0.5')
+
+        metric = stats.metrics.values()[0]
+        self.assertIsInstance(metric, SketchHistogram)
+        # memory doesn't grow with the number of samples
+        self.assertLess(len(metric.sketch), 500)
+
+        value_by_type = {}
+        for k in stats.flush():
+            value_by_type[k['metric'][len('myhistogram')+1:]] = k['points'][0][1]
+
+        # exact aggregates
+        self.assertEquals(value_by_type['min'], 1, value_by_type)
+        self.assertEquals(value_by_type['max'], 10000, value_by_type)
+        self.assertEquals(value_by_type['sum'], 50005001, value_by_type)
+        self.assertEquals(value_by_type['count'], 10002, value_by_type)
+        self.assertAlmostEqual(value_by_type['avg'], 50005001 / 10001.0)
+
+        # approximated quantiles, within the relative accuracy
+        for name, expected in [('median', 5000), ('50percentile', 5000),
+                               ('95percentile', 9500), ('99percentile', 9900)]:
+            self.assertLessEqual(abs(value_by_type[name] - expected), 0.01 * expected + 1, (name, value_by_type))
+
+        self.assertEquals(stats.flush(), [])
+
+    def test_sketch_backend_bounded_by_samples(self):
+        stats = MetricsAggregator('myhost', histogram_backend='sketch')
+        stats.submit_packets('myhistogram:3.3|h')
+
+        value_by_type = {}
+        for k in stats.flush():
+            value_by_type[k['metric'][len('myhistogram')+1:]] = k['points'][0][1]
+
+        self.assertEquals(value_by_type['max'], 3.3)
+        self.assertEquals(value_by_type['median'], 3.3)
+        self.assertEquals(value_by_type['95percentile'], 3.3)
+
+    def test_histogram_backend_config(self):
+        self.assertEquals(get_histogram_backend(' Sketch'), 'sketch')
+        self.assertIsNone(get_histogram_backend('tdigest'))
+        self.assertIsNone(get_histogram_relative_accuracy('1.5'))
+        self.assertIsNone(get_histogram_relative_accuracy('foo'))
+        self.assertIs(MetricsAggregator('myhost', histogram_backend='unknown').histogram_class, Histogram)
+
+    def test_select_ranks(self):
+        values = [random.choice([random.random(), 1.0, 2.0]) for _ in xrange(5000)]
+        ordered = sorted(values)
+        ranks = [0, 1, 2499, 2500, 4750, 4999, 4999]
+        self.assertEquals(select_ranks(values, ranks), dict((r, ordered[r]) for r in ranks))
+        self.assertEquals(select_ranks([3.0], [0]), {0: 3.0})
+
+    def test_compact_storage(self):
+        aggregates = get_histogram_aggregates('min, max, median, avg, sum, count')
+        percentiles = get_histogram_percentiles('0.5, 0.75, 0.95, 0.99')
+        exact = MetricsAggregator('myhost', histogram_aggregates=aggregates, histogram_percentiles=percentiles)
+        compact = MetricsAggregator('myhost', histogram_aggregates=aggregates, histogram_percentiles=percentiles,
+                                    compact_storage=True)
+
+        for count in (1, 2, 3, 1000):
+            for _ in xrange(count):
+                packet = 'myhistogram:{0}|h'.format(random.randint(-100, 1000))
+                exact.submit_packets(packet)
+                compact.submit_packets(packet)
+            exact.submit_packets('myset:foo|s')
+            compact.submit_packets('myset:foo|s')
+            compact.submit_packets('myset:{0}|s'.format(count))
+
+            self.assertIsInstance(compact.metrics.values()[0], (CompactHistogram, CompactSet))
+            compact_metrics = dict((m['metric'], m['points'][0][1]) for m in compact.flush())
+            exact_metrics = dict((m['metric'], m['points'][0][1]) for m in exact.flush())
+
+            self.assertEquals(compact_metrics.pop('myset'), 2)
+            self.assertEquals(exact_metrics.pop('myset'), 1)
+            self.assertEquals(compact_metrics, exact_metrics)
+
+        self.assertEquals(compact.flush(), [])
+
+    def test_compact_set(self):
+        compact_set = CompactSet(None, 'myset', None, 'myhost', None)
+        for value in ['12', '12', '012', '0', 'foo', 'foo', '-3', 'a' * 1000, 'b' * 1000]:
+            compact_set.sample(value, 1)
+        # Integer members are kept as integers, the others as they are
+        self.assertEquals(compact_set.values, set([12, '012', 0, 'foo', '-3', 'a' * 1000, 'b' * 1000]))
+
+    def test_compact_storage_keeps_sketch_backend(self):
+        stats = MetricsAggregator('myhost', histogram_backend='sketch', compact_storage=True)
+        self.assertIs(stats.histogram_class, SketchHistogram)
+        self.assertIs(stats.set_class, CompactSet)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# stdlib
+from collections import namedtuple
+from decimal import Decimal
+import os
+import unittest
+
+# 3p
+import mock
+import simplejson
+
+# project
+from emitter import serialize_payload
+from utils import json_codec
+
+FIXTURE_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fixtures', 'payloads')
+
+
+class TestJSONCodec(unittest.TestCase):
+    PAYLOAD = {
+        "series": [
+            {"metric": "system.load.1", "points": [(1500000000, 0.1), (1500000010, 1e-12)],
+             "tags": [u"role:☢", "env:prod"], "host": "my.host"},
+        ],
+        "count": 2 ** 40,
+        "empty": None,
+    }
+
+    def test_codecs(self):
+        codecs = json_codec.get_codecs()
+        self.assertIn('json', codecs)
+        self.assertIn('simplejson', codecs)
+        codecs['default'] = json_codec.get_default_codec()
+
+        expected = {
+            "series": [
+                {"metric": "system.load.1", "points": [[1500000000, 0.1], [1500000010, 1e-12]],
+                 "tags": [u"role:☢", "env:prod"], "host": "my.host"},
+            ],
+            "count": 2 ** 40,
+            "empty": None,
+        }
+        for codec in codecs.itervalues():
+            self.assertEqual(codec.loads(codec.dumps(self.PAYLOAD)), expected, codec)
+            # Payloads are readable by the other codecs
+            self.assertEqual(codecs['json'].loads(codec.dumps(self.PAYLOAD)), expected, codec)
+
+    def test_undecodable_strings(self):
+        codecs = json_codec.get_codecs()
+        codecs['default'] = json_codec.get_default_codec()
+        for codec in codecs.itervalues():
+            self.assertRaises(UnicodeDecodeError, codec.dumps, {"tags": ['\xe9']})
+
+        # The payload is sanitized whatever the codec
+        log = mock.Mock()
+        self.assertEqual(json_codec.loads(serialize_payload({"tags": ['\xc3\xa9\xe9']}, log)),
+                         {"tags": [u'é']})
+
+    def test_default_codec_types(self):
+        # Serialized by simplejson, which was used before the codecs
+        codec = json_codec.get_default_codec()
+        self.assertEqual(codec.loads(codec.dumps({"value": Decimal('1.5')})), {"value": 1.5})
+
+    def test_default_codec_output(self):
+        # The payloads are serialized as they were before the codecs
+        codec = json_codec.get_default_codec()
+        for name in ('legacy_payload.json', 'sc_payload.json'):
+            with open(os.path.join(FIXTURE_PATH, name)) as f:
+                payload = simplejson.load(f)
+            self.assertEqual(codec.dumps(payload), simplejson.dumps(payload), name)
+
+        Point = namedtuple('Point', ['timestamp', 'value'])
+        payload = {"points": [Point(1500000000, 1e-20)]}
+        self.assertEqual(codec.dumps(payload), simplejson.dumps(payload))
+        self.assertEqual(codec.loads(codec.dumps(payload)), {"points": [{"timestamp": 1500000000, "value": 1e-20}]})
+
+    def test_configure(self):
+        try:
+            json_codec.configure({'json_codec': 'json'})
+            self.assertEqual(json_codec.codec.name, 'json')
+            json_codec.configure({'json_codec': 'unknown'})
+            self.assertEqual(json_codec.codec.name, 'simplejson')
+            json_codec.configure({'json_codec': 'json'})
+            json_codec.configure({})
+            self.assertEqual(json_codec.codec.name, 'simplejson')
+        finally:
+            json_codec.configure({})
@@ -0,0 +1,40 @@
+# stdlib
+from unittest import TestCase
+
+# project
+from utils.lru_cache import LRUCache
+
+
+class TestLRUCache(TestCase):
+    def test_get_set(self):
+        cache = LRUCache(10)
+        self.assertIsNone(cache.get('foo'))
+        self.assertEqual(cache.get('foo', 'default'), 'default')
+        cache.set('foo', 'bar')
+        self.assertEqual(cache.get('foo'), 'bar')
+        self.assertIn('foo', cache)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_bounded(self):
+        cache = LRUCache(10)
+        for i in xrange(1000):
+            cache.set(i, i)
+        self.assertLessEqual(len(cache), 10)
+        self.assertEqual(cache.get(999), 999)
+        self.assertIsNone(cache.get(0))
+
+    def test_recently_used_entries_are_kept(self):
+        cache = LRUCache(10)
+        cache.set('hot', 1)
+        for i in xrange(1000):
+            cache.set(i, i)
+            self.assertEqual(cache.get('hot'), 1)
+        self.assertLessEqual(len(cache), 10)
+
+    def test_clear(self):
+        cache = LRUCache(10)
+        cache.set('foo', 'bar')
+        cache.clear()
+        self.assertNotIn('foo', cache)
+        self.assertEqual(len(cache), 0)
@@ -0,0 +1,52 @@
+# stdlib
+import random
+import unittest
+
+# project
+from utils.quantile_sketch import DDSketch
+
+
+class TestDDSketch(unittest.TestCase):
+    RELATIVE_ACCURACY = 0.02
+
+    def assert_quantiles(self, sketch, values):
+        values = sorted(values)
+        for q in [0, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99, 1]:
+            expected = values[int(q * (len(values) - 1))]
+            approx = sketch.quantile(q)
+            self.assertLessEqual(abs(approx - expected), self.RELATIVE_ACCURACY * abs(expected) + 1e-9,
+                                 (q, approx, expected))
+
+    def test_empty(self):
+        self.assertIsNone(DDSketch().quantile(0.5))
+
+    def test_relative_accuracy(self):
+        random.seed(42)
+        values = [random.lognormvariate(0, 2) for _ in xrange(10000)]
+        values += [-v for v in values[:2000]] + [0] * 100
+
+        sketch = DDSketch(self.RELATIVE_ACCURACY)
+        for v in values:
+            sketch.add(v)
+
+        self.assertEqual(sketch.count, len(values))
+        self.assert_quantiles(sketch, values)
+
+    def test_merge(self):
+        random.seed(42)
+        values = [random.expovariate(0.1) for _ in xrange(5000)]
+        sketches = [DDSketch(self.RELATIVE_ACCURACY), DDSketch(self.RELATIVE_ACCURACY)]
+        for i, v in enumerate(values):
+            sketches[i % 2].add(v)
+
+        sketches[0].merge(sketches[1])
+        self.assertEqual(sketches[0].count, len(values))
+        self.assert_quantiles(sketches[0], values)
+
+    def test_bounded_bins(self):
+        sketch = DDSketch(0.01, max_bins=100)
+        for i in xrange(1, 100000, 7):
+            sketch.add(i)
+        self.assertLessEqual(len(sketch), 100)
+        # collapsing only affects the lowest quantiles
+        self.assertLessEqual(abs(sketch.quantile(0.99) - 99000), 0.01 * 99000 + 7)
@@ -1,4 +1,5 @@
 # 3p
+import mock
 
 # project
 from checks import AgentCheck
@@ -86,3 +87,196 @@ def test_check_status_always_succeeds():
     assert len(instance_statuses) == 2
     assert instance_statuses[0].status == STATUS_OK
     assert instance_statuses[1].status == STATUS_ERROR
+
+
+class ChangingTopologyCheck(AgentCheck):
+    """ Sends a snapshot of the components and relations it's given. """
+    def __init__(self, init_config):
+        super(ChangingTopologyCheck, self).__init__('changing_topology_check', init_config, {}, [{}])
+        self.components = {}
+        self.relations = []
+
+    def check(self, instance):
+        instance_key = {"type": "test", "url": "changing"}
+        self.start_snapshot(instance_key)
+        for component_id, data in sorted(self.components.items()):
+            self.component(instance_key, component_id, {"name": "container"}, data)
+        for source_id, target_id in self.relations:
+            self.relation(instance_key, source_id, target_id, {"name": "dependsOn"})
+        self.stop_snapshot(instance_key)
+
+    def run_topology(self):
+        self.run()
+        topologies = self.get_topology_instances()
+        assert len(topologies) == 1
+        return topologies[0]
+
+
+def external_ids(elements):
+    return [element['externalId'] for element in elements]
+
+
+def test_full_topology_snapshots():
+    check = ChangingTopologyCheck({})
+    check.components = {"c1": {"v": 1}, "c2": {"v": 1}}
+    for _ in xrange(2):
+        topology = check.run_topology()
+        assert external_ids(topology['components']) == ["c1", "c2"]
+        assert topology['start_snapshot'] and topology['stop_snapshot']
+        assert 'delete_ids' not in topology
+
+
+def test_incremental_topology():
+    check = ChangingTopologyCheck({'incremental_topology': True})
+    check.components = {"c1": {"v": 1}, "c2": {"v": 1}, "c3": {"v": 1}}
+    check.relations = [("c1", "c2")]
+
+    # The first snapshot is sent in full
+    topology = check.run_topology()
+    assert external_ids(topology['components']) == ["c1", "c2", "c3"]
+    assert external_ids(topology['relations']) == ["c1-dependsOn-c2"]
+    assert topology['start_snapshot'] and topology['stop_snapshot']
+
+    # Then only the changes
+    topology = check.run_topology()
+    assert topology == {
+        "instance": {"type": "test", "url": "changing"},
+        "components": [],
+        "relations": [],
+        "delete_ids": []
+    }
+
+    check.components["c2"] = {"v": 2}
+    check.components["c4"] = {"v": 1}
+    del check.components["c3"]
+    check.relations = [("c1", "c4")]
+    topology = check.run_topology()
+    assert external_ids(topology['components']) == ["c2", "c4"]
+    assert topology['components'][0]['data'] == {"v": 2}
+    assert external_ids(topology['relations']) == ["c1-dependsOn-c4"]
+    assert topology['delete_ids'] == ["c3", "c1-dependsOn-c2"]
+    assert 'start_snapshot' not in topology and 'stop_snapshot' not in topology
+
+    # A failed emission loses the changes, the next snapshot is sent in full
+    check.commit_failure()
+    topology = check.run_topology()
+    assert external_ids(topology['components']) == ["c1", "c2", "c4"]
+    assert topology['start_snapshot'] and topology['stop_snapshot']
+
+
+def test_incremental_topology_resync():
+    check = ChangingTopologyCheck({'incremental_topology': True, 'topology_resync_interval': 60})
+    check.components = {"c1": {"v": 1}}
+    with mock.patch('checks.time.time', return_value=1000):
+        assert 'start_snapshot' in check.run_topology()
+    with mock.patch('checks.time.time', return_value=1059):
+        assert check.run_topology()['components'] == []
+    with mock.patch('checks.time.time', return_value=1060):
+        topology = check.run_topology()
+        assert external_ids(topology['components']) == ["c1"]
+        assert 'start_snapshot' in topology
+
+
+def test_topology_batches():
+    check = ChangingTopologyCheck({})
+    check.topology_batch_size = 2
+    check.components = dict(("c%s" % i, {"v": 1}) for i in xrange(5))
+    check.relations = [("c0", "c1")]
+    batches = []
+    check.topology_emitter = lambda topologies: batches.extend(topologies) or True
+
+    topology = check.run_topology()
+    assert [external_ids(b['components']) for b in batches] == [["c0", "c1"], ["c2", "c3"], ["c4"]]
+    assert external_ids(batches[2]['relations']) == ["c0-dependsOn-c1"]
+    # The snapshot spans the batches
+    assert [(b['start_snapshot'], b['stop_snapshot']) for b in batches] == [(True, False), (False, False), (False, False)]
+    assert topology['components'] == [] and topology['relations'] == []
+    assert 'start_snapshot' not in topology and topology['stop_snapshot'] is True
+
+    # Without emitter, the batches are returned with the topology
+    check.topology_emitter = None
+    check.run()
+    topologies = check.get_topology_instances()
+    assert [len(t['components']) + len(t['relations']) for t in topologies] == [2, 2, 2, 0]
+    assert topologies[0]['start_snapshot'] and topologies[-1]['stop_snapshot']
+
+
+def test_incremental_topology_batches():
+    check = ChangingTopologyCheck({'incremental_topology': True})
+    check.topology_batch_size = 2
+    check.components = dict(("c%s" % i, {"v": 1}) for i in xrange(5))
+    batches = []
+    check.topology_emitter = lambda topologies: batches.extend(topologies) or True
+    check.run_topology()
+    assert len(batches) == 2
+
+    # Only the changes are held, and batched
+    del batches[:]
+    for i in (0, 2, 4):
+        check.components["c%s" % i] = {"v": 2}
+    del check.components["c1"]
+    topology = check.run_topology()
+    assert [external_ids(b['components']) for b in batches] == [["c0", "c2"]]
+    assert 'start_snapshot' not in batches[0]
+    assert external_ids(topology['components']) == ["c4"]
+    assert topology['delete_ids'] == ["c1"]
+
+    # A batch which couldn't be sent makes the next snapshot a full one
+    check.topology_emitter = lambda topologies: False
+    check.components["c0"] = {"v": 3}
+    check.components["c2"] = {"v": 3}
+    check.run_topology()
+    check.topology_emitter = lambda topologies: batches.extend(topologies) or True
+    del batches[:]
+    topology = check.run_topology()
+    assert batches[0]['start_snapshot'] is True
+    assert sum(len(t['components']) for t in batches + [topology]) == 4
+
+
+def test_topology_batch_failure():
+    check = ChangingTopologyCheck({})
+    check.topology_batch_size = 2
+    check.components = dict(("c%s" % i, {"v": 1}) for i in xrange(5))
+    batches = []
+
+    def failing_emitter(topologies):
+        batches.extend(topologies)
+        return len(batches) != 2
+    check.topology_emitter = failing_emitter
+
+    # The snapshot is aborted at the lost batch, and never stopped
+    topology = check.run_topology()
+    assert [external_ids(b['components']) for b in batches] == [["c0", "c1"], ["c2", "c3"]]
+    assert topology['components'] == [] and topology['relations'] == []
+    assert 'start_snapshot' not in topology and 'stop_snapshot' not in topology
+    assert check.topology_instances == {}
+
+    # The next snapshot is sent in full
+    del batches[:]
+    check.topology_emitter = lambda topologies: batches.extend(topologies) or True
+    topology = check.run_topology()
+    assert [external_ids(b['components']) for b in batches] == [["c0", "c1"], ["c2", "c3"]]
+    assert batches[0]['start_snapshot'] is True
+    assert external_ids(topology['components']) == ["c4"] and topology['stop_snapshot'] is True
+
+
+def test_incremental_topology_batch_failure():
+    check = ChangingTopologyCheck({'incremental_topology': True})
+    check.topology_batch_size = 2
+    check.components = dict(("c%s" % i, {"v": 1}) for i in xrange(5))
+    check.topology_emitter = lambda topologies: True
+    check.run_topology()
+
+    # A lost batch of changes aborts the snapshot, without deleting anything
+    check.topology_emitter = lambda topologies: False
+    for i in xrange(5):
+        check.components["c%s" % i] = {"v": 2}
+    topology = check.run_topology()
+    assert topology == {"instance": {"type": "test", "url": "changing"}, "components": [], "relations": []}
+
+    batches = []
+    check.topology_emitter = lambda topologies: batches.extend(topologies) or True
+    topology = check.run_topology()
+    assert batches[0]['start_snapshot'] is True
+    assert sum(len(t['components']) for t in batches + [topology]) == 5
+    assert topology['stop_snapshot'] is True
@@ -1,25 +1,34 @@
 # stdlib
 from datetime import datetime, timedelta
+import shutil
+import tempfile
 import threading
 import time
 import unittest
+import zlib
 
 # 3rd party
+import mock
 from nose.plugins.attrib import attr
 #import requests
-#import simplejson as json
+import simplejson as json
+from tornado.httputil import HTTPHeaders
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
 from tornado.web import Application
 
 # project
-#from config import get_version
+from config import get_version
 from stsagent import (
-    #APIMetricTransaction,
+    APIMetricTransaction,
     #APIServiceCheckTransaction,
+    Application as ForwarderApplication,
+    EmitterManager,
     MAX_QUEUE_SIZE,
     MetricTransaction,
     THROTTLING_DELAY,
 )
-from transaction import Transaction, TransactionManager
+from transaction import EndpointWindow, Transaction, TransactionManager
+from utils.disk_queue import DiskQueue
 
 
 class memTransaction(Transaction):
@@ -68,6 +77,50 @@ class SleepingTransaction(Transaction):
         self._trManager.flush_next()
 
 
+class spillableTransaction(Transaction):
+    """A transaction which can be pickled to the spill queue"""
+    _trManager = None
+    sent = []
+
+    def __init__(self, size, payload):
+        Transaction.__init__(self)
+        self._size = size
+        self._endpoint = 'https://example.com'
+        self.payload = payload
+
+    def flush(self):
+        self.sent.append(self.payload)
+        self._trManager.tr_success(self)
+        self._trManager.flush_next()
+
+
+class mergeableTransaction(Transaction):
+    """A transaction whose batches can be rejected"""
+    sent = []
+    reject_batches = False
+
+    def __init__(self, manager, payloads):
+        Transaction.__init__(self)
+        self._trManager = manager
+        self._size = 10 * len(payloads)
+        self._endpoint = 'https://example.com'
+        self.payloads = payloads
+
+    def get_merge_key(self):
+        return self._endpoint
+
+    def merge(self, transactions):
+        return mergeableTransaction(self._trManager, sum([tr.payloads for tr in transactions], []))
+
+    def flush(self):
+        if self.reject_batches and len(self.payloads) > 1:
+            self._trManager.tr_error_reject_request(self, 413)
+        else:
+            self.sent.append(self.payloads)
+            self._trManager.tr_success(self)
+        self._trManager.flush_next()
+
+
 @attr(requires='core_integration')
 class TestTransaction(unittest.TestCase):
 
@@ -247,6 +300,114 @@ class TestTransaction(unittest.TestCase):
 #                               headers={'Content-Type': "application/json"})
 #             r.raise_for_status()
 
+    def test_spill_queue(self):
+        spill_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spill_path)
+        spillableTransaction.sent = []
+
+        trManager = TransactionManager(timedelta(seconds=0), 100, timedelta(seconds=0),
+                                       spill_queue=DiskQueue(spill_path, 1024 * 1024))
+        spillableTransaction._trManager = trManager
+        for i in xrange(10):
+            trManager.append(spillableTransaction(30, i))
+
+        # Only what fits in the queue size is kept in memory, nothing is dropped
+        self.assertEqual([tr.payload for tr in trManager._transactions], [0, 1, 2])
+        self.assertEqual(len(trManager._spill_queue), 7)
+        self.assertEqual(trManager._transactions_received, 10)
+
+        # The spilled transactions are loaded as the queue drains, oldest first
+        trManager.flush()
+        first_flush = sorted(spillableTransaction.sent)
+        self.assertEqual(first_flush, range(len(first_flush)))
+        while len(trManager._spill_queue) or trManager._transactions:
+            trManager.flush()
+        self.assertEqual(sorted(spillableTransaction.sent), range(10))
+
+    def test_spill_queue_restart(self):
+        spill_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spill_path)
+        spillableTransaction.sent = []
+
+        trManager = TransactionManager(timedelta(seconds=0), 100, timedelta(seconds=0),
+                                       spill_queue=DiskQueue(spill_path, 1024 * 1024))
+        for i in xrange(5):
+            trManager.append(spillableTransaction(30, i))
+        # The forwarder stops, the transactions in memory are saved ahead of the spilled ones
+        trManager.spill_transactions()
+        self.assertEqual(trManager._transactions, [])
+
+        trManager = TransactionManager(timedelta(seconds=0), 100, timedelta(seconds=0),
+                                       spill_queue=DiskQueue(spill_path, 1024 * 1024))
+        spillableTransaction._trManager = trManager
+        while len(trManager._spill_queue) or trManager._transactions:
+            trManager.flush()
+        self.assertEqual(sorted(spillableTransaction.sent), range(5))
+
+    def test_spill_agent_transaction(self):
+        spill_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spill_path)
+        # Too small for any transaction, they are all spilled
+        trManager = TransactionManager(timedelta(seconds=0), 1, timedelta(seconds=0),
+                                       spill_queue=DiskQueue(spill_path, 1024 * 1024))
+
+        headers = HTTPHeaders({'Content-Type': 'application/json'})
+        with mock.patch.object(APIMetricTransaction, '_trManager', mock.Mock()), \
+                mock.patch.object(APIMetricTransaction, '_endpoints', {}):
+            tr = APIMetricTransaction(json.dumps({'series': [{'metric': 'metric.0'}]}), headers)
+        tr._endpoint = 'https://app.example.com'
+        tr._api_key = 'api_key'
+        trManager.append(tr)
+        self.assertEqual(len(trManager._spill_queue), 1)
+
+        trManager._MAX_QUEUE_SIZE = MAX_QUEUE_SIZE
+        trManager._load_spilled()
+        self.assertEqual(len(trManager._spill_queue), 0)
+        loaded = trManager._transactions
+        self.assertEqual(len(loaded), 1)
+        self.assertIsInstance(loaded[0]._headers, HTTPHeaders)
+        self.assertEqual(dict(loaded[0]._headers),
+                         {'Content-Type': 'application/json', 'Dd-Forwarder-Version': get_version()})
+        self.assertEqual(loaded[0]._data, tr._data)
+        self.assertEqual(loaded[0].get_merge_key(), tr.get_merge_key())
+
+    def test_flush_due_transactions(self):
+        # Failed transactions are replayed 20s later
+        trManager = TransactionManager(timedelta(seconds=60), MAX_QUEUE_SIZE,
+                                       timedelta(seconds=0), max_endpoint_errors=100)
+        now = datetime.utcnow()
+        due, later = [], []
+        for i in xrange(20):
+            tr = memTransaction(10, trManager)
+            # Half of the transactions are replayed in the future
+            if i % 2:
+                tr._next_flush = now + timedelta(hours=i)
+                later.append(tr)
+            else:
+                due.append(tr)
+            trManager.append(tr)
+
+        # Only the due transactions are flushed
+        trManager.flush()
+        self.assertEqual([tr._flush_count for tr in due], [1] * 10)
+        self.assertEqual([tr._flush_count for tr in later], [0] * 10)
+
+        # Rescheduled transactions are flushed again once due, not before
+        for tr in later:
+            tr._next_flush = now
+            trManager._schedule(tr)
+        trManager.flush()
+        self.assertEqual([tr._flush_count for tr in later], [1] * 10)
+        self.assertEqual([tr._flush_count for tr in due], [1] * 10)
+
+        # Outdated scheduling entries are eventually dropped
+        for i in xrange(200):
+            for tr in later:
+                trManager._schedule(tr)
+        trManager._compact_heaps()
+        self.assertEqual(len(trManager._flush_heap), len(trManager._waiting))
+        self.assertEqual(len(trManager._drop_heap), 20)
+
     def test_endpoint_error(self):
         trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE,
                                        timedelta(seconds=0), max_endpoint_errors=2)
@@ -339,6 +500,64 @@ class TestTransaction(unittest.TestCase):
         self.assertEqual(trManager._finished_flushes, 2)
         self.assertIs(trManager._trs_to_flush, None)
 
+    def test_endpoint_window(self):
+        window = EndpointWindow(max_size=3, slow_latency=1)
+        window.start(datetime.utcnow())
+        self.assertTrue(window.is_full())
+
+        # Additive increase on fast flushes, up to the max size
+        window.success(0.1)
+        self.assertEqual(window.size, 2)
+        for i in xrange(10):
+            window.start(datetime.utcnow())
+            window.success(0.1)
+        self.assertEqual(window.size, 3)
+
+        # Multiplicative decrease on errors and slow flushes, down to 1
+        window.start(datetime.utcnow())
+        window.error()
+        self.assertEqual(window.size, 1.5)
+        window.start(datetime.utcnow())
+        window.success(2)
+        self.assertEqual(window.size, 1)
+        self.assertEqual(window.in_flight, 0)
+
+        # The throttling delay is shared between the flushes of the window
+        now = datetime.utcnow()
+        window.size = 2
+        window.start(now)
+        self.assertEqual(window.throttling_delay(timedelta(seconds=1), now), 0.5)
+
+    def test_endpoint_parallelism(self):
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE,
+                                       timedelta(seconds=0), max_parallelism=10,
+                                       max_endpoint_errors=100, max_endpoint_parallelism=4)
+        fast_trs = []
+        for i in xrange(5):
+            tr = memTransaction(1, trManager)
+            tr.is_flushable = True
+            fast_trs.append(tr)
+            trManager.append(tr)
+        for i in xrange(3):
+            tr = SleepingTransaction(trManager, delay=0.2)
+            tr._endpoint = 'https://slow.example.com'
+            tr.is_flushable = True
+            trManager.append(tr)
+
+        # The slow endpoint starts with a single flush at once, and doesn't
+        # hold back the other one
+        trManager.flush()
+        self.assertEqual(trManager._running_flushes, 1)
+        self.assertEqual([tr._flush_count for tr in fast_trs], [1] * 5)
+        self.assertEqual(len(trManager._transactions), 3)
+        self.assertGreater(trManager.get_endpoint_window('https://example.com').size, 3)
+
+        time.sleep(1)
+        self.assertEqual(trManager._running_flushes, 0)
+        self.assertEqual(len(trManager._transactions), 0)
+        self.assertIs(trManager._trs_to_flush, None)
+        self.assertAlmostEqual(trManager.get_endpoint_window('https://slow.example.com').size, 2.9)
+
     def test_multiple_endpoints(self):
         config = {
             "endpoints": {
@@ -365,3 +584,114 @@ class TestTransaction(unittest.TestCase):
         self.assertEqual(len(trManager._transactions), 2)
         self.assertEqual(trManager._transactions[0]._endpoint, 'https://app.datadoghq.com')
         self.assertEqual(trManager._transactions[1]._endpoint, 'https://app.example.com')
+
+    def test_http_client(self):
+        config = {
+            "endpoints": {"https://app.example.com": ['api_key']},
+            "forwarder_timeout": 42,
+            "skip_ssl_validation": "yes",
+        }
+        app = ForwarderApplication(17123, config, watchdog=False, use_simple_http_client=True)
+
+        # A single client for all the transactions, configured once
+        self.assertIsInstance(app.http_client, SimpleAsyncHTTPClient)
+        self.assertEqual(app.http_client.max_clients, ForwarderApplication.DEFAULT_PARALLELISM)
+        self.assertEqual(app.http_client.defaults['request_timeout'], 42)
+        self.assertFalse(app.http_client.defaults['validate_cert'])
+
+        app.http_request_count = 3
+        self.assertEqual(app.get_http_client_stats(), {'requests': 3, 'connections': None, 'reused': None})
+
+    def test_coalesce(self):
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE,
+                                       timedelta(seconds=0), max_batch_size=25)
+        mergeableTransaction.sent = []
+        mergeableTransaction.reject_batches = False
+        for i in xrange(5):
+            trManager.append(mergeableTransaction(trManager, [i]))
+        # Not merged with the others
+        tr = memTransaction(10, trManager)
+        tr.is_flushable = True
+        trManager.append(tr)
+
+        trManager.flush()
+        self.assertEqual(sorted(mergeableTransaction.sent), [[0, 1], [2, 3], [4]])
+        self.assertEqual(tr._flush_count, 1)
+        self.assertEqual(len(trManager._transactions), 0)
+        self.assertEqual(trManager._transactions_flushed, 6)
+
+    def test_coalesce_rejected(self):
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE,
+                                       timedelta(seconds=0), max_batch_size=100)
+        mergeableTransaction.sent = []
+        mergeableTransaction.reject_batches = True
+        for i in xrange(3):
+            trManager.append(mergeableTransaction(trManager, [i]))
+
+        # The rejected batch is sent again one transaction at a time
+        trManager.flush()
+        self.assertEqual(sorted(mergeableTransaction.sent), [[0], [1], [2]])
+        self.assertEqual(len(trManager._transactions), 0)
+        self.assertEqual(trManager._transactions_rejected, 0)
+
+    def test_merge_series(self):
+        transactions = []
+        for i, headers in enumerate([{'Content-Type': 'text/plain'}, {'Content-Encoding': 'deflate'}]):
+            tr = APIMetricTransaction.__new__(APIMetricTransaction)
+            Transaction.__init__(tr)
+            tr._endpoint = 'https://app.example.com'
+            tr._api_key = 'api_key'
+            tr._headers = HTTPHeaders(headers)
+            tr._data = json.dumps({'series': [{'metric': 'metric.%s' % i}]})
+            if 'Content-Encoding' in headers:
+                tr._data = zlib.compress(tr._data)
+            transactions.append(tr)
+
+        self.assertEqual(transactions[0].get_merge_key(), transactions[1].get_merge_key())
+        batch = transactions[0].merge(transactions)
+        self.assertEqual(batch._headers['Content-Encoding'], 'deflate')
+        self.assertEqual(json.loads(zlib.decompress(batch._data)),
+                         {'series': [{'metric': 'metric.0'}, {'metric': 'metric.1'}]})
+        self.assertEqual(batch._endpoint, 'https://app.example.com')
+        self.assertIs(batch.get_id(), None)
+        # The payloads of the batched transactions aren't changed
+        self.assertEqual(list(transactions[0]._headers.get_all()), [('Content-Type', 'text/plain')])
+        self.assertEqual(list(transactions[1]._headers.get_all()), [('Content-Encoding', 'deflate')])
+
+
+class TestEmitterManager(unittest.TestCase):
+
+    def make_emitter(self, accepts_raw_payload):
+        received = []
+        done = threading.Event()
+
+        class Emitter(object):
+            def __call__(self, data, logger, config, *args):
+                received.append((data,) + args)
+                done.set()
+        Emitter.accepts_raw_payload = accepts_raw_payload
+        return Emitter, received, done
+
+    def test_emitters(self):
+        manager = EmitterManager({'custom_emitters': ''})
+        decoding_emitter, decoded, decoded_done = self.make_emitter(False)
+        raw_emitter, raw, raw_done = self.make_emitter(True)
+        manager.add_emitter('decoding', decoding_emitter)
+        manager.add_emitter('raw', raw_emitter)
+
+        payload = zlib.compress(json.dumps({'series': []}))
+        headers = {'Content-Encoding': 'deflate'}
+        decoding_threads = []
+
+        def loads(data):
+            decoding_threads.append(threading.current_thread())
+            return json.loads(data)
+
+        with mock.patch('stsagent.json_codec.loads', side_effect=loads):
+            manager.send(payload, headers)
+            self.assertTrue(decoded_done.wait(5))
+            self.assertTrue(raw_done.wait(5))
+        # Decoded once, by the decoder thread rather than in send
+        self.assertEqual(decoding_threads, [manager.decoderThread])
+        self.assertEqual(decoded, [({'series': []},)])
+        self.assertEqual(raw, [(payload, headers)])
@@ -11,7 +11,7 @@ from nose.plugins.skip import SkipTest
 # project
 from utils.net import inet_pton, _inet_pton_win
 from utils.net import IPV6_V6ONLY, IPPROTO_IPV6
-from utils.net import DNSCache
+from utils.net import DNSCache, get_udp_socket_drops
 from config import get_url_endpoint
 
 DEFAULT_ENDPOINT = "https://app.datadoghq.com"
@@ -55,3 +55,16 @@ class TestUtilsNet(TestCase):
         location = urlparse(endpoint)
         ip = cache.resolve(location.netloc)
         self.assertNotEqual(ip, location.netloc)
+
+    def test_get_udp_socket_drops(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        try:
+            drops = get_udp_socket_drops(sock)
+            if drops is None:
+                raise SkipTest('UDP drop counters are not available on this platform')
+            self.assertEqual(drops, 0)
+            # an unknown procfs location doesn't expose the counter
+            self.assertIsNone(get_udp_socket_drops(sock, procfs_path='/nonexistent'))
+        finally:
+            sock.close()
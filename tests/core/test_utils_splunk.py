@@ -1,5 +1,7 @@
 # stdlib
 import itertools
+import threading
+import time
 from urllib import quote
 from unittest import TestCase
 
@@ -7,8 +9,11 @@ import logging
 import mock
 import json
 
+from checks import CheckException
+from checks.libs.thread_pool import Pool
 from utils.splunk.splunk import SplunkSavedSearch, SplunkInstanceConfig, SavedSearches
 from utils.splunk.splunk_helper import SplunkHelper
+from utils.splunk.splunk_telemetry_base import PrefetchedSearchResults, SplunkTelemetryBase
 
 
 class FakeInstanceConfig(object):
@@ -93,7 +98,11 @@ class TestUtilsSplunk(TestCase):
         setattr(splunk_helper, "_search_chunk", _mocked_search_chunk)
 
         res = splunk_helper.saved_search_results("id", saved_search)
-        self.assertEquals(len(res), 5)
+        # pages are only requested as they are consumed
+        self.assertEquals(search_offsets, [])
+        self.assertEquals(len(next(res)["results"]), 1000)
+        self.assertEquals(search_offsets, [0])
+        self.assertEquals(len(list(res)), 4)
         self.assertEquals(search_offsets, [0, 1000, 2000, 3000, 4000])
 
     def test_splunk_saved_searches(self):
@@ -188,6 +197,56 @@ class TestUtilsSplunk(TestCase):
         res = splunk_helper.dispatch(saved_search, username, appname, 'true', params)
         self.assertEquals(res, "zesid")
 
+    def test_search_backoff(self):
+        instance_config = SplunkInstanceConfig({'url': 'dummy'}, {}, {
+            'default_request_timeout_seconds': 5,
+            'default_search_max_retry_count': 6,
+            'default_search_seconds_between_retries': 1,
+            'default_verify_ssl_certificate': False,
+            'default_batch_size': 1000,
+            'default_saved_searches_parallel': 3,
+            'default_unique_key_fields': ["_bkt", "_cd"],
+            'default_app': 'default',
+            'default_parameters': {}
+        })
+        splunk_helper = SplunkHelper(instance_config)
+        saved_search = SplunkSavedSearch(instance_config, {"name": "search", "parameters": {}})
+        splunk_helper._do_get = lambda *args: FakeResponse("", status_code=204)
+
+        with mock.patch('utils.splunk.splunk_helper.time.sleep') as sleep:
+            self.assertRaises(CheckException, splunk_helper._search_chunk, saved_search, "zesid", 0, 1000)
+        # the delay doubles, up to 8 times search_seconds_between_retries
+        self.assertEquals([call[0][0] for call in sleep.call_args_list], [1, 2, 4, 8, 8, 8])
+
+    def test_request_latencies(self):
+        instance_config = SplunkInstanceConfig({'url': 'dummy'}, {}, {
+            'default_request_timeout_seconds': 5,
+            'default_search_max_retry_count': 3,
+            'default_search_seconds_between_retries': 0,
+            'default_verify_ssl_certificate': False,
+            'default_batch_size': 1000,
+            'default_saved_searches_parallel': 3,
+            'default_unique_key_fields': ["_bkt", "_cd"],
+            'default_app': 'default',
+            'default_parameters': {}
+        })
+        splunk_helper = SplunkHelper(instance_config, connection_pool_size=20)
+        self.assertEquals(splunk_helper.requests_session.get_adapter('https://splunk:8089')._pool_maxsize, 20)
+        saved_search = SplunkSavedSearch(instance_config, {"name": "search", "parameters": {}})
+
+        responses = [FakeResponse("", status_code=204), FakeResponse("""{"messages": [], "results": []}""")]
+        splunk_helper._do_get = lambda *args: responses.pop(0)
+        splunk_helper._do_post = lambda *args, **kwargs: FakeResponse("""{"sid": "zesid"}""")
+
+        splunk_helper.dispatch(saved_search, "admin", "myapp", True, {})
+        list(splunk_helper.saved_search_results("zesid", saved_search))
+        splunk_helper.finalize_sid("zesid", saved_search)
+
+        latencies = splunk_helper.pop_request_latencies()
+        self.assertEquals(dict((category, len(l)) for category, l in latencies.iteritems()),
+                          {'dispatch': 1, 'poll': 1, 'results': 1, 'finalize': 1})
+        self.assertEquals(splunk_helper.pop_request_latencies(), {})
+
 class TestSavedSearches(TestCase):
 
     def test_saved_searches(self):
@@ -234,3 +293,144 @@ class TestSavedSearches(TestCase):
         # And remove again
         saved_searches.update_searches(log, [])
         self.assertEquals([s.name for s in saved_searches.searches], ["components"])
+
+
+class ParallelSearchesCheck(SplunkTelemetryBase):
+    SERVICE_CHECK_NAME = "splunk.parallel_searches"
+
+    def __init__(self, delays):
+        super(ParallelSearchesCheck, self).__init__("splunk_parallel_searches", {}, {}, "splunk_parallel_searches_test")
+        self.delays = delays
+        self.applied = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        self.clear_status()
+
+    def _finalize_sid(self, instance, sid, saved_search):
+        pass
+
+    def _dispatch_saved_search(self, instance, saved_search):
+        return "sid_" + saved_search.name
+
+    def _search(self, search_id, saved_search, instance):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.delays[saved_search.name])
+        with self.lock:
+            self.in_flight -= 1
+        if saved_search.name == "failing":
+            raise Exception("search failed")
+        return [{"messages": [], "results": [{"_time": "2018-01-01T00:00:00.000000+0000", "name": saved_search.name}]}]
+
+    def _apply(self, **kwargs):
+        self.applied.append(kwargs["name"])
+
+
+class FakeSavedSearch(object):
+    def __init__(self, name):
+        self.name = name
+        self.unique_key_fields = ["name"]
+        self.last_observed_telemetry = set()
+        self.last_observed_timestamp = 0
+
+    def retrieve_fields(self, data):
+        return {"name": data["name"]}
+
+
+class FakeTelemetryInstance(object):
+    def __init__(self, saved_searches_parallel):
+        self.instance_config = FakeInstanceConfig()
+        self.instance_config.ignore_saved_search_errors = False
+        self.saved_searches_parallel = saved_searches_parallel
+        self.tags = []
+        self.search_pool = Pool(saved_searches_parallel, daemon=True)
+
+    def get_search_pool(self):
+        return self.search_pool
+
+
+class TestParallelSearches(TestCase):
+
+    def test_searches_in_flight(self):
+        delays = {"slow": 0.3, "fast": 0.1, "failing": 0.1, "last": 0.1}
+        check = ParallelSearchesCheck(delays)
+        instance = FakeTelemetryInstance(saved_searches_parallel=2)
+        searches = [FakeSavedSearch(name) for name in ["slow", "fast", "failing", "last"]]
+
+        start = time.time()
+        self.assertTrue(check._dispatch_and_await_search(instance, searches))
+        # the searches after the slow one are retrieved while it's still running
+        self.assertLess(time.time() - start, 0.55)
+        self.assertEquals(check.max_in_flight, 2)
+        # results are applied in the order of the saved searches
+        self.assertEquals(check.applied, ["slow", "fast", "last"])
+        self.assertEquals(len(check.service_checks), 1)
+        self.assertEquals(check.service_checks[0]["status"], SplunkTelemetryBase.WARNING)
+        self.assertEquals(check.status.data["http://testhost:8089last"], "sid_last")
+        check.clear_status()
+
+    def test_request_time_metrics(self):
+        check = ParallelSearchesCheck({})
+        instance = FakeTelemetryInstance(saved_searches_parallel=2)
+        instance.tags = ["mytag"]
+        instance.splunkHelper = SplunkHelper(instance.instance_config)
+        instance.splunkHelper._record_latency('dispatch', time.time())
+        instance.splunkHelper._record_latency('results', time.time())
+        instance.splunkHelper._record_latency('results', time.time())
+
+        check._send_request_latencies(instance)
+        counts = dict((tuple(m[3]['tags']), m[2]) for m in check.get_metrics()
+                      if m[0] == 'stackstate.agent.splunk.request_time.count')
+        self.assertEquals(counts, {
+            ('endpoint:dispatch', 'url:http://testhost:8089', 'mytag'): 1,
+            ('endpoint:results', 'url:http://testhost:8089', 'mytag'): 2,
+        })
+
+    def test_no_searches(self):
+        check = ParallelSearchesCheck({})
+        self.assertFalse(check._dispatch_and_await_search(FakeTelemetryInstance(saved_searches_parallel=2), []))
+
+    def test_prefetched_results(self):
+        requested = []
+
+        def pages():
+            for i in xrange(10):
+                requested.append(i)
+                yield {"messages": [], "results": [i]}
+
+        results = PrefetchedSearchResults(pages, prefetch=1)
+        worker = threading.Thread(target=results.fetch)
+        worker.start()
+        iterator = iter(results)
+        self.assertEquals(next(iterator)["results"], [0])
+        time.sleep(0.1)
+        # one page waits in the queue, and the retrieval holds the next one
+        self.assertEquals(requested, [0, 1, 2])
+        self.assertEquals([page["results"][0] for page in iterator], range(1, 10))
+        worker.join(1)
+        self.assertFalse(worker.is_alive())
+
+        # the retrieval stops once cancelled
+        del requested[:]
+        results = PrefetchedSearchResults(pages, prefetch=1)
+        worker = threading.Thread(target=results.fetch)
+        worker.start()
+        time.sleep(0.1)
+        results.cancel()
+        worker.join(1)
+        self.assertFalse(worker.is_alive())
+        self.assertLess(len(requested), 10)
+
+    def test_failing_results(self):
+        def pages():
+            yield {"messages": [], "results": [0]}
+            raise Exception("FATAL")
+
+        # room for the page and the error, to retrieve them upfront
+        results = PrefetchedSearchResults(pages, prefetch=2)
+        results.fetch()
+        iterator = iter(results)
+        self.assertEquals(next(iterator)["results"], [0])
+        self.assertRaises(Exception, next, iterator)
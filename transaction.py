@@ -1,6 +1,8 @@
 
 # stdlib
+import cPickle as pickle
 from datetime import datetime, timedelta
+import heapq
 import logging
 from operator import attrgetter
 import sys
@@ -17,6 +19,9 @@ log = logging.getLogger(__name__)
 
 FLUSH_LOGGING_PERIOD = 20
 FLUSH_LOGGING_INITIAL = 5
+# Outdated entries kept in the scheduling heaps before rebuilding them
+COMPACT_THRESHOLD = 1000
+EPOCH = datetime(1970, 1, 1)
 
 class Transaction(object):
 
@@ -26,6 +31,10 @@ class Transaction(object):
         self._error_count = 0
         self._next_flush = datetime.utcnow()
         self._size = None
+        # Transactions sent by this one, when it's a batch
+        self._batch = None
+        # Rejected as part of a batch, only sent on its own since
+        self._split = False
 
     def get_id(self):
         return self._id
@@ -65,22 +74,88 @@ class Transaction(object):
     def flush(self):
         raise NotImplementedError("To be implemented in a subclass")
 
+    def get_merge_key(self):
+        """Queued transactions with the same key can be sent as a single one,
+           built by `merge`. None if the transaction can't be merged."""
+        return None
+
+    def merge(self, transactions):
+        """Return a new transaction sending the payloads of `transactions`"""
+        raise NotImplementedError("To be implemented in a subclass")
+
+class EndpointWindow(object):
+    """Number of concurrent flushes allowed to an endpoint, adapted with AIMD:
+       it grows by one every `size` successful flushes, and is halved when a
+       flush fails or is slower than `slow_latency` seconds"""
+
+    def __init__(self, max_size, slow_latency):
+        self.max_size = float(max_size)
+        self.slow_latency = slow_latency
+        self.size = 1.0
+        self.in_flight = 0
+        self.last_flush = datetime.min
+
+    def is_full(self):
+        return self.in_flight >= int(self.size)
+
+    def throttling_delay(self, throttling_delay, now):
+        """Seconds to wait before the next flush, the bigger the window the
+           shorter the wait"""
+        return (self.last_flush + throttling_delay / int(self.size) - now).total_seconds()
+
+    def start(self, now):
+        self.in_flight += 1
+        self.last_flush = now
+
+    def success(self, latency):
+        self.in_flight -= 1
+        if latency > self.slow_latency:
+            self._decrease()
+        else:
+            self.size = min(self.max_size, self.size + 1 / self.size)
+
+    def error(self):
+        self.in_flight -= 1
+        self._decrease()
+
+    def done(self):
+        self.in_flight -= 1
+
+    def _decrease(self):
+        self.size = max(1.0, self.size / 2.0)
+
+
 class TransactionManager(object):
     """Holds any transaction derived object list and make sure they
        are all commited, without exceeding parameters (throttling, memory consumption) """
 
     def __init__(self, max_wait_for_replay, max_queue_size, throttling_delay,
-                 max_parallelism=1, max_endpoint_errors=4):
+                 max_parallelism=1, max_endpoint_errors=4, spill_queue=None,
+                 max_endpoint_parallelism=None, slow_flush_latency=5,
+                 max_batch_size=None):
         self._MAX_WAIT_FOR_REPLAY = max_wait_for_replay
         self._MAX_QUEUE_SIZE = max_queue_size
         self._THROTTLING_DELAY = throttling_delay
         self._MAX_PARALLELISM = max_parallelism
         self._MAX_ENDPOINT_ERRORS = max_endpoint_errors
         self._MAX_FLUSH_DURATION = timedelta(seconds=10)
+        # Due transactions with the same merge key are sent in batches of up
+        # to max_batch_size bytes, None to always send them one by one
+        self._MAX_BATCH_SIZE = max_batch_size
 
         self._flush_without_ioloop = False # useful for tests
 
-        self._transactions = []  # List of all non commited transactions
+        # All non commited transactions, by id, and their next flush time
+        self._transactions_by_id = {}
+        self._next_flushes = {}
+        # Ids of the transactions waiting for a flush, i.e. not being flushed
+        self._waiting = set()
+        # Heaps of (next flush, id) to pick the transactions due for a flush,
+        # and of (-next flush, id, next flush) to pick the ones to drop when
+        # the queue is full. Rescheduling a transaction pushes new entries,
+        # the outdated ones are skipped when they reach the top.
+        self._flush_heap = []
+        self._drop_heap = []
         self._total_count = 0  # Maintain size/count not to recompute it everytime
         self._total_size = 0
         self._flush_count = 0
@@ -90,6 +165,10 @@ class TransactionManager(object):
 
         self._transactions_rejected = 0
 
+        # Optional DiskQueue receiving the transactions that don't fit in
+        # max_queue_size, memory then only holds the head of the queue
+        self._spill_queue = spill_queue
+
         # Global counter to assign a number to each transaction: we may have an issue
         #  if this overlaps
         self._counter = 0
@@ -97,6 +176,16 @@ class TransactionManager(object):
         self._trs_to_flush = None # Current transactions being flushed
         self._last_flush = datetime.utcnow() # Last flush (for throttling)
 
+        # With max_endpoint_parallelism, every endpoint gets its own window of
+        # concurrent flushes and throttling, so that a slow endpoint doesn't
+        # hold back the others. Otherwise, max_parallelism flushes are run
+        # regardless of the endpoints.
+        self._MAX_ENDPOINT_PARALLELISM = max_endpoint_parallelism
+        self._SLOW_FLUSH_LATENCY = slow_flush_latency
+        self._endpoint_windows = {}
+        # Endpoint and start time of the running flushes, by transaction id
+        self._running = {}
+
         # Error management
         self._endpoints_errors = {}
         self._finished_flushes = 0
@@ -104,6 +193,17 @@ class TransactionManager(object):
         # Track an initial status message.
         ForwarderStatus().persist()
 
+    def get_endpoint_window(self, endpoint):
+        window = self._endpoint_windows.get(endpoint)
+        if window is None:
+            window = EndpointWindow(self._MAX_ENDPOINT_PARALLELISM, self._SLOW_FLUSH_LATENCY)
+            self._endpoint_windows[endpoint] = window
+        return window
+
+    @property
+    def _transactions(self):
+        return sorted(self._transactions_by_id.itervalues(), key=attrgetter('_id'))
+
     def get_transactions(self):
         return self._transactions
 
@@ -111,6 +211,12 @@ class TransactionManager(object):
         log.debug("Queue size: at %s, %s transaction(s), %s KB" %
             (time.time(), self._total_count, (self._total_size/1024)))
 
+    def _spilled_count(self):
+        return len(self._spill_queue) if self._spill_queue is not None else None
+
+    def _spilled_size(self):
+        return self._spill_queue.size if self._spill_queue is not None else None
+
     def get_tr_id(self):
         self._counter = self._counter + 1
         return self._counter
@@ -126,31 +232,131 @@ class TransactionManager(object):
         log.debug("New transaction to add, total size of queue would be: %s KB" %
             ((self._total_size + tr_size) / 1024))
 
+        # Once transactions are spilled the next ones are too, to keep the order
+        if self._spill_queue is not None and \
+                (len(self._spill_queue) or (self._total_size + tr_size) > self._MAX_QUEUE_SIZE):
+            try:
+                self._spill_queue.append(pickle.dumps(tr, pickle.HIGHEST_PROTOCOL))
+            except Exception:
+                log.exception("Unable to spill transaction %s to disk, keeping it in memory", tr.get_id())
+            else:
+                self._transactions_received += 1
+                log.debug("Transaction %s spilled to disk" % (tr.get_id()))
+                return
+
         if (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
             log.warn("Queue is too big, removing old transactions...")
-            new_trs = sorted(self._transactions,key=attrgetter('_next_flush'), reverse = True)
-            for tr2 in new_trs:
-                if (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
+            while (self._total_size + tr_size) > self._MAX_QUEUE_SIZE and self._drop_heap:
+                _, tr_id, next_flush = heapq.heappop(self._drop_heap)
+                if self._next_flushes.get(tr_id) == next_flush:
+                    tr2 = self._transactions_by_id[tr_id]
                     self._remove(tr2)
                     log.warn("Removed transaction %s from queue" % tr2.get_id())
 
         # Done
-        self._transactions.append(tr)
-        self._total_count += 1
+        self._insert(tr)
         self._transactions_received += 1
-        self._total_size = self._total_size + tr_size
 
         log.debug("Transaction %s added" % (tr.get_id()))
         self.print_queue_stats()
 
+    def _load_spilled(self):
+        """Move the oldest spilled transactions back in memory, as many as fit"""
+        if self._spill_queue is None or not len(self._spill_queue):
+            return
+
+        room = self._MAX_QUEUE_SIZE - self._total_size
+        if room <= 0:
+            return
+
+        for record in self._spill_queue.pop(room):
+            try:
+                tr = pickle.loads(record)
+            except Exception:
+                log.exception("Unable to load a spilled transaction, dropping it")
+                continue
+            # Ids are given again, they are only unique within a run
+            tr._id = None
+            tr.set_id(self.get_tr_id())
+            self._insert(tr)
+
+        log.debug("Loaded spilled transactions, %s left on disk" % len(self._spill_queue))
+
+    def spill_transactions(self):
+        """Move all the transactions in memory to the spill queue, ahead of
+        the ones already spilled, so that they are replayed after a restart"""
+        if self._spill_queue is None:
+            return
+
+        transactions = self._transactions
+        try:
+            self._spill_queue.prepend([pickle.dumps(tr, pickle.HIGHEST_PROTOCOL) for tr in transactions])
+        except Exception:
+            log.exception("Unable to spill the %s queued transactions to disk", len(transactions))
+            return
+        finally:
+            self._spill_queue.close()
+
+        log.info("Spilled %s transaction%s to disk" % (len(transactions), plural(len(transactions))))
+        self._transactions_by_id = {}
+        self._next_flushes = {}
+        self._waiting = set()
+        self._flush_heap = []
+        self._drop_heap = []
+        self._total_count = 0
+        self._total_size = 0
+
+    def _insert(self, tr):
+        self._transactions_by_id[tr.get_id()] = tr
+        self._total_count += 1
+        self._total_size += tr.get_size()
+        self._schedule(tr)
+
+    def _schedule(self, tr):
+        '''Wait for the next flush time of the transaction to flush it again'''
+        tr_id = tr.get_id()
+        if tr_id not in self._transactions_by_id:
+            return
+        next_flush = tr.get_next_flush()
+        self._next_flushes[tr_id] = next_flush
+        self._waiting.add(tr_id)
+        heapq.heappush(self._flush_heap, (next_flush, tr_id))
+        heapq.heappush(self._drop_heap, (-self._timestamp(next_flush), tr_id, next_flush))
+
+    @staticmethod
+    def _timestamp(next_flush):
+        return (next_flush - EPOCH).total_seconds()
+
+    def _pop_due(self, now):
+        '''Return the waiting transactions whose next flush time has come'''
+        due = []
+        heap = self._flush_heap
+        while heap and heap[0][0] <= now:
+            next_flush, tr_id = heapq.heappop(heap)
+            if tr_id in self._waiting and self._next_flushes[tr_id] == next_flush:
+                self._waiting.remove(tr_id)
+                due.append(self._transactions_by_id[tr_id])
+        return due
+
+    def _compact_heaps(self):
+        '''Drop the outdated heap entries once they outnumber the valid ones'''
+        if len(self._flush_heap) > 2 * len(self._waiting) + COMPACT_THRESHOLD:
+            self._flush_heap = [(self._next_flushes[tr_id], tr_id) for tr_id in self._waiting]
+            heapq.heapify(self._flush_heap)
+        if len(self._drop_heap) > 2 * self._total_count + COMPACT_THRESHOLD:
+            self._drop_heap = [(-self._timestamp(next_flush), tr_id, next_flush)
+                               for tr_id, next_flush in self._next_flushes.iteritems()]
+            heapq.heapify(self._drop_heap)
+
     def _remove(self, tr):
         '''Safely remove transaction from list'''
-        try:
-            self._transactions.remove(tr)
-        except ValueError:
+        tr_id = tr.get_id()
+        if self._transactions_by_id.pop(tr_id, None) is None:
             # Should not happen if we order the queue consistently, but we should catch the error anyway
-            log.warn("Tried to remove transaction %s from queue but it was not in the queue anymore.", tr.get_id())
+            log.warn("Tried to remove transaction %s from queue but it was not in the queue anymore.", tr_id)
         else:
+            del self._next_flushes[tr_id]
+            self._waiting.discard(tr_id)
             self._total_count -= 1
             self._total_size -= tr.get_size()
 
@@ -160,12 +366,11 @@ class TransactionManager(object):
             log.debug("A flush is already in progress, not doing anything")
             return
 
-        to_flush = []
+        self._load_spilled()
+        self._compact_heaps()
+
         # Do we have something to do ?
-        now = datetime.utcnow()
-        for tr in self._transactions:
-            if tr.time_to_flush(now):
-                to_flush.append(tr)
+        to_flush = self._pop_due(datetime.utcnow())
 
         count = len(to_flush)
         should_log = self._flush_count + 1 <= FLUSH_LOGGING_INITIAL or (self._flush_count + 1) % FLUSH_LOGGING_PERIOD == 0
@@ -179,7 +384,7 @@ class TransactionManager(object):
             self._finished_flushes = 0
 
             # We sort LIFO-style, taking into account errors
-            self._trs_to_flush = sorted(to_flush, key=lambda tr: (- tr._error_count, tr._id))
+            self._trs_to_flush = sorted(self._coalesce(to_flush), key=lambda tr: (- tr._error_count, tr._id))
             self._flush_time = datetime.utcnow()
             self.flush_next()
         else:
@@ -199,7 +404,9 @@ class TransactionManager(object):
             flush_count=self._flush_count,
             transactions_received=self._transactions_received,
             transactions_flushed=self._transactions_flushed,
-            transactions_rejected=self._transactions_rejected).persist()
+            transactions_rejected=self._transactions_rejected,
+            spilled_count=self._spilled_count(),
+            spilled_size=self._spilled_size()).persist()
 
     def flush_next(self):
 
@@ -210,17 +417,17 @@ class TransactionManager(object):
                 for tr in self._trs_to_flush:
                     # Recompute these transactions' next flush so that if we hit the max queue size
                     # newer transactions are preserved
-                    tr.compute_next_flush(self._MAX_WAIT_FOR_REPLAY)
+                    for transaction in self._unbatch(tr):
+                        transaction.compute_next_flush(self._MAX_WAIT_FOR_REPLAY)
+                        self._schedule(transaction)
                 self._trs_to_flush = []
                 return self.flush_next()
 
-            td = self._last_flush + self._THROTTLING_DELAY - datetime.utcnow()
-            delay = td.total_seconds()
+            index, delay = self._next_tr_to_flush()
 
-            if delay <= 0 and self._running_flushes < self._MAX_PARALLELISM:
-                tr = self._trs_to_flush.pop()
-                self._running_flushes += 1
-                self._last_flush = datetime.utcnow()
+            if index is not None:
+                tr = self._trs_to_flush.pop(index)
+                self._start_flush(tr)
                 log.debug("Flushing transaction %d", tr.get_id())
                 try:
                     tr.flush()
@@ -231,7 +438,7 @@ class TransactionManager(object):
             # Every running flushes relaunches a flush once it's finished
             # If we are already at MAX_PARALLELISM, do nothing
             # Otherwise, schedule a flush as soon as possible (throttling)
-            elif self._running_flushes < self._MAX_PARALLELISM:
+            elif delay is not None:
                 # Wait a little bit more
                 tornado_ioloop = ioloop.IOLoop.current()
                 if tornado_ioloop._running:
@@ -253,9 +460,144 @@ class TransactionManager(object):
         else:
             log.debug("Flush in progress, %s flushes running", self._running_flushes)
 
-    def tr_error(self, tr):
+    def _coalesce(self, to_flush):
+        """Merge the transactions to flush sharing a merge key into batches"""
+        if self._MAX_BATCH_SIZE is None:
+            return to_flush
+
+        coalesced = []
+        by_key = {}
+        for tr in to_flush:
+            key = None if tr._split else tr.get_merge_key()
+            if key is None:
+                coalesced.append(tr)
+            else:
+                by_key.setdefault(key, []).append(tr)
+
+        for trs in by_key.itervalues():
+            batch = []
+            batch_size = 0
+            for tr in sorted(trs, key=attrgetter('_id')):
+                if batch and batch_size + tr.get_size() > self._MAX_BATCH_SIZE:
+                    coalesced.extend(self._merge(batch))
+                    batch = []
+                    batch_size = 0
+                batch.append(tr)
+                batch_size += tr.get_size()
+            coalesced.extend(self._merge(batch))
+        return coalesced
+
+    def _merge(self, trs):
+        """Return the transactions to flush in place of `trs`: a batch of
+           them, or themselves if they can't be merged"""
+        if len(trs) == 1:
+            return trs
+        try:
+            batch = trs[0].merge(trs)
+        except Exception:
+            log.exception("Unable to merge %s transactions, sending them one by one", len(trs))
+            for tr in trs:
+                tr._split = True
+            return trs
+
+        batch.set_id(self.get_tr_id())
+        batch._batch = trs
+        batch._error_count = max(tr.get_error_count() for tr in trs)
+        log.debug("Merged %s transactions into transaction %d (%s bytes)",
+                  len(trs), batch.get_id(), batch.get_size())
+        return [batch]
+
+    def _unbatch(self, tr):
+        return tr._batch if tr._batch is not None else [tr]
+
+    def _next_tr_to_flush(self):
+        """Return the index in _trs_to_flush of the next transaction to flush,
+           or None and the delay after which to try again, if any"""
+        if self._running_flushes >= self._MAX_PARALLELISM:
+            return None, None
+
+        now = datetime.utcnow()
+        if self._MAX_ENDPOINT_PARALLELISM is None:
+            delay = (self._last_flush + self._THROTTLING_DELAY - now).total_seconds()
+            if delay <= 0:
+                return len(self._trs_to_flush) - 1, None
+            return None, delay
+
+        # Newest transaction of an endpoint which can take one more flush
+        min_delay = None
+        seen = set()
+        for index in xrange(len(self._trs_to_flush) - 1, -1, -1):
+            endpoint = self._trs_to_flush[index]._endpoint
+            if endpoint in seen:
+                continue
+            seen.add(endpoint)
+            window = self.get_endpoint_window(endpoint)
+            # A full window is relaunched by its running flushes
+            if window.is_full():
+                continue
+            delay = window.throttling_delay(self._THROTTLING_DELAY, now)
+            if delay <= 0:
+                return index, None
+            if min_delay is None or delay < min_delay:
+                min_delay = delay
+        return None, min_delay
+
+    def _start_flush(self, tr):
+        now = datetime.utcnow()
+        self._running_flushes += 1
+        self._last_flush = now
+        if self._MAX_ENDPOINT_PARALLELISM is not None:
+            self.get_endpoint_window(tr._endpoint).start(now)
+            self._running[tr.get_id()] = (tr._endpoint, time.time())
+
+    def _finish_flush(self, tr, success=None):
+        """Account for the end of a flush, `success` is None when the outcome
+           says nothing about the endpoint health"""
         self._running_flushes -= 1
         self._finished_flushes += 1
+        running = self._running.pop(tr.get_id(), None)
+        if running is None:
+            return
+        endpoint, start = running
+        window = self.get_endpoint_window(endpoint)
+        if success is None:
+            window.done()
+        elif success:
+            window.success(time.time() - start)
+        else:
+            window.error()
+            log.debug("Endpoint %s in error, flushing up to %d transactions at once",
+                      endpoint, int(window.size))
+
+    def tr_error(self, tr):
+        self._finish_flush(tr, success=False)
+        replayed = False
+        for transaction in self._unbatch(tr):
+            replayed = self._tr_failed(transaction) or replayed
+        if not replayed:
+            return
+
+        self._endpoints_errors[tr._endpoint] = self._endpoints_errors.get(tr._endpoint, 0) + 1
+        # Endpoint failed too many times, it's probably an enpoint issue
+        # Let's avoid blocking on it
+        if self._endpoints_errors[tr._endpoint] == self._MAX_ENDPOINT_ERRORS:
+            new_trs_to_flush = []
+            for transaction in self._trs_to_flush:
+                if transaction._endpoint != tr._endpoint:
+                    new_trs_to_flush.append(transaction)
+                else:
+                    for t in self._unbatch(transaction):
+                        t.compute_next_flush(self._MAX_WAIT_FOR_REPLAY)
+                        self._schedule(t)
+            log.debug('Endpoint %s seems down, removed %s transaction from current flush',
+                      tr._endpoint,
+                      len(self._trs_to_flush) - len(new_trs_to_flush))
+
+            self._trs_to_flush = new_trs_to_flush
+
+    def _tr_failed(self, tr):
+        """Remove a failed transaction or schedule its replay, return whether
+           it will be replayed"""
         tr.inc_error_count()
         if tr.get_error_count() > self._MAX_ENDPOINT_ERRORS:
             log.warn("Transaction %d failed too many (%d) times, removing",
@@ -271,33 +613,38 @@ class TransactionManager(object):
                 flush_count=self._flush_count,
                 transactions_received=self._transactions_received,
                 transactions_flushed=self._transactions_flushed,
-                transactions_rejected=self._transactions_rejected).persist()
-        else:
-            tr.compute_next_flush(self._MAX_WAIT_FOR_REPLAY)
-            log.warn("Transaction %d in error (%s error%s), it will be replayed after %s",
-                     tr.get_id(),
-                     tr.get_error_count(),
-                     plural(tr.get_error_count()),
-                     tr.get_next_flush())
-            self._endpoints_errors[tr._endpoint] = self._endpoints_errors.get(tr._endpoint, 0) + 1
-            # Endpoint failed too many times, it's probably an enpoint issue
-            # Let's avoid blocking on it
-            if self._endpoints_errors[tr._endpoint] == self._MAX_ENDPOINT_ERRORS:
-                new_trs_to_flush = []
-                for transaction in self._trs_to_flush:
-                    if transaction._endpoint != tr._endpoint:
-                        new_trs_to_flush.append(transaction)
-                    else:
-                        transaction.compute_next_flush(self._MAX_WAIT_FOR_REPLAY)
-                log.debug('Endpoint %s seems down, removed %s transaction from current flush',
-                          tr._endpoint,
-                          len(self._trs_to_flush) - len(new_trs_to_flush))
-
-                self._trs_to_flush = new_trs_to_flush
+                transactions_rejected=self._transactions_rejected,
+                spilled_count=self._spilled_count(),
+                spilled_size=self._spilled_size()).persist()
+            return False
+
+        tr.compute_next_flush(self._MAX_WAIT_FOR_REPLAY)
+        self._schedule(tr)
+        log.warn("Transaction %d in error (%s error%s), it will be replayed after %s",
+                 tr.get_id(),
+                 tr.get_error_count(),
+                 plural(tr.get_error_count()),
+                 tr.get_next_flush())
+        return True
 
     def tr_error_reject_request(self, tr, response_code):
-        self._running_flushes -= 1
-        self._finished_flushes += 1
+        self._finish_flush(tr)
+        if tr._batch is not None:
+            # One of the payloads may be at fault, send them one by one
+            log.warn("Transaction %d has been rejected (code %d, size %sKB), sending its %s transactions separately",
+                     tr.get_id(),
+                     response_code,
+                     tr.get_size() / 1024,
+                     len(tr._batch))
+            for transaction in tr._batch:
+                transaction._split = True
+            if self._trs_to_flush is not None:
+                self._trs_to_flush.extend(tr._batch)
+            else:
+                for transaction in tr._batch:
+                    self._schedule(transaction)
+            return
+
         tr.inc_error_count()
         log.warn("Transaction %d has been rejected (code %d, size %sKB), it will not be replayed",
                  tr.get_id(),
@@ -313,12 +660,14 @@ class TransactionManager(object):
             flush_count=self._flush_count,
             transactions_received=self._transactions_received,
             transactions_flushed=self._transactions_flushed,
-            transactions_rejected=self._transactions_rejected).persist()
+            transactions_rejected=self._transactions_rejected,
+            spilled_count=self._spilled_count(),
+            spilled_size=self._spilled_size()).persist()
 
     def tr_success(self, tr):
-        self._running_flushes -= 1
-        self._finished_flushes += 1
+        self._finish_flush(tr, success=True)
         log.debug("Transaction %d completed",  tr.get_id())
-        self._remove(tr)
-        self._transactions_flushed += 1
+        for transaction in self._unbatch(tr):
+            self._remove(transaction)
+            self._transactions_flushed += 1
         self.print_queue_stats()
@@ -0,0 +1,259 @@
+# stdlib
+import json
+import logging
+import os
+import struct
+import zlib
+
+log = logging.getLogger(__name__)
+
+INDEX_FILE = 'index.json'
+SEGMENT_FILE_FORMAT = '%012d.seg'
+# Header of each record: length and CRC32 of the payload
+RECORD_HEADER = struct.Struct('>Ii')
+DEFAULT_SEGMENT_SIZE = 4 * 1024 * 1024
+
+# Fields of the in-memory description of a segment
+_NAME, _OFFSET, _SIZE, _COUNT = range(4)
+
+
+class DiskQueue(object):
+    """
+    FIFO queue of byte strings persisted in a directory, to keep data across
+    restarts and beyond what fits in memory.
+
+    Records are appended to segment files, each prefixed by its length and
+    CRC32. The index lists the segments in reading order with the offset of
+    the next record to read in each of them. Segments are deleted once read,
+    and the oldest ones are dropped when the queue holds more than `max_size`
+    bytes.
+    """
+    def __init__(self, path, max_size, segment_size=DEFAULT_SEGMENT_SIZE):
+        self.path = path
+        self.max_size = max_size
+        # Keep several segments so that dropping the oldest one frees space
+        self.segment_size = max(1, min(segment_size, max_size // 4))
+        # [name, offset, size, count of unread records], in reading order
+        self.segments = []
+        self.next_segment_id = 0
+        self.count = 0
+        self.size = 0
+        self.dropped_count = 0
+        self._writer = None
+        self._reader = None
+        self._load()
+
+    def __len__(self):
+        return self.count
+
+    def _segment_path(self, name):
+        return os.path.join(self.path, name)
+
+    def _load(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        index = {}
+        index_path = os.path.join(self.path, INDEX_FILE)
+        if os.path.exists(index_path):
+            try:
+                with open(index_path) as f:
+                    index = json.load(f)
+            except (IOError, ValueError):
+                log.exception("Unable to read the queue index %s, starting with an empty queue", index_path)
+
+        self.next_segment_id = index.get('next_segment_id', 0)
+        for name, offset in index.get('segments', []):
+            segment = self._scan_segment(name, offset)
+            if segment is not None:
+                self.segments.append(segment)
+                self.count += segment[_COUNT]
+                self.size += segment[_SIZE] - segment[_OFFSET]
+
+        # Segments created right before a crash, which never made it to the index
+        indexed = set(segment[_NAME] for segment in self.segments)
+        for name in os.listdir(self.path):
+            if name.endswith('.seg') and name not in indexed:
+                os.remove(self._segment_path(name))
+
+        self._write_index()
+        if self.count:
+            log.info("Loaded %s queued records (%s bytes) from %s", self.count, self.size, self.path)
+
+    def _scan_segment(self, name, offset):
+        """
+        Count the records of a segment from `offset`, and truncate a record
+        left incomplete by a crash.
+        """
+        path = self._segment_path(name)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            log.warning("Queue segment %s is missing, skipping it", path)
+            return None
+
+        count = 0
+        position = offset
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                length = RECORD_HEADER.unpack(header)[0]
+                if position + RECORD_HEADER.size + length > size:
+                    break
+                position += RECORD_HEADER.size + length
+                count += 1
+                f.seek(position)
+
+        if position < size:
+            log.warning("Truncating %s bytes of incomplete record from %s", size - position, path)
+            with open(path, 'r+b') as f:
+                f.truncate(position)
+
+        return [name, offset, position, count]
+
+    def _write_index(self):
+        index_path = os.path.join(self.path, INDEX_FILE)
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump({
+                'segments': [[segment[_NAME], segment[_OFFSET]] for segment in self.segments],
+                'next_segment_id': self.next_segment_id,
+            }, f)
+        os.rename(index_path + '.tmp', index_path)
+
+    def _new_segment_name(self):
+        name = SEGMENT_FILE_FORMAT % self.next_segment_id
+        self.next_segment_id += 1
+        return name
+
+    def append(self, record):
+        tail = self.segments[-1] if self.segments else None
+        if self._writer is None or tail[_SIZE] >= self.segment_size:
+            self._close_writer()
+            tail = [self._new_segment_name(), 0, 0, 0]
+            self.segments.append(tail)
+            self._write_index()
+            self._writer = open(self._segment_path(tail[_NAME]), 'ab')
+
+        self._writer.write(RECORD_HEADER.pack(len(record), zlib.crc32(record)) + record)
+        self._writer.flush()
+
+        record_size = RECORD_HEADER.size + len(record)
+        tail[_SIZE] += record_size
+        tail[_COUNT] += 1
+        self.size += record_size
+        self.count += 1
+
+        while self.size > self.max_size and len(self.segments) > 1:
+            segment = self.segments[0]
+            log.warning("Queue %s is over %s bytes, dropping its %s oldest records",
+                        self.path, self.max_size, segment[_COUNT])
+            self.dropped_count += segment[_COUNT]
+            self._remove_head_segment()
+
+    def prepend(self, records):
+        """
+        Queue `records` ahead of the records already queued.
+        """
+        if not records:
+            return
+
+        name = self._new_segment_name()
+        size = 0
+        with open(self._segment_path(name), 'wb') as f:
+            for record in records:
+                f.write(RECORD_HEADER.pack(len(record), zlib.crc32(record)) + record)
+                size += RECORD_HEADER.size + len(record)
+
+        self._close_reader()
+        self.segments.insert(0, [name, 0, size, len(records)])
+        self.size += size
+        self.count += len(records)
+        self._write_index()
+
+    def pop(self, max_size):
+        """
+        Dequeue the oldest records, as many as fit in `max_size` bytes. The
+        first record is returned even if it is bigger.
+        """
+        records = []
+        records_size = 0
+        while self.segments:
+            segment = self.segments[0]
+            if segment[_OFFSET] >= segment[_SIZE]:
+                if len(self.segments) == 1 and self._writer is not None:
+                    break
+                self._remove_head_segment()
+                continue
+
+            if self._reader is None:
+                self._reader = open(self._segment_path(segment[_NAME]), 'rb')
+            self._reader.seek(segment[_OFFSET])
+            length, crc = RECORD_HEADER.unpack(self._reader.read(RECORD_HEADER.size))
+            if records and records_size + length > max_size:
+                break
+
+            record_size = RECORD_HEADER.size + length
+            if segment[_OFFSET] + record_size > segment[_SIZE]:
+                log.warning("Skipping the corrupted end of %s", self._segment_path(segment[_NAME]))
+                self.dropped_count += segment[_COUNT]
+                self.count -= segment[_COUNT]
+                self.size -= segment[_SIZE] - segment[_OFFSET]
+                segment[_OFFSET], segment[_COUNT] = segment[_SIZE], 0
+                continue
+
+            record = self._reader.read(length)
+            segment[_OFFSET] += record_size
+            segment[_COUNT] -= 1
+            self.size -= record_size
+            self.count -= 1
+            if zlib.crc32(record) != crc:
+                log.warning("Skipping a corrupted record of %s", self._segment_path(segment[_NAME]))
+                self.dropped_count += 1
+                continue
+
+            records.append(record)
+            records_size += length
+            if records_size >= max_size:
+                break
+
+        if not self.count:
+            self._reset()
+        self._write_index()
+        return records
+
+    def _remove_head_segment(self):
+        segment = self.segments.pop(0)
+        self._close_reader()
+        if not self.segments:
+            self._close_writer()
+        self.size -= segment[_SIZE] - segment[_OFFSET]
+        self.count -= segment[_COUNT]
+        try:
+            os.remove(self._segment_path(segment[_NAME]))
+        except OSError:
+            log.warning("Unable to remove queue segment %s", segment[_NAME])
+        self._write_index()
+
+    def _reset(self):
+        """ Remove the segments of an empty queue. """
+        while self.segments:
+            self._remove_head_segment()
+        self.size = 0
+
+    def _close_reader(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    def _close_writer(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def close(self):
+        self._close_reader()
+        self._close_writer()
+        self._write_index()
@@ -0,0 +1,110 @@
+# stdlib
+from collections import OrderedDict
+import json as stdlib_json
+import logging
+
+# 3p
+import simplejson
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+log = logging.getLogger(__name__)
+
+# Error of ujson on objects it can't serialize, e.g. big integers or strings
+# which aren't valid UTF-8
+UJSON_ENCODE_ERRORS = (OverflowError, TypeError, ValueError, UnicodeDecodeError)
+# Decimals of the floats serialized by ujson, its maximum: smaller floats
+# are serialized as 0
+UJSON_DOUBLE_PRECISION = 15
+# Codec used unless the `json_codec` [Main] option selects another one
+DEFAULT_CODEC = 'simplejson'
+
+
+class JSONCodec(object):
+    """
+    JSON library used to serialize and deserialize payloads.
+
+    Like simplejson, `dumps` raises UnicodeDecodeError when a string isn't
+    valid UTF-8, for the callers to sanitize their payload.
+    """
+    def __init__(self, name, dumps, loads):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+
+    def __repr__(self):
+        return "JSONCodec(%s)" % self.name
+
+
+def _ujson_dumps(obj):
+    try:
+        return ujson.dumps(obj, double_precision=UJSON_DOUBLE_PRECISION)
+    except UJSON_ENCODE_ERRORS:
+        # Let simplejson serialize it, or raise the usual error
+        return simplejson.dumps(obj)
+
+
+def _ujson_loads(s):
+    return ujson.loads(s, precise_float=True)
+
+
+def _has_ujson():
+    if ujson is None:
+        return False
+    try:
+        # Older versions of ujson lose float precision
+        _ujson_loads('0.1')
+    except TypeError:
+        log.debug("ujson %s is too old, not using it", getattr(ujson, '__version__', ''))
+        return False
+    return True
+
+
+def get_codecs():
+    """
+    Codecs of the available JSON libraries, by name.
+    """
+    codecs = OrderedDict()
+    if _has_ujson():
+        codecs['ujson'] = JSONCodec('ujson', _ujson_dumps, _ujson_loads)
+    codecs['simplejson'] = JSONCodec('simplejson', simplejson.dumps, simplejson.loads)
+    codecs['json'] = JSONCodec('json', stdlib_json.dumps, stdlib_json.loads)
+    return codecs
+
+
+def get_default_codec():
+    """
+    simplejson, which serialized the payloads before the codecs: the other
+    ones are faster (see tests/core/benchmark_json_codec.py) but don't
+    serialize every payload the same way. ujson rounds the floats to
+    `UJSON_DOUBLE_PRECISION` decimals, the standard library serializes
+    namedtuples as arrays and ignores `for_json`.
+    """
+    return get_codecs()[DEFAULT_CODEC]
+
+
+codec = get_default_codec()
+
+
+def configure(agentConfig):
+    """
+    Use the codec selected by the `json_codec` [Main] option, if any.
+    """
+    global codec
+    name = agentConfig.get('json_codec') or DEFAULT_CODEC
+    codecs = get_codecs()
+    if name not in codecs:
+        log.warning("JSON codec %s is not available, using %s", name, DEFAULT_CODEC)
+        name = DEFAULT_CODEC
+    codec = codecs[name]
+    log.debug("Using %r to serialize payloads", codec)
+
+
+def dumps(obj):
+    return codec.dumps(obj)
+
+
+def loads(s):
+    return codec.loads(s)
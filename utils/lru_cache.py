@@ -0,0 +1,48 @@
+# Sentinel telling a miss apart from a cached None
+_MISSING = object()
+
+
+class LRUCache(object):
+    """
+    Bounded mapping that keeps the most recently used entries.
+
+    The LRU order is approximated with two generations of plain dicts so that
+    a hit costs a single dict lookup: once the current generation is full it
+    becomes the previous one, and entries of the previous generation survive
+    the next rotation only if they are used again in between.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._generation_size = max(1, max_size // 2)
+        self._current = {}
+        self._previous = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        value = self._current.get(key, _MISSING)
+        if value is _MISSING:
+            value = self._previous.get(key, _MISSING)
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self.set(key, value)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        current = self._current
+        if len(current) >= self._generation_size and key not in current:
+            self._previous = current
+            self._current = current = {}
+        current[key] = value
+
+    def clear(self):
+        self._current = {}
+        self._previous = {}
+
+    def __len__(self):
+        return len(self._current) + len([k for k in self._previous if k not in self._current])
+
+    def __contains__(self, key):
+        return key in self._current or key in self._previous
@@ -1,9 +1,11 @@
 
 # lib
 import ctypes
+import os
 import time
 import random
 import socket
+import struct
 
 
 # 3p
@@ -26,8 +28,25 @@ try:
 except AttributeError:
     IPV6_V6ONLY = 27  # from `Ws2ipdef.h`
 
+# Not exposed by the python 2 socket module
+try:
+    SO_REUSEPORT = socket.SO_REUSEPORT
+except AttributeError:
+    SO_REUSEPORT = 15  # from `asm-generic/socket.h`, Linux >= 3.9
+
+try:
+    SO_PEERCRED = socket.SO_PEERCRED
+except AttributeError:
+    SO_PEERCRED = 17  # from `asm-generic/socket.h`
+
+# struct ucred: pid, uid, gid
+UCRED_FORMAT = '3i'
+
 DEFAULT_DNS_TTL = 300
 
+# Files listing the UDP sockets of the host, with their receive queue drops
+PROC_NET_UDP_FILES = ('net/udp', 'net/udp6')
+
 class sockaddr(ctypes.Structure):
     _fields_ = [("sa_family", ctypes.c_short),
                 ("__pad1", ctypes.c_ushort),
@@ -59,6 +78,44 @@ class DNSCache(object):
 
         return resolve
 
+def get_udp_socket_drops(sock, procfs_path='/proc'):
+    """
+    Return the number of datagrams dropped by the kernel for the given UDP
+    socket because its receive buffer was full, or None if the counter is not
+    available on this platform.
+    """
+    try:
+        inode = str(os.fstat(sock.fileno()).st_ino)
+    except (OSError, AttributeError, ValueError):
+        return None
+
+    for proc_file in PROC_NET_UDP_FILES:
+        try:
+            with open(os.path.join(procfs_path, proc_file)) as f:
+                # sl local_address rem_address st tx_queue:rx_queue tr:tm->when
+                # retrnsmt uid timeout inode ref pointer drops
+                for line in f.readlines()[1:]:
+                    fields = line.split()
+                    if len(fields) > 12 and fields[9] == inode:
+                        return int(fields[-1])
+        except (IOError, ValueError):
+            continue
+
+    return None
+
+
+def get_peer_credentials(sock):
+    """
+    Return the (pid, uid, gid) of the process connected to the given Unix
+    stream socket, or None if they are not available on this platform.
+    """
+    try:
+        ucred = sock.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, struct.calcsize(UCRED_FORMAT))
+        return struct.unpack(UCRED_FORMAT, ucred)
+    except (socket.error, struct.error):
+        return None
+
+
 def _inet_pton_win(address_family, ip_string):
     """
     Window specific version of `inet_pton` based on:
@@ -0,0 +1,98 @@
+# stdlib
+from math import ceil, log
+
+# Values closer to zero than this are counted in the zero bucket
+MIN_INDEXABLE_VALUE = 1e-9
+DEFAULT_RELATIVE_ACCURACY = 0.01
+DEFAULT_MAX_BINS = 2048
+
+
+class DDSketch(object):
+    """
+    Quantile sketch with a relative error guarantee, as described in
+    "DDSketch: A Fast and Fully-Mergeable Quantile Sketch with Relative-Error
+    Guarantees" (Masson, Rim, Lee - VLDB 2019).
+
+    Values are counted in logarithmically sized bins so that any quantile is
+    returned within `relative_accuracy` of its true value. Memory is bounded
+    by `max_bins` per sign: when it is exceeded the bins of the smallest
+    magnitudes are collapsed, which only degrades the lowest quantiles.
+    """
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY, max_bins=DEFAULT_MAX_BINS):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("relative_accuracy must be in ]0;1[")
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._multiplier = 1 / log(self.gamma)
+        self.positive_bins = {}
+        self.negative_bins = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def _value(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def add(self, value):
+        if value > MIN_INDEXABLE_VALUE:
+            bins = self.positive_bins
+            index = int(ceil(log(value) * self._multiplier))
+        elif value < -MIN_INDEXABLE_VALUE:
+            bins = self.negative_bins
+            index = int(ceil(log(-value) * self._multiplier))
+        else:
+            self.zero_count += 1
+            self.count += 1
+            return
+
+        bins[index] = bins.get(index, 0) + 1
+        self.count += 1
+        if len(bins) > self.max_bins:
+            self._collapse(bins)
+
+    def _collapse(self, bins):
+        indexes = sorted(bins)
+        overflow = len(indexes) - self.max_bins
+        collapsed = 0
+        for index in indexes[:overflow + 1]:
+            collapsed += bins.pop(index)
+        bins[indexes[overflow]] = collapsed
+
+    def merge(self, other):
+        for bins, other_bins in ((self.positive_bins, other.positive_bins),
+                                 (self.negative_bins, other.negative_bins)):
+            for index, count in other_bins.iteritems():
+                bins[index] = bins.get(index, 0) + count
+            if len(bins) > self.max_bins:
+                self._collapse(bins)
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    def quantile(self, q):
+        """
+        Return the value at quantile `q` (in [0;1]), or None if empty.
+        """
+        if not self.count:
+            return None
+
+        rank = q * (self.count - 1)
+        seen = 0
+        # Negative values, from the largest magnitude to the smallest
+        for index in sorted(self.negative_bins, reverse=True):
+            seen += self.negative_bins[index]
+            if seen > rank:
+                return -self._value(index)
+
+        seen += self.zero_count
+        if seen > rank:
+            return 0
+
+        for index in sorted(self.positive_bins):
+            seen += self.positive_bins[index]
+            if seen > rank:
+                return self._value(index)
+
+        return self._value(max(self.positive_bins)) if self.positive_bins else 0
+
+    def __len__(self):
+        return len(self.positive_bins) + len(self.negative_bins)
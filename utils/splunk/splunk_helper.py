@@ -1,6 +1,8 @@
 import time
 import requests
 import logging
+import threading
+from collections import defaultdict
 from urllib import urlencode, quote
 import jwt
 import datetime
@@ -11,13 +13,40 @@ from checks import CheckException, FinalizeException, TokenExpiredException
 
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
+# Connections kept alive to Splunk, at least; the default of requests
+DEFAULT_CONNECTION_POOL_SIZE = 10
+# The delay between the polls of a search doubles from its search_seconds_between_retries, up to this many times it
+SEARCH_MAX_BACKOFF_FACTOR = 8
+
 
 class SplunkHelper(object):
 
-    def __init__(self, instance_config):
+    def __init__(self, instance_config, connection_pool_size=DEFAULT_CONNECTION_POOL_SIZE):
+        """
+        :param connection_pool_size: the requests made at the same time to Splunk, the connections kept alive
+        """
         self.instance_config = instance_config
         self.log = logging.getLogger('%s' % __name__)
         self.requests_session = requests.session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(DEFAULT_CONNECTION_POOL_SIZE, connection_pool_size))
+        self.requests_session.mount('http://', adapter)
+        self.requests_session.mount('https://', adapter)
+        # seconds taken by the requests by endpoint category, until popped
+        self._request_latencies = defaultdict(list)
+        self._request_latencies_lock = threading.Lock()
+
+    def _record_latency(self, category, start_time):
+        with self._request_latencies_lock:
+            self._request_latencies[category].append(time.time() - start_time)
+
+    def pop_request_latencies(self):
+        """
+        :return: the seconds taken by the requests made since the last call, by endpoint category: dispatch, poll,
+        results and finalize
+        """
+        with self._request_latencies_lock:
+            latencies, self._request_latencies = self._request_latencies, defaultdict(list)
+        return latencies
 
     def auth_session(self):
         """
@@ -143,7 +172,7 @@ class SplunkHelper(object):
         :return: raw json response from splunk
         """
         search_path = '/servicesNS/-/-/search/jobs/%s/results?output_mode=json&offset=%s&count=%s' % (search_id, offset, count)
-        response = self._do_get(search_path, saved_search.request_timeout_seconds, self.instance_config.verify_ssl_certificate)
+        response = self._get_search_chunk(search_path, saved_search)
         retry_count = 0
 
         # retry until information is available.
@@ -151,20 +180,40 @@ class SplunkHelper(object):
             self.log.debug("Splunk has no result available yet for saved search {}. Going to retry".format(saved_search.name))
             if retry_count == saved_search.search_max_retry_count:
                 raise CheckException("maximum retries reached for %s with saved search %s" % (self.instance_config.base_url, saved_search.name))
+            time.sleep(self._search_backoff(saved_search, retry_count))
             retry_count += 1
-            time.sleep(saved_search.search_seconds_between_retries)
-            response = self._do_get(search_path, saved_search.request_timeout_seconds, self.instance_config.verify_ssl_certificate)
+            response = self._get_search_chunk(search_path, saved_search)
 
         return response.json()
 
+    @staticmethod
+    def _search_backoff(saved_search, retry_count):
+        """
+        :return: the seconds to wait before the retry `retry_count` (from 0) of a poll of the search results
+        """
+        seconds_between_retries = saved_search.search_seconds_between_retries
+        return min(seconds_between_retries * 2 ** retry_count, seconds_between_retries * SEARCH_MAX_BACKOFF_FACTOR)
+
+    def _get_search_chunk(self, search_path, saved_search):
+        start_time = time.time()
+        category = 'poll'
+        try:
+            response = self._do_get(search_path, saved_search.request_timeout_seconds, self.instance_config.verify_ssl_certificate)
+            if response.status_code != 204:
+                category = 'results'
+            return response
+        finally:
+            self._record_latency(category, start_time)
+
     def saved_search_results(self, search_id, saved_search):
         """
-        Perform a saved search, returns a list of responses that were received
+        Perform a saved search, yields the responses as they are received, a
+        page of `batch_size` results is only requested once the previous one
+        was consumed
         """
         # fetch results in batches
         offset = 0
         nr_of_results = None
-        results = []
         while nr_of_results is None or nr_of_results == saved_search.batch_size:
             response = self._search_chunk(saved_search, search_id, offset, saved_search.batch_size)
             # received a message?
@@ -172,10 +221,9 @@ class SplunkHelper(object):
                 if message['type'] == "FATAL":
                     raise CheckException("Received FATAL exception from Splunk, got: " + message['text'])
 
-            results.append(response)
             nr_of_results = len(response['results'])
             offset += nr_of_results
-        return results
+            yield response
 
     def dispatch(self, saved_search, splunk_user, splunk_app, splunk_ignore_saved_search_errors, parameters):
         """
@@ -189,7 +237,12 @@ class SplunkHelper(object):
             # in case of token based mechanism, username won't exist and need to use `user` from token config
             splunk_user = self.instance_config.name
         dispatch_path = '/servicesNS/%s/%s/saved/searches/%s/dispatch' % (splunk_user, splunk_app, quote(saved_search.name))
-        response_body = self._do_post(dispatch_path, parameters, saved_search.request_timeout_seconds, splunk_ignore_saved_search_errors).json()
+        start_time = time.time()
+        try:
+            response = self._do_post(dispatch_path, parameters, saved_search.request_timeout_seconds, splunk_ignore_saved_search_errors)
+        finally:
+            self._record_latency('dispatch', start_time)
+        response_body = response.json()
         return response_body.get("sid")
 
     def finalize_sid(self, search_id, saved_search):
@@ -199,6 +252,7 @@ class SplunkHelper(object):
         """
         finish_path = '/services/search/jobs/%s/control' % (search_id)
         payload = "action=finalize"
+        start_time = time.time()
         try:
             res = self._do_post(finish_path, payload, saved_search.request_timeout_seconds, splunk_ignore_saved_search_errors=False)
             # api returns 200 in general and even in case when saved search is already finalized
@@ -219,6 +273,8 @@ class SplunkHelper(object):
         except ConnectionError as error:
             self.log.error("Search job not finalized as connection error occured %s" % error.message)
             raise FinalizeException(None, error.message)
+        finally:
+            self._record_latency('finalize', start_time)
 
     def _do_get(self, path, request_timeout_seconds, verify_ssl_certificate):
         url = "%s%s" % (self.instance_config.base_url, path)
@@ -1,3 +1,4 @@
+from checks.libs.thread_pool import Pool
 from utils.splunk.splunk import SplunkSavedSearch
 from utils.splunk.splunk_helper import SplunkHelper
 
@@ -40,7 +41,6 @@ class SplunkTelemetrySavedSearch(SplunkSavedSearch):
 class SplunkTelemetryInstance(object):
     def __init__(self, current_time, instance, instance_config, saved_searches):
         self.instance_config = instance_config
-        self.splunkHelper = SplunkHelper(instance_config)
 
         # no saved searches may be configured
         if not isinstance(instance['saved_searches'], list):
@@ -48,11 +48,24 @@ class SplunkTelemetryInstance(object):
 
         self.saved_searches = saved_searches
         self.saved_searches_parallel = int(instance.get('saved_searches_parallel', self.instance_config.get_or_default('default_saved_searches_parallel')))
+        # the searches retrieved in parallel and the requests of the check, over the lifetime of the instance
+        self.splunkHelper = SplunkHelper(instance_config, connection_pool_size=self.saved_searches_parallel + 1)
+        self._search_pool = None
         self.tags = instance.get('tags', [])
         self.initial_delay_seconds = int(instance.get('initial_delay_seconds', self.instance_config.get_or_default('default_initial_delay_seconds')))
         self.launch_time_seconds = current_time
         self.unique_key_fields = instance.get('unique_key_fields', self.instance_config.get_or_default('default_unique_key_fields'))
 
+    def get_search_pool(self):
+        """
+        Threads retrieving the results of the saved searches, kept for the lifetime of the instance: a retrieval
+        still retrying at the end of a check run holds one of them, so the searches of the next runs never have
+        more than `saved_searches_parallel` retrievals in flight.
+        """
+        if self._search_pool is None:
+            self._search_pool = Pool(max(1, self.saved_searches_parallel), name="SplunkSearches", daemon=True)
+        return self._search_pool
+
     def initial_time_done(self, current_time_seconds):
         return current_time_seconds >= self.launch_time_seconds + self.initial_delay_seconds
 
@@ -1,9 +1,73 @@
+from collections import deque
+from functools import partial
+import Queue
+import sys
+import threading
 import time
 
 from checks.check_status import CheckData
 from checks import AgentCheck, CheckException, FinalizeException, TokenExpiredException
 
-from utils.splunk.splunk import chunks, take_required_field, time_to_seconds, get_utc_time
+from utils.splunk.splunk import take_required_field, time_to_seconds, get_utc_time
+
+
+# Seconds taken by the requests to Splunk
+REQUEST_TIME_METRIC = "stackstate.agent.splunk.request_time"
+# Pages of results of a saved search retrieved ahead of the ones processed
+SEARCH_RESULTS_PREFETCH = 1
+
+
+class PrefetchedSearchResults(object):
+    """
+    Streams the pages of the results of a saved search from the thread which
+    retrieves them, `fetch`, to the thread which iterates over them. Up to
+    `prefetch` pages are retrieved ahead of the one being processed, so a
+    search never holds all of its results in memory.
+    """
+    _END = object()
+
+    def __init__(self, pages, prefetch=SEARCH_RESULTS_PREFETCH):
+        # callable returning an iterable of the pages
+        self._pages = pages
+        self._queue = Queue.Queue(max(1, prefetch))
+        self._cancelled = threading.Event()
+
+    def fetch(self):
+        try:
+            for page in self._pages():
+                if not self._put((page, None)):
+                    return
+        except Exception:
+            self._put((None, sys.exc_info()))
+            return
+        self._put((self._END, None))
+
+    def _put(self, item):
+        if self._cancelled.is_set():
+            return False
+        self._queue.put(item)
+        return True
+
+    def cancel(self):
+        """
+        Stop the retrieval of the pages, e.g. when their processing failed.
+        """
+        self._cancelled.set()
+        # unblock the retrieval waiting for room, it checks the flag before its next page
+        try:
+            while True:
+                self._queue.get_nowait()
+        except Queue.Empty:
+            pass
+
+    def __iter__(self):
+        while True:
+            page, exc_info = self._queue.get()
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if page is self._END:
+                return
+            yield page
 
 
 class SplunkTelemetryBase(AgentCheck):
@@ -77,9 +141,7 @@ class SplunkTelemetryBase(AgentCheck):
             self.load_status()
             instance.update_status(current_time, self.status)
 
-            executed_searches = False
-            for saved_searches in chunks(instance.saved_searches.searches, instance.saved_searches_parallel):
-                executed_searches |= self._dispatch_and_await_search(instance, saved_searches)
+            executed_searches = self._dispatch_and_await_search(instance, instance.saved_searches.searches)
 
             if len(instance.saved_searches.searches) != 0 and not executed_searches:
                 raise CheckException("No saved search was successfully executed.")
@@ -96,6 +158,17 @@ class SplunkTelemetryBase(AgentCheck):
             if not instance.instance_config.ignore_saved_search_errors:
                 raise CheckException("Error getting Splunk data, please check your configuration. Message: " + str(e))
             self.log.warning("Ignoring the exception since the flag ignore_saved_search_errors is true")
+        finally:
+            self._send_request_latencies(instance)
+
+    def _send_request_latencies(self, instance):
+        """
+        Send the time taken by the requests to Splunk, by endpoint category, as a histogram
+        """
+        for category, latencies in instance.splunkHelper.pop_request_latencies().iteritems():
+            tags = ["endpoint:%s" % category, "url:%s" % instance.instance_config.base_url] + instance.tags
+            for latency in latencies:
+                self.histogram(REQUEST_TIME_METRIC, latency, tags=tags)
 
     def get_instance(self, instance, current_time):
         raise NotImplementedError
@@ -105,49 +178,90 @@ class SplunkTelemetryBase(AgentCheck):
         self.log.warn(msg)
 
     def _dispatch_and_await_search(self, instance, saved_searches):
-        start_time = self._current_time_seconds()
-        search_ids = []
-
-        for saved_search in saved_searches:
-            try:
-                # a unique saved search key to persist the data
-                persist_status_key = instance.instance_config.base_url + saved_search.name
-                if self.status.data.get(persist_status_key) is not None:
-                    sid = self.status.data[persist_status_key]
-                    self._finalize_sid(instance, sid, saved_search)
-                    self.update_persistent_status(instance.instance_config.base_url, saved_search.name, sid, 'remove')
-                sid = self._dispatch_saved_search(instance, saved_search)
-                self.update_persistent_status(instance.instance_config.base_url, saved_search.name, sid, "add")
-                search_ids.append((sid, saved_search))
-            except FinalizeException as e:
-                self.log.exception("Got an error %s while finalizing the saved search %s" % (e.message, saved_search.name))
-                if not instance.instance_config.ignore_saved_search_errors:
-                    raise e
-                self.log.warning("Ignoring the finalize exception as ignore_saved_search_errors flag is true")
-            except Exception as e:
-                self._log_warning(instance, "Failed to dispatch saved search '%s' due to: %s" % (saved_search.name, e.message))
+        """
+        Dispatch the saved searches and process their results, with up to
+        `saved_searches_parallel` searches in flight at once. The results of
+        the searches in flight are polled and retrieved concurrently by a pool
+        of threads, each search polling with its own backoff. Searches are dispatched
+        and their results processed by the check, in order, page by page as
+        they are retrieved.
+        """
+        if not saved_searches:
+            return False
 
+        start_time = self._current_time_seconds()
+        parallel = max(1, instance.saved_searches_parallel)
+        pool = instance.get_search_pool()
+        # (sid, saved search, its results), in dispatch order
+        in_flight = deque()
+        to_dispatch = iter(saved_searches)
         executed_searches = False
-        for (sid, saved_search) in search_ids:
-            try:
-                self.log.debug("Processing saved search: %s." % saved_search.name)
-                count = self._process_saved_search(sid, saved_search, instance)
-                duration = self._current_time_seconds() - start_time
-                self.log.debug("Save search done: %s in time %d with results %d" % (saved_search.name, duration, count))
-                executed_searches = True
-            except Exception as e:
-                self._log_warning(instance, "Failed to execute dispatched search '%s' with id %s due to: %s" % (saved_search.name, sid, e.message))
+        try:
+            while True:
+                while len(in_flight) < parallel:
+                    saved_search = next(to_dispatch, None)
+                    if saved_search is None:
+                        break
+                    sid = self._dispatch_search(instance, saved_search)
+                    if sid is not None:
+                        results = PrefetchedSearchResults(partial(self._search, sid, saved_search, instance))
+                        pool.apply_async(results.fetch)
+                        in_flight.append((sid, saved_search, results))
+
+                if not in_flight:
+                    break
+
+                sid, saved_search, results = in_flight.popleft()
+                try:
+                    self.log.debug("Processing saved search: %s." % saved_search.name)
+                    count = self._process_saved_search(sid, saved_search, instance, results)
+                    duration = self._current_time_seconds() - start_time
+                    self.log.debug("Save search done: %s in time %d with results %d" % (saved_search.name, duration, count))
+                    executed_searches = True
+                except Exception as e:
+                    self._log_warning(instance, "Failed to execute dispatched search '%s' with id %s due to: %s" % (saved_search.name, sid, e.message))
+                finally:
+                    results.cancel()
+        finally:
+            for _, _, results in in_flight:
+                results.cancel()
 
         return executed_searches
 
-    def _process_saved_search(self, search_id, saved_search, instance):
+    def _dispatch_search(self, instance, saved_search):
+        """
+        Finalize the previous job of the saved search and dispatch it, return
+        its search id or None when it failed.
+        """
+        try:
+            # a unique saved search key to persist the data
+            persist_status_key = instance.instance_config.base_url + saved_search.name
+            if self.status.data.get(persist_status_key) is not None:
+                sid = self.status.data[persist_status_key]
+                self._finalize_sid(instance, sid, saved_search)
+                self.update_persistent_status(instance.instance_config.base_url, saved_search.name, sid, 'remove')
+            sid = self._dispatch_saved_search(instance, saved_search)
+            self.update_persistent_status(instance.instance_config.base_url, saved_search.name, sid, "add")
+            return sid
+        except FinalizeException as e:
+            self.log.exception("Got an error %s while finalizing the saved search %s" % (e.message, saved_search.name))
+            if not instance.instance_config.ignore_saved_search_errors:
+                raise e
+            self.log.warning("Ignoring the finalize exception as ignore_saved_search_errors flag is true")
+        except Exception as e:
+            self._log_warning(instance, "Failed to dispatch saved search '%s' due to: %s" % (saved_search.name, e.message))
+        return None
+
+    def _process_saved_search(self, search_id, saved_search, instance, responses=None):
         produced_count = 0
         fail_count = 0
 
         sent_events = saved_search.last_observed_telemetry
         saved_search.last_observed_telemetry = set()
 
-        for response in self._search(search_id, saved_search, instance):
+        if responses is None:
+            responses = self._search(search_id, saved_search, instance)
+        for response in responses:
             for message in response['messages']:
                 if message['type'] != "FATAL":
                     if message['type'] == "INFO" and message['text'] == "No matching fields exist":